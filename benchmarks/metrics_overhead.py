@@ -0,0 +1,87 @@
+"""
+Measures the cost of the metrics instrumentation on the scheduler hot path.
+
+Run from the repository root::
+
+    python -m benchmarks.metrics_overhead
+"""
+import io
+import sys
+import time
+
+from periodtask import Task, TaskList
+from periodtask.metrics import Registry
+from periodtask.process_thread import ProcessThread
+
+
+def best(func, *args, repeat=5):
+    return min(func(*args) for _ in range(repeat))
+
+
+def tick_cost(tasks, metrics, rounds):
+    tl = TaskList(
+        *[
+            Task('bench_%s' % i, ('true',), '* * * * * -1526')
+            for i in range(tasks)
+        ],
+        metrics=Registry() if metrics else None
+    )
+    now = int(time.time())
+    start = time.perf_counter()
+    for _ in range(rounds):
+        tl.last_checked = now - 1
+        tl._tick()
+    return (time.perf_counter() - start) / rounds
+
+
+def outcome_cost(metrics, rounds):
+    task = Task('bench', ('true',), '* * * * * -1526')
+    if metrics:
+        task.metrics = TaskList(task, metrics=Registry()).metrics
+    start = time.perf_counter()
+    for _ in range(rounds):
+        task.emit('skipped', '2020-01-01 00:00:00')
+    return (time.perf_counter() - start) / rounds
+
+
+def read_cost(lines):
+    thrd = ProcessThread(
+        'bench', ('true',), None, 10, '', 50, None, None, None, None, None
+    )
+    desc = io.StringIO(('x' * 80 + '\n') * lines)
+    h, t, m = thrd.max_lines[:3]
+    start = time.perf_counter()
+    while thrd.read_descriptor(
+        desc, thrd.stdout_head, thrd.stdout_tail, None, None, h, t, m
+    ):
+        pass
+    return (time.perf_counter() - start) / lines
+
+
+def main():
+    results = []
+    for tasks in (100, 1000):
+        results.append((
+            '_tick, %s tasks' % tasks,
+            best(tick_cost, tasks, False, 100),
+            best(tick_cost, tasks, True, 100),
+        ))
+    results.append((
+        'outcome (emit)',
+        best(outcome_cost, False, 100000),
+        best(outcome_cost, True, 100000),
+    ))
+    for name, off, on in results:
+        print('%-24s off %9.2f us  on %9.2f us  overhead %+8.2f us' % (
+            name, off * 1e6, on * 1e6, (on - off) * 1e6
+        ))
+    # line counting is not optional, it is two additions under the lock
+    # read_descriptor takes anyway
+    print('%-24s %9.2f us/line' % (
+        'read_descriptor', best(read_cost, 100000) * 1e6
+    ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
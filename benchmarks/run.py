@@ -0,0 +1,285 @@
+"""
+Benchmark suite of periodtask.
+
+Run from the repository root::
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json --threshold 0.2
+
+Every case reports one number. With ``--compare`` the results are compared
+to an earlier run and the exit status is 1 if any case regressed by more
+than the threshold (a fraction, 0.2 means 20%).
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from periodtask import Task, TaskList
+from periodtask.metrics import Registry
+from periodtask.periods import Period
+from periodtask.process_thread import ProcessThread, POPEN, POSIX_SPAWN
+from periodtask.simulation import Simulation, Profile
+
+
+CASES = []
+(LOWER, HIGHER) = ('lower', 'higher')
+
+
+def case(name, unit, better=LOWER):
+    def decorator(func):
+        CASES.append((name, unit, better, func))
+        return func
+    return decorator
+
+
+def best(func, repeat, better=LOWER):
+    values = [func() for _ in range(repeat)]
+    return min(values) if better == LOWER else max(values)
+
+
+# Period._check
+
+EXPRESSIONS = {
+    'simple': '0 */5 * * * * UTC',
+    'lists': '0,30 0,15,30,45 8-18 1,15,28 * * Europe/Budapest',
+    'steps': '*/7 */3 1-23/2 */2 */3 * UTC',
+    'lf': '0 0 21 sun/L,mon/F,fri/LL * * UTC',
+}
+
+
+def period_check(cron, count=20000):
+    period = Period(cron)
+    start_sec = 1530000000
+    start = time.perf_counter()
+    for sec in range(start_sec, start_sec + count):
+        period._check(sec)
+    return count / (time.perf_counter() - start)
+
+
+for _name, _cron in EXPRESSIONS.items():
+    case(
+        'period_check_%s' % _name, 'checks/s', HIGHER
+    )(lambda cron=_cron: period_check(cron))
+
+
+# TaskList._tick
+
+def tick_cost(tasks, rounds, metrics=None):
+    tl = TaskList(*[
+        Task('bench_%s' % i, ('true',), '0 0 0 1 1 * UTC')
+        for i in range(tasks)
+    ], metrics=metrics)
+    now = int(time.time())
+    start = time.perf_counter()
+    for _ in range(rounds):
+        tl.last_checked = now - 1
+        tl._tick()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+for _tasks, _rounds in ((100, 200), (1000, 50), (10000, 5)):
+    case('tick_%s_tasks' % _tasks, 'ms')(
+        lambda tasks=_tasks, rounds=_rounds: tick_cost(tasks, rounds)
+    )
+
+
+@case('tick_1000_tasks_metrics', 'ms')
+def tick_cost_metrics():
+    return tick_cost(1000, 50, Registry())
+
+
+# ProcessThread
+
+def process_thread(command, max_lines=50, launcher=POPEN):
+    return ProcessThread(
+        'bench', command, None, 10, '', max_lines, None, None, None, None,
+        None, launcher=launcher
+    )
+
+
+def spawn_latency(launcher=POPEN, count=20):
+    start = time.perf_counter()
+    for _ in range(count):
+        thrd = process_thread(('true',), launcher=launcher)
+        thrd.start()
+        thrd.join()
+    return (time.perf_counter() - start) / count * 1000
+
+
+for _launcher in (POPEN, POSIX_SPAWN):
+    case('spawn_latency_%s' % _launcher, 'ms')(
+        lambda launcher=_launcher: spawn_latency(launcher)
+    )
+
+
+@case('spawn_rate', 'processes/s', HIGHER)
+def spawn_rate(count=100):
+    start = time.perf_counter()
+    threads = [process_thread(('true',)) for _ in range(count)]
+    for thrd in threads:
+        thrd.start()
+    for thrd in threads:
+        thrd.join()
+    return count / (time.perf_counter() - start)
+
+
+def ingestion(max_lines, lines=200000, width=99):
+    command = ('sh', '-c', 'yes %s | head -n %s' % ('x' * width, lines))
+    thrd = process_thread(command, max_lines)
+    start = time.perf_counter()
+    thrd.start()
+    thrd.join()
+    return lines * (width + 1) / (time.perf_counter() - start) / 1e6
+
+
+for _max_lines in (10, 1000, 100000):
+    case('ingestion_max_lines_%s' % _max_lines, 'MB/s', HIGHER)(
+        lambda max_lines=_max_lines: ingestion(max_lines)
+    )
+
+
+# templates
+
+def render(max_lines, count=5):
+    task = Task('bench', ('true',), max_lines=max_lines)
+    thrd = process_thread(
+        ('sh', '-c', 'yes %s | head -n %s' % ('x' * 99, 4 * max_lines)),
+        max_lines
+    )
+    thrd.start()
+    thrd.join()
+
+    def send(subject, text, html_message=None):
+        pass
+    start = time.perf_counter()
+    for _ in range(count):
+        task.send_mail_template(
+            send, 'success_subject.txt', 'success.txt', 'success.html',
+            subproc=thrd, stats=task.stats
+        )
+    return (time.perf_counter() - start) / count * 1000
+
+
+for _max_lines in (50, 5000):
+    case('render_max_lines_%s' % _max_lines, 'ms')(
+        lambda max_lines=_max_lines: render(max_lines)
+    )
+
+
+# Simulation
+
+@case('simulate_month_1000_tasks', 's')
+def simulate_month(tasks=1000, days=30):
+    # hourly tasks and daily ones at different minutes
+    tl = TaskList(*[
+        Task(
+            'sim_%s' % i, ('true',),
+            '0 %s %s * * * UTC' % (i % 60, '*' if i % 10 == 0 else i % 24)
+        )
+        for i in range(tasks)
+    ])
+    start = 1530000000
+    simulation = Simulation(
+        tl, start, start + days * 86400, default=Profile(duration=(1, 600))
+    )
+    started = time.perf_counter()
+    simulation.run()
+    return time.perf_counter() - started
+
+
+# Memory
+
+def memory_per_task(tasks=10000, distinct=20):
+    # many tasks sharing a few schedules, as in a large installation
+    crons = ['0 %s * * * * UTC' % (i * 3) for i in range(distinct)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tl = TaskList(*[
+            Task('mem_%s' % i, ('true',), crons[i % distinct])
+            for i in range(tasks)
+        ])
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del tl
+    return (after - before) / tasks
+
+
+case('memory_per_task', 'bytes')(memory_per_task)
+
+
+def compare(results, baseline, threshold):
+    """Return the names of the cases that regressed."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        value, base_value = result['value'], base['value']
+        if result['better'] == LOWER:
+            regressed = value > base_value * (1 + threshold)
+        else:
+            regressed = value < base_value * (1 - threshold)
+        change = (value - base_value) / base_value * 100
+        print('%-28s %12.3f -> %12.3f %s (%+.1f%%)%s' % (
+            name, base_value, value, result['unit'], change,
+            ' REGRESSION' if regressed else ''
+        ))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='periodtask benchmarks')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='allowed regression as a fraction (default: 0.2)'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='the best of this many runs is taken (default: 3)'
+    )
+    parser.add_argument(
+        'filter', nargs='*', help='only run cases containing these strings'
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, unit, better, func in CASES:
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        value = best(func, args.repeat, better)
+        results[name] = {'value': value, 'unit': unit, 'better': better}
+        print('%-28s %12.3f %s' % (name, value, unit))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%s regression(s) over %s%%' % (
+                len(regressions), args.threshold * 100
+            ))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
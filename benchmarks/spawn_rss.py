@@ -0,0 +1,52 @@
+"""
+Measures the spawn latency of the launchers as the scheduler's RSS grows.
+
+Run from the repository root::
+
+    python -m benchmarks.spawn_rss 0 256 1024
+"""
+import argparse
+import json
+import resource
+import sys
+
+from periodtask.process_thread import POPEN, POSIX_SPAWN
+from .run import best, spawn_latency
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        'sizes', nargs='*', type=int, default=[0, 128, 512],
+        help='ballast sizes in MB (default: 0 128 512)'
+    )
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    ballast = []
+    allocated = 0
+    results = []
+    for size in sorted(args.sizes):
+        chunk = bytearray((size - allocated) * 1024 * 1024)
+        # touch every page, so that it is really part of the RSS
+        chunk[::4096] = b'\x01' * len(range(0, len(chunk), 4096))
+        ballast.append(chunk)
+        allocated = size
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        row = {'ballast_mb': size, 'max_rss_mb': rss}
+        for launcher in (POPEN, POSIX_SPAWN):
+            row[launcher] = best(lambda: spawn_latency(launcher), 3)
+        results.append(row)
+        print('RSS %6s MB   popen %7.3f ms   posix_spawn %7.3f ms' % (
+            rss, row[POPEN], row[POSIX_SPAWN]
+        ))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,11 @@
-from .task import Task, SKIP, DELAY, RUN
+from .task import (
+    Task, SKIP, DELAY, RUN, DROP_OLDEST, DROP_NEWEST, COALESCE
+)
 from .periods import BadCronFormat
+from .dag import DependencyError
 from .tasklist import TaskList
 
-__all__ = (TaskList, Task, BadCronFormat, SKIP, DELAY, RUN)
+__all__ = (
+    TaskList, Task, BadCronFormat, DependencyError, SKIP, DELAY, RUN,
+    DROP_OLDEST, DROP_NEWEST, COALESCE
+)
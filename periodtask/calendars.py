@@ -0,0 +1,240 @@
+"""
+Calendars of days for the ``include_days`` and ``exclude_days`` parameters
+of :py:class:`Task <periodtask.Task>` (and
+:py:class:`Period <periodtask.periods.Period>`), e.g. exchange holidays::
+
+    holidays = Calendar(
+        dates=['2024-07-05'],
+        rules=[
+            annual(1, 1, observed=True), nth_weekday(1, 'MON', 3),
+            easter(-2), nth_weekday(11, 'THU', 4), annual(12, 25, True),
+        ]
+    )
+    Task('settle', ('settle.sh',), '0 0 18 MON-FRI * * America/New_York',
+         exclude_days=holidays)
+
+A calendar is compiled into a bitmap of the days of a year when a day of
+that year is first looked up, so a check is a single index operation.
+Create calendars once and pass them to all the tasks they apply to.
+"""
+import logging
+import os
+import re
+from datetime import date, datetime, timedelta
+
+
+logger = logging.getLogger('periodtask.calendars')
+WEEKDAYS = {
+    'MON': 1, 'TUE': 2, 'WED': 3, 'THU': 4, 'FRI': 5, 'SAT': 6, 'SUN': 7
+}
+ONE_DAY = timedelta(days=1)
+
+
+def _date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def weekends(year):
+    """Rule: the Saturdays and Sundays of ``year``."""
+    day = date(year, 1, 1)
+    while day.year == year:
+        if day.isoweekday() >= 6:
+            yield day
+        day += ONE_DAY
+
+
+def annual(month, day, observed=False):
+    """
+    Rule: the same day every year. With ``observed`` a Saturday is moved to
+    the Friday before, a Sunday to the Monday after.
+    """
+    def rule(year):
+        d = date(year, month, day)
+        if observed and d.isoweekday() == 6:
+            d -= ONE_DAY
+        elif observed and d.isoweekday() == 7:
+            d += ONE_DAY
+        return [d]
+    return rule
+
+
+def nth_weekday(month, weekday, n):
+    """
+    Rule: the ``n``-th ``weekday`` (``'MON'`` ... ``'SUN'``) of ``month``,
+    counted from the end of the month if ``n`` is negative.
+    """
+    iso = WEEKDAYS[weekday.upper()]
+
+    def rule(year):
+        if n > 0:
+            first = date(year, month, 1)
+            d = first + timedelta(days=(iso - first.isoweekday()) % 7)
+            d += timedelta(days=7 * (n - 1))
+        else:
+            last = date(year + month // 12, month % 12 + 1, 1) - ONE_DAY
+            d = last - timedelta(days=(last.isoweekday() - iso) % 7)
+            d -= timedelta(days=7 * (-n - 1))
+        return [d] if d.month == month else []
+    return rule
+
+
+def easter(offset=0):
+    """
+    Rule: ``offset`` days from (Western) Easter Sunday, e.g. ``-2`` is Good
+    Friday, ``1`` is Easter Monday.
+    """
+    def rule(year):
+        # the anonymous Gregorian algorithm
+        a, b, c = year % 19, year // 100, year % 100
+        d, e = b // 4, b % 4
+        f = (b + 8) // 25
+        g = (b - f + 1) // 3
+        h = (19 * a + b - d - g + 15) % 30
+        i, k = c // 4, c % 4
+        m = (32 + 2 * e + 2 * i - h - k) % 7
+        n = (a + 11 * h + 22 * m) // 451
+        month, day = divmod(h + m - 7 * n + 114, 31)
+        return [date(year, month, day + 1) + timedelta(days=offset)]
+    return rule
+
+
+class Calendar:
+    """
+    A set of days: explicit ``dates`` and the days given by ``rules``.
+
+    :param list dates: ``datetime.date`` objects or ``'YYYY-MM-DD'``
+      strings.
+    :param list rules: Functions taking a year and returning the days of
+      that year, see :py:func:`weekends`, :py:func:`annual`,
+      :py:func:`nth_weekday` and :py:func:`easter`.
+    :param str name: The name of the calendar, shown in its ``repr``.
+    """
+    def __init__(self, dates=(), rules=(), name=None):
+        self.name = name
+        self.rules = list(rules)
+        # the explicit dates by year
+        self.dates = {}
+        for d in dates:
+            d = _date(d)
+            self.dates.setdefault(d.year, []).append(d)
+        # year -> (ordinal of January 1, bytearray of the days)
+        self.years = {}
+
+    @classmethod
+    def from_ics(cls, source, rules=(), name=None):
+        """
+        Create a calendar of the all-day events of an iCalendar file (or
+        text). Events repeating every year (``RRULE:FREQ=YEARLY``, with
+        ``UNTIL`` or ``COUNT``) become rules, other repetitions are not
+        supported: only their first occurrence is taken.
+        """
+        if os.path.exists(source):
+            with open(source, encoding='utf-8') as f:
+                source = f.read()
+        # unfold the continuation lines
+        text = re.sub(r'\r?\n[ \t]', '', source)
+        dates, rules = [], list(rules)
+        event = None
+        for line in text.splitlines():
+            key, _, value = line.partition(':')
+            key = key.split(';')[0].upper()
+            if key == 'BEGIN' and value.upper() == 'VEVENT':
+                event = {}
+            elif key == 'END' and value.upper() == 'VEVENT':
+                if 'DTSTART' in event:
+                    _ics_event(event, dates, rules)
+                event = None
+            elif event is not None and key in ('DTSTART', 'DTEND', 'RRULE'):
+                event[key] = value.strip()
+        return cls(dates, rules, name)
+
+    def _compile(self, year):
+        first = date(year, 1, 1).toordinal()
+        days = bytearray(date(year, 12, 31).toordinal() - first + 1)
+        for d in self.dates.get(year, ()):
+            days[d.toordinal() - first] = 1
+        for rule in self.rules:
+            # the days of a rule may fall into the next or previous year
+            # (observed days, events of several days)
+            for y in range(max(1, year - 1), min(9999, year + 1) + 1):
+                for d in rule(y):
+                    if d.year == year:
+                        days[d.toordinal() - first] = 1
+        self.years[year] = compiled = (first, days)
+        return compiled
+
+    def __contains__(self, day):
+        compiled = self.years.get(day.year)
+        if compiled is None:
+            compiled = self._compile(day.year)
+        first, days = compiled
+        return days[day.toordinal() - first] == 1
+
+    def next_day(self, day, last):
+        """
+        The first day of the calendar not before ``day`` and not after
+        ``last``, ``None`` if there is none.
+        """
+        day, last = _date(day), _date(last)
+        for year in range(day.year, last.year + 1):
+            first, days = self.years.get(year) or self._compile(year)
+            start = max(0, day.toordinal() - first)
+            i = days.find(1, start)
+            if i != -1:
+                found = date.fromordinal(first + i)
+                return found if found <= last else None
+        return None
+
+    def __repr__(self):
+        return '<Calendar %s>' % (self.name or hex(id(self)))
+
+
+def _ics_date(value):
+    return datetime.strptime(value[:8], '%Y%m%d').date()
+
+
+def _ics_event(event, dates, rules):
+    start = _ics_date(event['DTSTART'])
+    end = start + ONE_DAY
+    if 'DTEND' in event:
+        # exclusive
+        end = max(end, _ics_date(event['DTEND']))
+    length = (end - start).days
+    rrule = dict(
+        part.split('=', 1) for part in event.get('RRULE', '').split(';')
+        if '=' in part
+    )
+    if not rrule:
+        dates.extend(start + timedelta(days=i) for i in range(length))
+        return
+    if rrule.get('FREQ') != 'YEARLY' or set(rrule) - {
+        'FREQ', 'UNTIL', 'COUNT', 'INTERVAL'
+    }:
+        logger.warning('unsupported RRULE, first occurrence only: %s' % (
+            event['RRULE'],
+        ))
+        dates.extend(start + timedelta(days=i) for i in range(length))
+        return
+    interval = int(rrule.get('INTERVAL', 1))
+    until = None
+    if 'UNTIL' in rrule:
+        until = _ics_date(rrule['UNTIL']).year
+    if 'COUNT' in rrule:
+        until = start.year + (int(rrule['COUNT']) - 1) * interval
+
+    def rule(year):
+        if year < start.year or (until is not None and year > until):
+            return []
+        if (year - start.year) % interval:
+            return []
+        try:
+            first = start.replace(year=year)
+        except ValueError:
+            # February 29
+            return []
+        return [first + timedelta(days=i) for i in range(length)]
+    rules.append(rule)
@@ -0,0 +1,30 @@
+import time
+
+
+class Clock:
+    """The clock of the scheduler: the system clock."""
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+SYSTEM_CLOCK = Clock()
+
+
+class VirtualClock(Clock):
+    """
+    A clock that only moves when it is told to, see
+    :py:class:`periodtask.simulation.Simulation`.
+
+    :param number now: The initial time (a UNIX timestamp).
+    """
+    def __init__(self, now=0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
@@ -0,0 +1,346 @@
+"""
+A control API on a Unix domain socket, see the ``control_socket`` parameter
+of :py:class:`TaskList <periodtask.TaskList>`.
+
+Requests and responses are JSON objects, one per line. A request has a
+``cmd`` and maybe other arguments, the response is either
+``{"ok": true, "result": ...}`` or ``{"ok": false, "error": "..."}``.
+
+Client usage::
+
+    python -m periodtask.control /run/periodtask.sock tasks
+    python -m periodtask.control /run/periodtask.sock trigger my_task
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger('periodtask.control')
+
+POLICIES = {0: 'SKIP', 1: 'DELAY', 2: 'RUN'}
+
+
+class ControlError(Exception):
+    pass
+
+
+def _format(sec):
+    if sec is None:
+        return None
+    return time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(sec))
+
+
+class ControlServer:
+    """
+    Serves the control API of ``tasklist`` on the Unix socket ``path`` from
+    a single selector thread.
+
+    Status requests (``tasks``, ``running``, ``queue``, ``history``) are
+    answered from the selector thread. Changes (``trigger``, ``pause``,
+    ``resume``, ``kill``) are queued and applied by the scheduler at the
+    start of its next tick, the response is sent after that.
+    """
+    READ_COMMANDS = ('tasks', 'running', 'queue', 'history')
+    CHANGE_COMMANDS = ('trigger', 'pause', 'resume', 'kill')
+
+    def __init__(self, tasklist, path):
+        self.tasklist = tasklist
+        self.path = path
+        # (connection, request) tuples for the scheduler
+        self.pending = collections.deque()
+        # (connection, response) tuples for the selector thread
+        self.replies = collections.deque()
+        self.buffers = {}
+        self.selector = None
+        self.sock = None
+        self.thread = None
+        self.closing = False
+
+    def start(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.thread = threading.Thread(
+            target=self._work, daemon=True, name='control'
+        )
+        self.thread.start()
+        logger.info('control socket listening on %s' % self.path)
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.closing = True
+        self._wakeup()
+        self.thread.join(timeout=5)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _wakeup(self):
+        try:
+            self.wakeup_w.send(b'x')
+        except (BlockingIOError, OSError):
+            pass
+
+    # selector thread
+
+    def _work(self):
+        while not self.closing:
+            for key, mask in self.selector.select():
+                sock = key.fileobj
+                if sock is self.sock:
+                    self._accept()
+                elif sock is self.wakeup_r:
+                    self._drain_wakeup()
+                else:
+                    if mask & selectors.EVENT_READ:
+                        self._read(sock)
+                    if mask & selectors.EVENT_WRITE and sock in self.buffers:
+                        self._write(sock)
+        for sock in list(self.buffers):
+            self._close(sock)
+        self.selector.close()
+        self.sock.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def _accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.buffers[conn] = [b'', b'']
+        self.selector.register(conn, selectors.EVENT_READ)
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.replies:
+            conn, response = self.replies.popleft()
+            if conn in self.buffers:
+                self._send(conn, response)
+
+    def _close(self, conn):
+        self.selector.unregister(conn)
+        del self.buffers[conn]
+        conn.close()
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(conn)
+            return
+        buf = self.buffers[conn]
+        buf[0] += data
+        while b'\n' in buf[0]:
+            line, buf[0] = buf[0].split(b'\n', 1)
+            if line.strip():
+                self._handle(conn, line)
+
+    def _write(self, conn):
+        buf = self.buffers[conn]
+        try:
+            sent = conn.send(buf[1])
+        except BlockingIOError:
+            return
+        except OSError:
+            self._close(conn)
+            return
+        buf[1] = buf[1][sent:]
+        if not buf[1]:
+            self.selector.modify(conn, selectors.EVENT_READ)
+
+    def _send(self, conn, response):
+        buf = self.buffers[conn]
+        buf[1] += json.dumps(response).encode() + b'\n'
+        self.selector.modify(
+            conn, selectors.EVENT_READ | selectors.EVENT_WRITE
+        )
+
+    def _handle(self, conn, line):
+        cmd = None
+        try:
+            request = json.loads(line.decode())
+            cmd = request.get('cmd')
+            if cmd in self.READ_COMMANDS:
+                result = getattr(self, 'cmd_%s' % cmd)(request)
+            elif cmd in self.CHANGE_COMMANDS:
+                self._task(request)
+                self.pending.append((conn, request))
+                return
+            else:
+                raise ControlError('unknown command: %s' % cmd)
+        except (ValueError, AttributeError, ControlError) as e:
+            self._send(conn, {'ok': False, 'error': str(e)})
+            return
+        except Exception as e:
+            # a bad request must not stop the selector thread
+            logger.exception('control command %s failed' % cmd)
+            self._send(conn, {'ok': False, 'error': str(e)})
+            return
+        self._send(conn, {'ok': True, 'result': result})
+
+    def _task(self, request):
+        name = request.get('task')
+        for task in self.tasklist.tasks:
+            if task.name == name:
+                return task
+        raise ControlError('unknown task: %s' % name)
+
+    def cmd_tasks(self, request):
+        now = int(self.tasklist.clock.time())
+        result = []
+        for task in self.tasklist.tasks:
+            next_fire = task.next_fire(now + 1)
+            result.append({
+                'name': task.name,
+                'policy': POLICIES.get(task.policy, task.policy),
+                'paused': task.paused,
+                'periods': [p.cron for p in task.periods],
+                'next_fire': next_fire,
+                'next_fire_formatted': _format(next_fire),
+                'running': len(task.process_threads),
+                'delayed': len(task.delay_queue),
+            })
+        return result
+
+    def cmd_running(self, request):
+        now = self.tasklist.clock.time()
+        result = []
+        for task in self.tasklist.tasks:
+            for thrd in list(task.process_threads):
+                proc, start = thrd.proc, thrd.start_time
+                result.append({
+                    'task': task.name,
+                    'scheduled': thrd.formatted_sec,
+                    'pid': proc.pid if proc is not None else None,
+                    'elapsed': now - start if start is not None else None,
+                })
+        return result
+
+    def cmd_queue(self, request):
+        return [
+            {
+                'task': task.name,
+                'delayed': [f for _, f, _ in list(task.delay_queue)],
+                'coalesced': [n for _, _, n in list(task.delay_queue)],
+            }
+            for task in self.tasklist.tasks
+        ]
+
+    def cmd_history(self, request):
+        runs = list(self.tasklist.history)
+        if request.get('task'):
+            self._task(request)
+            runs = [r for r in runs if r['task'] == request['task']]
+        limit = request.get('limit')
+        if limit:
+            runs = runs[-int(limit):]
+        return runs
+
+    # scheduler thread
+
+    def apply_pending(self):
+        """Apply the queued changes, called by the scheduler."""
+        if not self.pending:
+            return
+        while self.pending:
+            conn, request = self.pending.popleft()
+            cmd = request['cmd']
+            try:
+                task = self._task(request)
+                if cmd == 'trigger':
+                    task.trigger()
+                    result = None
+                elif cmd == 'pause':
+                    task.pause()
+                    result = None
+                elif cmd == 'resume':
+                    task.resume()
+                    result = None
+                else:
+                    result = {'stopped': task.kill_processes()}
+                response = {'ok': True, 'result': result}
+            except Exception as e:
+                logger.exception('control command %s failed' % cmd)
+                response = {'ok': False, 'error': str(e)}
+            self.replies.append((conn, response))
+        self._wakeup()
+
+
+def request(path, cmd, timeout=10, **kwargs):
+    """Send a request to the control socket ``path`` and return the result."""
+    kwargs['cmd'] = cmd
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(kwargs).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    response = json.loads(data.decode())
+    if not response['ok']:
+        raise ControlError(response['error'])
+    return response['result']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='periodtask control client')
+    parser.add_argument('socket', help='path of the control socket')
+    parser.add_argument(
+        'cmd', choices=ControlServer.READ_COMMANDS +
+        ControlServer.CHANGE_COMMANDS
+    )
+    parser.add_argument('task', nargs='?', help='name of the task')
+    parser.add_argument('--limit', type=int, help='number of runs (history)')
+    parser.add_argument('--timeout', type=float, default=10)
+    args = parser.parse_args(argv)
+    kwargs = {}
+    if args.task:
+        kwargs['task'] = args.task
+    if args.limit:
+        kwargs['limit'] = args.limit
+    try:
+        result = request(args.socket, args.cmd, args.timeout, **kwargs)
+    except (OSError, ControlError) as e:
+        print('error: %s' % e, file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import logging
+
+
+logger = logging.getLogger('periodtask.dag')
+
+(PENDING, QUEUED, RUNNING, SUCCESS, FAILURE, TIMEOUT, SKIPPED) = (
+    'pending', 'queued', 'running', 'success', 'failure', 'timeout',
+    'skipped'
+)
+
+
+class DependencyError(Exception):
+    pass
+
+
+def resolve(tasks):
+    """
+    Replace the ``upstream`` names of ``tasks`` with the tasks, set their
+    ``downstream`` lists and check that there is no cycle and that no task
+    depends on several root tasks.
+    """
+    by_name = {}
+    for task in tasks:
+        by_name.setdefault(task.name, []).append(task)
+    for task in tasks:
+        upstream = []
+        for up in task.upstream:
+            if isinstance(up, str):
+                if up not in by_name:
+                    raise DependencyError('unknown upstream task of %s: %s' % (
+                        task.name, up
+                    ))
+                if len(by_name[up]) > 1:
+                    raise DependencyError(
+                        'ambiguous upstream task of %s: %s' % (task.name, up)
+                    )
+                up = by_name[up][0]
+            elif up not in tasks:
+                raise DependencyError(
+                    'upstream task of %s is not in the task list: %s' % (
+                        task.name, up.name
+                    )
+                )
+            upstream.append(up)
+        task.upstream = upstream
+        task.downstream = []
+    for task in tasks:
+        for up in task.upstream:
+            up.downstream.append(task)
+
+    # depth-first search, a task on the current path seen again is a cycle
+    done, path = set(), []
+
+    def visit(task):
+        if task in done:
+            return
+        if task in path:
+            cycle = path[path.index(task):] + [task]
+            raise DependencyError('dependency cycle: %s' % ' -> '.join(
+                t.name for t in cycle
+            ))
+        path.append(task)
+        for down in task.downstream:
+            visit(down)
+        path.pop()
+        done.add(task)
+
+    for task in tasks:
+        visit(task)
+
+    # a DAG run starts from a single root task, a task depending on several
+    # roots would run once for each of them, without waiting for the others
+    roots = {}
+
+    def roots_of(task):
+        if task not in roots:
+            if task.upstream:
+                roots[task] = set().union(
+                    *(roots_of(up) for up in task.upstream)
+                )
+            else:
+                roots[task] = {task}
+        return roots[task]
+
+    for task in tasks:
+        found = roots_of(task)
+        if len(found) > 1:
+            raise DependencyError(
+                'task %s depends on several root tasks: %s' % (
+                    task.name, ', '.join(sorted(t.name for t in found))
+                )
+            )
+
+
+class DagNode:
+    """The state of a task in a :py:class:`DagRun`."""
+    def __init__(self, task_name):
+        self.task_name = task_name
+        self.state = PENDING
+        self.returncode = None
+        self.duration = None
+
+
+class DagRun:
+    """
+    A run of the tasks reachable from ``root`` (a task without upstream
+    tasks), started when ``root`` starts. A task is queued when all of its
+    upstream tasks succeeded (all of them are reachable from ``root``, see
+    :py:func:`resolve`). When a task fails, the tasks depending on it are
+    skipped.
+    """
+    def __init__(self, root, formatted_sec):
+        self.root = root
+        self.formatted_sec = formatted_sec
+        self.started = root.clock.time()
+        self.finished = None
+        self.outcome = None
+        self.tasks = []
+        stack = [root]
+        while stack:
+            task = stack.pop()
+            if task not in self.tasks:
+                self.tasks.append(task)
+                stack.extend(task.downstream)
+        self.nodes = dict((t, DagNode(t.name)) for t in self.tasks)
+        self.nodes[root].state = RUNNING
+
+    @property
+    def node_list(self):
+        return [self.nodes[t] for t in self.tasks]
+
+    @property
+    def done(self):
+        return all(
+            n.state in (SUCCESS, FAILURE, TIMEOUT, SKIPPED)
+            for n in self.nodes.values()
+        )
+
+    def task_started(self, task):
+        self.nodes[task].state = RUNNING
+
+    def task_finished(self, task, outcome, thrd):
+        node = self.nodes[task]
+        node.state = outcome
+        node.returncode = thrd.returncode
+        if thrd.result is not None:
+            node.duration = thrd.result.duration
+        if outcome == SUCCESS:
+            for down in task.downstream:
+                if self.nodes[down].state != PENDING:
+                    continue
+                if all(
+                    self.nodes[up].state == SUCCESS
+                    for up in down.upstream
+                ):
+                    self.nodes[down].state = QUEUED
+                    down.dag_queue.append(self)
+        else:
+            self._skip_downstream(task)
+        if self.done:
+            self._finish()
+
+    def _skip_downstream(self, task):
+        for down in task.downstream:
+            node = self.nodes[down]
+            if node.state in (PENDING, QUEUED):
+                if node.state == QUEUED and self in down.dag_queue:
+                    down.dag_queue.remove(self)
+                node.state = SKIPPED
+                logger.warning('task %s skipped in DAG run %s %s' % (
+                    down.name, self.root.name, self.formatted_sec
+                ))
+                self._skip_downstream(down)
+
+    def _finish(self):
+        self.finished = self.root.clock.time()
+        ok = all(n.state == SUCCESS for n in self.nodes.values())
+        self.outcome = SUCCESS if ok else FAILURE
+        logger.info('DAG run %s %s finished: %s' % (
+            self.root.name, self.formatted_sec, self.outcome
+        ))
+        if self.root.mail_dag:
+            self.root.notify('dag', self.root.mail_dag, dag=self)
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+
+from .task import default_template_dir, shared_template_lookup
+from .dispatcher import send_rendered
+from .clock import SYSTEM_CLOCK
+
+
+logger = logging.getLogger('periodtask.digest')
+
+
+class DigestEntry:
+    """What a digest tells about one task."""
+    def __init__(self, task_name):
+        self.task_name = task_name
+        self.counts = {}
+        self.last_sec = None
+        self.last_returncode = None
+        self.stdout_lines = ''
+        self.stderr_lines = ''
+
+    def add(self, typ, subproc=None, current_sec=None, **kwargs):
+        self.counts[typ] = self.counts.get(typ, 0) + 1
+        if current_sec is not None:
+            self.last_sec = current_sec
+        if subproc is not None:
+            self.last_sec = subproc.formatted_sec
+            self.last_returncode = subproc.returncode
+            self.stdout_lines = subproc.stdout_lines
+            self.stderr_lines = subproc.stderr_lines
+
+
+class Digest:
+    """
+    Collects the notifications of the tasks of a
+    :py:class:`TaskList <periodtask.TaskList>` and sends one summary per
+    ``window`` seconds instead. Notifications are grouped by their e-mail
+    sending function (the ``mail_...`` parameters of the task), so every
+    recipient group gets its own summary with per-task counts and the
+    latest STDOUT and STDERR head and tail.
+
+    Every outcome (``success``, ``failure``, ``timeout``, ``skipped``,
+    ``delayed``) is counted, the thresholds of the tasks
+    (``failure_email_threshold``, ``skip_delayed_email_threshold``) only
+    limit the immediate notifications: tasks created with ``urgent=True``
+    send their FAILURE and TIMEOUT notifications immediately as well.
+
+    :param number window: The length of the summary window in seconds.
+    :param list/str template_dir: Directories to look for the ``digest``
+      templates in, before the builtin ones.
+    :param func send_mail_func: The outcomes of tasks without a ``mail_...``
+      function for them (not set or ``True``) are summarized with this
+      function. If not given, such outcomes are not summarized.
+    """
+    def __init__(self, window=3600, template_dir=[], send_mail_func=None):
+        self.window = window
+        self.send_mail_func = send_mail_func
+        if not isinstance(template_dir, list):
+            template_dir = [template_dir]
+        self.template_lookup = shared_template_lookup(
+            template_dir + [default_template_dir]
+        )
+        # the Dispatcher and the Clock of the TaskList
+        self.dispatcher = None
+        self.clock = SYSTEM_CLOCK
+        self.lock = threading.Lock()
+        # send_func -> (window start, {task name: DigestEntry})
+        self.groups = {}
+
+    def add(self, send_func, task, typ, **kwargs):
+        now = self.clock.time()
+        with self.lock:
+            start, entries = self.groups.setdefault(send_func, (now, {}))
+            entry = entries.get(task.name)
+            if entry is None:
+                entry = entries[task.name] = DigestEntry(task.name)
+            entry.add(typ, **kwargs)
+
+    def tick(self, now):
+        """Send the summaries whose window is over."""
+        with self.lock:
+            due = [
+                (send_func, self.groups.pop(send_func))
+                for send_func, (start, _) in list(self.groups.items())
+                if now >= start + self.window
+            ]
+        for send_func, (start, entries) in due:
+            self._send(send_func, start, now, entries)
+
+    def flush(self):
+        """Send every pending summary."""
+        with self.lock:
+            due, self.groups = self.groups, {}
+        now = self.clock.time()
+        for send_func, (start, entries) in due.items():
+            self._send(send_func, start, now, entries)
+
+    def _send(self, send_func, start, end, entries):
+        kwargs = {
+            'start': _format(start),
+            'end': _format(end),
+            'entries': [entries[name] for name in sorted(entries)],
+        }
+        if self.dispatcher is not None:
+            self.dispatcher.submit(
+                self.template_lookup, send_func, 'digest', kwargs
+            )
+            return
+        try:
+            send_rendered(self.template_lookup, send_func, 'digest', kwargs)
+        except Exception:
+            logger.exception('could not send digest')
+
+
+def _format(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(ts))
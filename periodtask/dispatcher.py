@@ -0,0 +1,214 @@
+import copy
+import logging
+import queue
+import threading
+import time
+
+from .dag import DagRun
+from .process_thread import ProcessThread
+
+
+logger = logging.getLogger('periodtask.dispatcher')
+
+(DROP_NEW, DROP_OLD, BLOCK) = ('drop_new', 'drop_old', 'block')
+
+
+class RunSnapshot:
+    """The state of a :py:class:`ProcessThread` when it was notified about."""
+    def __init__(self, thrd):
+        self.task_name = thrd.task_name
+        self.command = thrd.command
+        self.formatted_sec = thrd.formatted_sec
+        self.sec = thrd.sec
+        self.returncode = thrd.returncode
+        self.result = thrd.result
+        self.limit_breach = thrd.limit_breach
+        self.timed_out = thrd.timed_out
+        self.stdout_lines = thrd.stdout_lines
+        self.stderr_lines = thrd.stderr_lines
+
+
+class TaskSnapshot:
+    """The state of a :py:class:`Task <periodtask.Task>` for templates."""
+    def __init__(self, task):
+        self.name = task.name
+        self.command = task.command
+        self.process_threads = [RunSnapshot(t) for t in task.process_threads]
+
+
+class DagSnapshot:
+    """The state of a :py:class:`DagRun <periodtask.dag.DagRun>`."""
+    def __init__(self, dag):
+        self.root = TaskSnapshot(dag.root)
+        self.formatted_sec = dag.formatted_sec
+        self.started = dag.started
+        self.finished = dag.finished
+        self.outcome = dag.outcome
+        self.node_list = [copy.copy(n) for n in dag.node_list]
+
+
+def snapshot(value):
+    """Return an immutable copy of a template argument."""
+    # imported here, task imports this module
+    from .task import Task
+    from .stats import TaskStats
+
+    if isinstance(value, ProcessThread):
+        return RunSnapshot(value)
+    if isinstance(value, Task):
+        return TaskSnapshot(value)
+    if isinstance(value, DagRun):
+        return DagSnapshot(value)
+    if isinstance(value, TaskStats):
+        stats = copy.copy(value)
+        stats.recent = copy.copy(value.recent)
+        return stats
+    if isinstance(value, list):
+        return [snapshot(x) for x in value]
+    return value
+
+
+class Dispatcher:
+    """
+    Renders and sends notifications in a worker thread, so that slow
+    templates or slow e-mail sending functions do not delay scheduling.
+    Pass it to :py:class:`TaskList <periodtask.TaskList>`.
+
+    The scheduler only puts snapshots of the template arguments into a
+    bounded queue.
+
+    :param int queue_size: The size of the queue.
+    :param str overflow: What to do when the queue is full: ``'drop_new'``
+      drops the new notification, ``'drop_old'`` drops the oldest queued one
+      and ``'block'`` waits for room (delaying the scheduler).
+    """
+    def __init__(self, queue_size=1000, overflow=DROP_NEW):
+        if overflow not in (DROP_NEW, DROP_OLD, BLOCK):
+            raise ValueError('invalid overflow: %s' % overflow)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow = overflow
+        self.worker = None
+        self.lock = threading.Lock()
+        self.sent_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+        self.max_depth = 0
+        self.render_time_total = 0.0
+        self.render_time_max = 0.0
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.lock:
+            done = self.sent_count + self.failed_count
+            return {
+                'queue_depth': self.queue_depth,
+                'max_depth': self.max_depth,
+                'sent': self.sent_count,
+                'failed': self.failed_count,
+                'dropped': self.dropped_count,
+                'mean_render_time':
+                    self.render_time_total / done if done else None,
+                'max_render_time': self.render_time_max,
+            }
+
+    def in_worker(self):
+        return threading.current_thread() is self.worker
+
+    def submit(self, template_lookup, send_func, typ, kwargs, on_done=None):
+        """
+        Queue the ``typ`` notification. ``kwargs`` must not reference
+        objects the scheduler changes later, see :py:func:`snapshot`.
+        ``on_done`` is called with ``True`` or ``False`` (not sent) when
+        the notification is done with.
+        """
+        if self.worker is None:
+            self.worker = threading.Thread(
+                target=self._work, daemon=True, name='dispatcher'
+            )
+            self.worker.start()
+        job = (template_lookup, send_func, typ, kwargs, on_done)
+        if self.overflow == BLOCK:
+            self.queue.put(job)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(job)
+                    break
+                except queue.Full:
+                    if self.overflow == DROP_NEW:
+                        self._dropped(job)
+                        return
+                    try:
+                        self._dropped(self.queue.get_nowait())
+                        self.queue.task_done()
+                    except queue.Empty:
+                        pass
+        with self.lock:
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _dropped(self, job):
+        with self.lock:
+            self.dropped_count += 1
+        logger.error('notification queue is full, dropped %s notification' % (
+            job[2]
+        ))
+        if job[4] is not None:
+            job[4](False)
+
+    def _work(self):
+        while True:
+            template_lookup, send_func, typ, kwargs, on_done = (
+                self.queue.get()
+            )
+            start = time.time()
+            ok = False
+            try:
+                send_rendered(template_lookup, send_func, typ, kwargs)
+                ok = True
+            except Exception:
+                logger.exception('could not send %s notification' % typ)
+            elapsed = time.time() - start
+            with self.lock:
+                if ok:
+                    self.sent_count += 1
+                else:
+                    self.failed_count += 1
+                self.render_time_total += elapsed
+                self.render_time_max = max(self.render_time_max, elapsed)
+            if on_done is not None:
+                try:
+                    on_done(ok)
+                except Exception:
+                    logger.exception('on_done callback failed')
+            self.queue.task_done()
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued notifications are sent. Return ``False`` if
+        the timeout expired before.
+        """
+        if self.in_worker():
+            return False
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+
+def send_rendered(template_lookup, send_func, typ, kwargs):
+    """Render the ``typ`` templates and send them with ``send_func``."""
+    get_template = template_lookup.get_template
+    subject = get_template('%s_subject.txt' % typ).render(**kwargs)
+    subject = ''.join(subject.splitlines())
+    text = get_template('%s.txt' % typ).render(**kwargs)
+    html = get_template('%s.html' % typ).render(**kwargs)
+    send_func(subject, text, html_message=html)
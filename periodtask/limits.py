@@ -0,0 +1,217 @@
+import ctypes
+import json
+import logging
+import os
+import platform
+import resource
+import signal
+import sys
+import uuid
+
+
+logger = logging.getLogger('periodtask.limits')
+
+
+# ioprio_set(2) has no wrapper in libc or in the os module
+IOPRIO_SET = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'armv7l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+TRAMPOLINE = os.path.abspath(__file__)
+
+
+class Limits:
+    """
+    Resource limits of a task process.
+
+    The limits are applied by a small trampoline (this module run as a
+    script) that sets them on itself and then ``exec``-s the command. No
+    ``preexec_fn`` is involved, so this is safe to use from the threads the
+    scheduler starts the processes in.
+
+    :param int address_space: ``RLIMIT_AS`` in bytes.
+    :param int cpu_time: ``RLIMIT_CPU`` in seconds. The process receives
+      ``SIGXCPU`` when exceeding it.
+    :param int open_files: ``RLIMIT_NOFILE``.
+    :param int nice: Niceness increment of the process.
+    :param tuple ionice: I/O priority as ``(cls, level)`` where ``cls`` is
+      ``'realtime'``, ``'best-effort'`` or ``'idle'`` and ``level`` is
+      ``0``-``7``.
+    :param str cgroup: A writable cgroup v2 directory
+      (e.g. ``/sys/fs/cgroup/periodtask``). If given, every run is placed in
+      a new sub-group of this directory which is removed after the run.
+    :param str/int memory_max: Written to ``memory.max`` of the sub-group.
+    :param str cpu_max: Written to ``cpu.max`` of the sub-group
+      (e.g. ``'50000 100000'`` for half a CPU).
+    """
+    def __init__(
+        self, address_space=None, cpu_time=None, open_files=None,
+        nice=None, ionice=None,
+        cgroup=None, memory_max=None, cpu_max=None
+    ):
+        self.address_space = address_space
+        self.cpu_time = cpu_time
+        self.open_files = open_files
+        self.nice = nice
+        self.ionice = ionice
+        self.cgroup = cgroup
+        self.memory_max = memory_max
+        self.cpu_max = cpu_max
+        if ionice is not None and ionice[0] not in IOPRIO_CLASSES:
+            raise ValueError('unknown I/O priority class: %s' % ionice[0])
+
+    def _spec(self, cgroup_path):
+        return {
+            'rlimits': [
+                (name, value) for name, value in (
+                    ('RLIMIT_AS', self.address_space),
+                    ('RLIMIT_CPU', self.cpu_time),
+                    ('RLIMIT_NOFILE', self.open_files),
+                ) if value is not None
+            ],
+            'nice': self.nice,
+            'ionice': self.ionice,
+            'cgroup': cgroup_path,
+        }
+
+    def wrap(self, command, cgroup_path=None):
+        """Return the trampoline command line that runs ``command``."""
+        if isinstance(command, str):
+            command = [command]
+        # -S: the trampoline only needs the standard library
+        return [
+            sys.executable, '-S', TRAMPOLINE,
+            json.dumps(self._spec(cgroup_path)), '--'
+        ] + list(command)
+
+    def create_cgroup(self, task_name):
+        """Create the cgroup v2 sub-group of a run, return its path."""
+        if not self.cgroup:
+            return None
+        path = os.path.join(
+            self.cgroup, '%s-%s' % (task_name, uuid.uuid4().hex[:12])
+        )
+        os.mkdir(path)
+        if self.memory_max is not None:
+            _write(os.path.join(path, 'memory.max'), self.memory_max)
+        if self.cpu_max is not None:
+            _write(os.path.join(path, 'cpu.max'), self.cpu_max)
+        return path
+
+    def signal_cgroup(self, path, sig):
+        """Send ``sig`` to every process of the sub-group."""
+        if sig == signal.SIGKILL and os.path.exists(
+            os.path.join(path, 'cgroup.kill')
+        ):
+            try:
+                _write(os.path.join(path, 'cgroup.kill'), 1)
+                return
+            except OSError:
+                pass
+        try:
+            with open(os.path.join(path, 'cgroup.procs')) as f:
+                pids = [int(line) for line in f]
+        except (OSError, ValueError):
+            return
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def kill_cgroup(self, path):
+        """Kill the processes left in the sub-group after a run."""
+        self.signal_cgroup(path, signal.SIGKILL)
+
+    def remove_cgroup(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            logger.warning('could not remove cgroup %s: %s' % (path, e))
+
+    def breach(self, returncode, result, cgroup_path=None):
+        """
+        Return a description of the limit the process ran into, or ``None``.
+
+        Exceeding ``RLIMIT_AS`` or ``RLIMIT_NOFILE`` makes the allocation or
+        the ``open`` fail inside the process, so these can only be reported
+        by the process itself.
+        """
+        if returncode == -signal.SIGXCPU:
+            return 'CPU time limit (RLIMIT_CPU) exceeded'
+        if (
+            returncode == -signal.SIGKILL and
+            self.cpu_time is not None and
+            result is not None and result.cpu_time is not None and
+            result.cpu_time >= self.cpu_time
+        ):
+            return 'CPU time limit (RLIMIT_CPU) exceeded'
+        if cgroup_path and self.memory_max is not None:
+            events = _read_keyed(os.path.join(cgroup_path, 'memory.events'))
+            if events.get('oom_kill', 0) > 0:
+                return 'cgroup memory limit (memory.max) exceeded'
+        return None
+
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value))
+
+
+def _read_keyed(path):
+    try:
+        with open(path) as f:
+            return dict(
+                (k, int(v)) for k, v in (line.split() for line in f)
+            )
+    except (OSError, ValueError):
+        return {}
+
+
+def _ioprio_set(cls, level):
+    nr = IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        raise OSError('ioprio_set is not supported on %s' % (
+            platform.machine()
+        ))
+    libc = ctypes.CDLL(None, use_errno=True)
+    prio = (IOPRIO_CLASSES[cls] << IOPRIO_CLASS_SHIFT) | level
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, prio) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def apply(spec):
+    if spec.get('cgroup'):
+        _write(os.path.join(spec['cgroup'], 'cgroup.procs'), os.getpid())
+    for name, value in spec['rlimits']:
+        # SIGXCPU comes at the soft limit, SIGKILL at the hard one: leave a
+        # second between the two
+        hard = value + 1 if name == 'RLIMIT_CPU' else value
+        resource.setrlimit(getattr(resource, name), (value, hard))
+    if spec.get('nice'):
+        os.nice(spec['nice'])
+    if spec.get('ionice'):
+        _ioprio_set(*spec['ionice'])
+
+
+def main(argv):
+    spec, sep, command = json.loads(argv[0]), argv[1], argv[2:]
+    if sep != '--' or not command:
+        print('usage: limits.py SPEC -- COMMAND...', file=sys.stderr)
+        return 2
+    try:
+        apply(spec)
+    except OSError as e:
+        print('periodtask: could not apply limits: %s' % e, file=sys.stderr)
+        return 126
+    try:
+        os.execvp(command[0], command)
+    except OSError as e:
+        print('periodtask: %s: %s' % (command[0], e), file=sys.stderr)
+        return 127
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,17 +1,124 @@
 from email.message import EmailMessage
+from email import message_from_bytes, policy
+import heapq
+import os
+import random
 import ssl
 import smtplib
 import logging
-from threading import Thread
+import queue
+import time
+import uuid
+import weakref
+from threading import Thread, Lock
 
 
 logger = logging.getLogger('periodtask.mailsender')
 
 
+class Spool:
+    """
+    On-disk message queue of a :py:class:`MailSender`.
+
+    Messages are written to ``tmp/`` and renamed to ``new/``, so a message
+    is either complete in ``new/`` or not there at all. The due time and
+    the number of failed attempts are kept in the file name, rescheduling
+    is a rename. Messages failing ``max_attempts`` times are moved to
+    ``dead/``.
+    """
+    def __init__(self, directory, max_attempts):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        for sub in ('tmp', 'new', 'dead'):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    def _name(self, due, attempts):
+        return '%013d-%d-%s.eml' % (
+            int(due * 1000), attempts, uuid.uuid4().hex
+        )
+
+    def parse(self, path):
+        """Return ``(due, attempts)`` of a spooled message."""
+        due, attempts, _ = os.path.basename(path).split('-', 2)
+        return int(due) / 1000, int(attempts)
+
+    def put(self, message):
+        name = self._name(0, 0)
+        tmp = os.path.join(self.directory, 'tmp', name)
+        with open(tmp, 'wb') as f:
+            f.write(message.as_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        path = os.path.join(self.directory, 'new', name)
+        os.rename(tmp, path)
+        return path
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            return message_from_bytes(f.read(), policy=policy.default)
+
+    def remove(self, path):
+        os.unlink(path)
+
+    def reschedule(self, path, due):
+        """
+        Move a failed message to its next due time and return the new path,
+        or return ``None`` if it was moved to the dead letters.
+        """
+        attempts = self.parse(path)[1] + 1
+        if attempts >= self.max_attempts:
+            os.rename(path, os.path.join(
+                self.directory, 'dead', os.path.basename(path)
+            ))
+            return None
+        new_path = os.path.join(
+            self.directory, 'new', self._name(due, attempts)
+        )
+        os.rename(path, new_path)
+        return new_path
+
+    def pending(self):
+        new = os.path.join(self.directory, 'new')
+        return sorted(os.path.join(new, name) for name in os.listdir(new))
+
+
 class MailSender:
+    """
+    Sends e-mails over SMTP, use its ``send_mail`` method as the e-mail
+    sending function of a :py:class:`Task <periodtask.Task>`.
+
+    By default every message is sent from a new thread over a new
+    connection. If ``pool_size`` is given, messages are put in a bounded
+    queue instead, and ``pool_size`` worker threads send them over
+    persistent connections.
+
+    :param int pool_size: Number of worker threads (and SMTP connections).
+    :param int queue_size: Messages arriving when the queue is full are
+      dropped (and logged), so that a slow relay never blocks the scheduler.
+    :param number idle_timeout: Connections idle for this many seconds are
+      closed, they are reopened when a new message arrives.
+    :param int max_session_messages: Connections are reopened after sending
+      this many messages.
+    :param str spool_dir: If given, messages are written to this directory
+      before sending (by a background thread, not by the caller of
+      ``send_mail``) and removed when sent, so they survive relay outages
+      and restarts. Failed messages are retried with exponential backoff
+      and jitter, after ``max_attempts`` they are moved to the ``dead``
+      subdirectory. Messages left in the spool are sent at startup. Implies
+      ``pool_size=1`` if not given.
+    :param int max_attempts: See **spool_dir**.
+    :param number retry_base: The first retry is after about this many
+      seconds, the delay is doubled for every further attempt.
+    :param number retry_cap: The maximum delay between retries.
+    """
+    instances = weakref.WeakSet()
+
     def __init__(
         self, host, port, from_email, recipient_list,
         timeout=10, use_ssl=False, use_tls=False, username=None, password=None,
+        pool_size=None, queue_size=100, idle_timeout=30,
+        max_session_messages=100,
+        spool_dir=None, max_attempts=8, retry_base=30, retry_cap=3600,
     ):
         self.host, self.port = host, port
         self.from_email, self.recipient_list = from_email, recipient_list
@@ -22,41 +129,263 @@ class MailSender:
         if isinstance(recipient_list, str):
             self.recipient_list = [recipient_list]
 
+        if spool_dir and not pool_size:
+            pool_size = 1
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_session_messages = max_session_messages
+        self.queue = queue.Queue(maxsize=queue_size) if pool_size else None
+        self.workers = []
+
+        self.spool = None
+        if spool_dir:
+            self.spool = Spool(spool_dir, max_attempts)
+            self.retry_base, self.retry_cap = retry_base, retry_cap
+            # messages to write to the spool and paths to reschedule, so
+            # that send_mail never touches the disk
+            self.incoming = queue.Queue(maxsize=queue_size)
+
+        self.lock = Lock()
+        self.sent_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        MailSender.instances.add(self)
+        if self.spool is not None and self.spool.pending():
+            self._start_workers()
+
+    @property
+    def queue_depth(self):
+        if self.queue is None:
+            return 0
+        if self.spool is not None:
+            return self.queue.qsize() + self.incoming.qsize()
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.lock:
+            done = self.sent_count + self.failed_count
+            return {
+                'queue_depth': self.queue_depth,
+                'sent': self.sent_count,
+                'failed': self.failed_count,
+                'dropped': self.dropped_count,
+                'mean_latency': self.latency_total / done if done else None,
+                'max_latency': self.latency_max,
+            }
+
+    def _record(self, ok, latency):
+        with self.lock:
+            if ok:
+                self.sent_count += 1
+            else:
+                self.failed_count += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def _connect(self):
+        conn = self.connection_class(
+            self.host, self.port, timeout=self.timeout
+        )
+        if self.use_tls:
+            conn.starttls()
+        logger.debug('starttls ok')
+        if self.username and self.password:
+            conn.login(self.username, self.password)
+        logger.debug('login ok')
+        return conn
+
+    def _quit(self, conn):
+        try:
+            conn.quit()
+        except (ssl.SSLError, smtplib.SMTPServerDisconnected):
+            # This happens when calling quit() on a TLS connection
+            # sometimes, or when the connection was already disconnected
+            # by the server.
+            conn.close()
+        except smtplib.SMTPException:
+            logger.exception('error during quit')
+
+    def _log_result(self, refused, msg):
+        if refused:
+            logger.warning('refused: %s' % msg)
+        else:
+            logger.info('e-mail sent: %s' % msg)
+
     def _send(self, message):
         logger.debug('message sender starts')
         msg = '(%s) to %s' % (message['Subject'], message['To'])
+        start = time.time()
+        ok = False
         try:
-            conn = self.connection_class(
-                self.host, self.port, timeout=self.timeout
-            )
-            if self.use_tls:
-                conn.starttls()
-            logger.debug('starttls ok')
-            if self.username and self.password:
-                conn.login(self.username, self.password)
-            logger.debug('login ok')
-
+            conn = self._connect()
             try:
                 refused = conn.send_message(message)
             except Exception:
                 logger.exception('sending error')
             else:
-                if refused:
-                    logger.warning('refused: %s' % msg)
+                ok = True
+                self._log_result(refused, msg)
+            self._quit(conn)
+        except Exception:
+            logger.exception('Error sending e-mail: %s' % msg)
+        self._record(ok, time.time() - start)
+
+    def _deliver(self, session, message):
+        msg = '(%s) to %s' % (message['Subject'], message['To'])
+        start = time.time()
+        ok = False
+        # a persistent connection may have been closed by the server,
+        # so we retry once on a new one
+        for attempt in (1, 2):
+            try:
+                if session['conn'] is None:
+                    session['conn'], session['count'] = self._connect(), 0
+                refused = session['conn'].send_message(message)
+            except (
+                smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused
+            ) as e:
+                # the server answered, the connection is fine
+                logger.error('Error sending e-mail: %s (%s)' % (msg, e))
+                break
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                if session['conn'] is not None:
+                    session['conn'].close()
+                session['conn'] = None
+                if attempt == 2:
+                    logger.error('Error sending e-mail: %s (%s)' % (msg, e))
+            except Exception:
+                logger.exception('Error sending e-mail: %s' % msg)
+                break
+            else:
+                ok = True
+                session['count'] += 1
+                self._log_result(refused, msg)
+                break
+        self._record(ok, time.time() - start)
+
+        if session['conn'] is not None and (
+            session['count'] >= self.max_session_messages
+        ):
+            self._quit(session['conn'])
+            session['conn'] = None
+        return ok
+
+    def _retry_delay(self, attempts):
+        delay = min(self.retry_cap, self.retry_base * 2 ** attempts)
+        return random.uniform(delay / 2, delay)
+
+    def _deliver_spooled(self, session, path):
+        try:
+            message = self.spool.load(path)
+        except FileNotFoundError:
+            return
+        if self._deliver(session, message):
+            self.spool.remove(path)
+            return
+        attempts = self.spool.parse(path)[1]
+        due = time.time() + self._retry_delay(attempts)
+        new_path = self.spool.reschedule(path, due)
+        if new_path is None:
+            logger.error('e-mail moved to dead letters after %s attempts: '
+                         '(%s)' % (attempts + 1, message['Subject']))
+        else:
+            self.incoming.put(('retry', (due, new_path)))
+
+    def _work(self):
+        session = {'conn': None, 'count': 0}
+        while True:
+            try:
+                item = self.queue.get(
+                    timeout=self.idle_timeout if session['conn'] else None
+                )
+            except queue.Empty:
+                logger.debug('closing idle connection')
+                self._quit(session['conn'])
+                session['conn'] = None
+                continue
+            try:
+                if isinstance(item, str):
+                    self._deliver_spooled(session, item)
                 else:
-                    logger.info('e-mail sent: %s' % msg)
+                    self._deliver(session, item)
+            except Exception:
+                logger.exception('mail worker error')
+            self.queue.task_done()
 
+    def _spool_work(self):
+        due_heap = [
+            (self.spool.parse(path)[0], path) for path in self.spool.pending()
+        ]
+        if due_heap:
+            logger.info('%s e-mail(s) found in the spool' % len(due_heap))
+        heapq.heapify(due_heap)
+        while True:
+            timeout = None
+            if due_heap:
+                timeout = max(0, due_heap[0][0] - time.time())
             try:
-                conn.quit()
-            except (ssl.SSLError, smtplib.SMTPServerDisconnected):
-                # This happens when calling quit() on a TLS connection
-                # sometimes, or when the connection was already disconnected
-                # by the server.
-                conn.close()
-            except smtplib.SMTPException:
-                logger.exception('error during quit')
-        except Exception:
-            logger.exception('Error sending e-mail: %s' % msg)
+                item = self.incoming.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            try:
+                if item is not None:
+                    kind, payload = item
+                    if kind == 'new':
+                        heapq.heappush(due_heap, (0, self.spool.put(payload)))
+                    else:
+                        heapq.heappush(due_heap, payload)
+                now = time.time()
+                while due_heap and due_heap[0][0] <= now:
+                    due, path = heapq.heappop(due_heap)
+                    try:
+                        self.queue.put_nowait(path)
+                    except queue.Full:
+                        heapq.heappush(due_heap, (now + 1, path))
+                        break
+            except Exception:
+                logger.exception('mail spool error')
+            if item is not None:
+                self.incoming.task_done()
+
+    def _start_workers(self):
+        with self.lock:
+            if self.spool is not None and not self.workers:
+                Thread(
+                    target=self._spool_work, daemon=True,
+                    name='mailsender-spool'
+                ).start()
+            while len(self.workers) < self.pool_size:
+                worker = Thread(
+                    target=self._work, daemon=True,
+                    name='mailsender-%s' % len(self.workers)
+                )
+                worker.start()
+                self.workers.append(worker)
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued messages are sent. Return ``False`` if the
+        timeout expired before.
+        """
+        if self.queue is None:
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        queues = [self.queue]
+        if self.spool is not None:
+            # retries waiting in the spool are not waited for
+            queues.insert(0, self.incoming)
+        for q in queues:
+            with q.all_tasks_done:
+                while q.unfinished_tasks:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                    q.all_tasks_done.wait(remaining)
+        return True
 
     def send_mail(
             self, subject, message, html_message=None
@@ -68,4 +397,27 @@ class MailSender:
         msg.set_content(message)
         if html_message:
             msg.add_alternative(html_message, subtype='html')
-        Thread(target=self._send, args=(msg,)).start()
+        if self.queue is None:
+            Thread(target=self._send, args=(msg,)).start()
+            return
+        self._start_workers()
+        try:
+            if self.spool is not None:
+                self.incoming.put_nowait(('new', msg))
+            else:
+                self.queue.put_nowait(msg)
+        except queue.Full:
+            with self.lock:
+                self.dropped_count += 1
+            logger.error('mail queue is full, dropped: (%s) to %s' % (
+                subject, msg['To']
+            ))
+
+
+def flush_all(deadline):
+    """Flush the queues of all pooled senders until ``deadline``."""
+    for sender in list(MailSender.instances):
+        if not sender.flush(timeout=max(0, deadline - time.time())):
+            logger.warning('could not flush mail queue of %s:%s' % (
+                sender.host, sender.port
+            ))
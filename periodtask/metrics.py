@@ -0,0 +1,421 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger('periodtask.metrics')
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+    900, 3600,
+)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for n, v in zip(names, values)
+    )
+
+
+def _number(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _CounterChild:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        Return the child of the given label values. Children are cached,
+        keep a reference to them on hot paths.
+        """
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.TYPE),
+        ]
+        for name, labelnames, values, value in self.samples():
+            lines.append('%s%s %s' % (
+                name, _labels(labelnames, values), _number(value)
+            ))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, self.labelnames, values, child.value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, self.labelnames, values, child.value
+
+
+class CallbackGauge(Metric):
+    """
+    A gauge computed when the metrics are collected. ``func`` returns a
+    number, or a list of ``(label values, number)`` tuples if there are
+    labels.
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, func, labelnames=()):
+        self.func = func
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return None
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            logger.exception('could not collect %s' % self.name)
+            return
+        if not self.labelnames:
+            if value is not None:
+                yield self.name, (), (), value
+            return
+        for values, v in value:
+            if v is not None:
+                yield self.name, self.labelnames, values, v
+
+
+class CallbackCounter(CallbackGauge):
+    """
+    A counter computed when the metrics are collected, for totals kept
+    elsewhere. ``func`` is the same as for :py:class:`CallbackGauge`.
+    """
+    TYPE = 'counter'
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        bucket_labels = self.labelnames + ('le',)
+        for values, child in list(self.children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for le, c in zip(self.buckets + (float('inf'),), counts):
+                cumulative += c
+                yield (
+                    self.name + '_bucket', bucket_labels,
+                    values + (_number(le),), cumulative
+                )
+            yield self.name + '_sum', self.labelnames, values, total
+            yield self.name + '_count', self.labelnames, values, count
+
+
+class Registry:
+    """
+    A set of metrics that can be exposed in the Prometheus text format, see
+    :py:class:`MetricsServer` and :py:class:`TextfileWriter`.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def callback_gauge(self, name, help, func, labelnames=()):
+        return self.register(CallbackGauge(name, help, func, labelnames))
+
+    def callback_counter(self, name, help, func, labelnames=()):
+        return self.register(CallbackCounter(name, help, func, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def expose(self):
+        return '\n'.join(m.expose() for m in self.metrics) + '\n'
+
+    def write_textfile(self, path):
+        """Write the metrics to ``path`` atomically (textfile collector)."""
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.expose())
+        os.rename(tmp, path)
+
+
+class MetricsServer:
+    """
+    Serves the metrics of ``registry`` over HTTP (any path) from a daemon
+    thread.
+    """
+    def __init__(self, registry, port, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.expose().encode()
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8'
+                )
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True, name='metrics'
+        )
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TextfileWriter:
+    """Writes the metrics of ``registry`` to ``path`` every ``interval``."""
+    def __init__(self, registry, path, interval=15):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.thread = threading.Thread(
+            target=self._work, daemon=True, name='metrics-textfile'
+        )
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            try:
+                self.registry.write_textfile(self.path)
+            except OSError:
+                logger.exception('could not write %s' % self.path)
+            time.sleep(self.interval)
+
+
+class SchedulerMetrics:
+    """
+    The metrics of a :py:class:`TaskList <periodtask.TaskList>`, registered
+    in ``registry``.
+    """
+    def __init__(self, registry, tasklist):
+        from . import mailsender
+
+        self.tick_duration = registry.histogram(
+            'periodtask_tick_duration_seconds', 'Duration of scheduler ticks',
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+        )
+        self.scheduling_lag = registry.histogram(
+            'periodtask_scheduling_lag_seconds',
+            'Delay between the scheduled second and the process start',
+            ('task',)
+        )
+        self.run_duration = registry.histogram(
+            'periodtask_run_duration_seconds', 'Wall-clock duration of runs',
+            ('task',)
+        )
+        self.outcomes = registry.counter(
+            'periodtask_outcomes_total',
+            'Runs and schedules by outcome (success, failure, timeout, '
+            'skipped, delayed)',
+            ('task', 'outcome')
+        )
+        self.output_lines = registry.counter(
+            'periodtask_output_lines_total',
+            'Lines read from the STDOUT and STDERR of processes', ('task',)
+        )
+        self.output_chars = registry.counter(
+            'periodtask_output_characters_total',
+            'Characters read from the STDOUT and STDERR of processes',
+            ('task',)
+        )
+        self.cpu_time = registry.counter(
+            'periodtask_cpu_seconds_total',
+            'User and system CPU time of finished runs', ('task',)
+        )
+        self.queue_wait = registry.histogram(
+            'periodtask_queue_wait_seconds',
+            'Delay between the scheduled second and the process start, by '
+            'task priority', ('priority',)
+        )
+        tasks = tasklist.tasks
+        registry.callback_gauge(
+            'periodtask_running_processes', 'Number of running processes',
+            lambda: sum(len(t.process_threads) for t in tasks)
+        )
+        registry.callback_gauge(
+            'periodtask_delay_queue_length', 'Length of the delay queues',
+            lambda: [((t.name,), len(t.delay_queue)) for t in tasks],
+            ('task',)
+        )
+
+        def waiting():
+            counts = {}
+            for t in tasks:
+                key = (str(t.priority),)
+                counts[key] = counts.get(key, 0) + t.waiting_runs()
+            return list(counts.items())
+        registry.callback_gauge(
+            'periodtask_waiting_runs', 'Runs waiting to start, by priority',
+            waiting, ('priority',)
+        )
+        registry.callback_gauge(
+            'periodtask_threads', 'Number of threads', threading.active_count
+        )
+
+        def senders():
+            return [
+                (('%s:%s' % (s.host, s.port),), s.stats())
+                for s in list(mailsender.MailSender.instances)
+            ]
+        registry.callback_gauge(
+            'periodtask_mail_queue_depth', 'Messages waiting to be sent',
+            lambda: [(k, v['queue_depth']) for k, v in senders()],
+            ('server',)
+        )
+        registry.callback_gauge(
+            'periodtask_mail_send_latency_mean_seconds',
+            'Mean time of sending a message',
+            lambda: [(k, v['mean_latency']) for k, v in senders()],
+            ('server',)
+        )
+        registry.callback_gauge(
+            'periodtask_mail_send_latency_max_seconds',
+            'Maximum time of sending a message',
+            lambda: [(k, v['max_latency']) for k, v in senders()],
+            ('server',)
+        )
+        registry.callback_counter(
+            'periodtask_mail_sent_total', 'Messages sent',
+            lambda: [(k, v['sent']) for k, v in senders()],
+            ('server',)
+        )
+        registry.callback_counter(
+            'periodtask_mail_failed_total', 'Messages that could not be sent',
+            lambda: [(k, v['failed']) for k, v in senders()],
+            ('server',)
+        )
+        if tasklist.dispatcher is not None:
+            dispatcher = tasklist.dispatcher
+            registry.callback_gauge(
+                'periodtask_notification_queue_depth',
+                'Notifications waiting to be rendered and sent',
+                lambda: dispatcher.queue_depth
+            )
+
+    def run_finished(self, task_name, thrd):
+        """Record a finished :py:class:`ProcessThread`."""
+        self.output_lines.labels(task_name).inc(thrd.line_count)
+        self.output_chars.labels(task_name).inc(thrd.char_count)
+        if thrd.result is not None:
+            self.run_duration.labels(task_name).observe(thrd.result.duration)
+            if thrd.result.cpu_time is not None:
+                self.cpu_time.labels(task_name).inc(thrd.result.cpu_time)
@@ -0,0 +1,299 @@
+import http.client
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger('periodtask.notifiers')
+
+(DROP_NEW, BLOCK) = ('drop_new', 'block')
+
+
+class _SysLogHandler(logging.handlers.SysLogHandler):
+    def handleError(self, record):
+        # raised to the worker, which counts the events as failed
+        raise
+
+
+class OutcomeEvent:
+    """
+    A structured notification about a task: a run completed (``success``,
+    ``failure``, ``timeout``) or a scheduled run was ``skipped`` or
+    ``delayed``.
+    """
+    FIELDS = (
+        'kind', 'task', 'scheduled', 'scheduled_sec', 'time', 'returncode',
+        'duration', 'start_delay', 'cpu_time', 'maxrss', 'limit_breach',
+        'stdout', 'stderr',
+    )
+
+    def __init__(self, kind, task, scheduled, subproc=None):
+        self.kind = kind
+        self.task = task
+        self.scheduled = scheduled
+        self.time = time.time()
+        self.scheduled_sec = None
+        self.returncode = self.limit_breach = None
+        self.duration = self.start_delay = None
+        self.cpu_time = self.maxrss = None
+        self.stdout = self.stderr = None
+        if subproc is not None:
+            self.scheduled_sec = subproc.sec
+            self.returncode = subproc.returncode
+            self.limit_breach = subproc.limit_breach
+            self.stdout = subproc.stdout_lines
+            self.stderr = subproc.stderr_lines
+            result = subproc.result
+            if result is not None:
+                self.duration = result.duration
+                self.start_delay = result.start_delay
+                self.cpu_time = result.cpu_time
+                self.maxrss = result.maxrss
+
+    def as_dict(self):
+        return dict((f, getattr(self, f)) for f in self.FIELDS)
+
+
+class Notifier:
+    """
+    Base class of the notifier backends. Events are put in a bounded queue
+    and sent in batches from ``concurrency`` worker threads, subclasses
+    implement :py:meth:`send_batch`.
+
+    :param int queue_size: The size of the queue.
+    :param str overflow: ``'drop_new'`` drops events arriving to a full
+      queue, ``'block'`` makes the scheduler wait for room.
+    :param int batch_size: At most this many events are sent together.
+    :param number batch_interval: A batch is sent when it is full or when
+      its first event has waited this many seconds.
+    :param int concurrency: The number of worker threads, that is the
+      number of batches sent at the same time.
+    """
+    def __init__(
+        self, queue_size=1000, overflow=DROP_NEW,
+        batch_size=1, batch_interval=1.0, concurrency=1
+    ):
+        if overflow not in (DROP_NEW, BLOCK):
+            raise ValueError('invalid overflow: %s' % overflow)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.concurrency = concurrency
+        self.workers = []
+        self.lock = threading.Lock()
+        self.sent_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'sent': self.sent_count,
+                'failed': self.failed_count,
+                'dropped': self.dropped_count,
+            }
+
+    def emit(self, event):
+        """Queue ``event``, return ``False`` if it was dropped."""
+        if not self.workers:
+            self._start_workers()
+        if self.overflow == BLOCK:
+            self.queue.put(event)
+            return True
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            with self.lock:
+                self.dropped_count += 1
+            logger.error('%s queue is full, event dropped' % (
+                self.__class__.__name__
+            ))
+            return False
+        return True
+
+    def _start_workers(self):
+        with self.lock:
+            while len(self.workers) < self.concurrency:
+                worker = threading.Thread(
+                    target=self._work, daemon=True,
+                    name='%s-%s' % (self.__class__.__name__, len(self.workers))
+                )
+                worker.start()
+                self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.send_batch(batch)
+            except Exception:
+                logger.exception('%s could not send %s event(s)' % (
+                    self.__class__.__name__, len(batch)
+                ))
+                with self.lock:
+                    self.failed_count += len(batch)
+            else:
+                with self.lock:
+                    self.sent_count += len(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def send_batch(self, events):
+        raise NotImplementedError
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued events are sent. Return ``False`` if the
+        timeout expired before.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+
+class WebhookNotifier(Notifier):
+    """
+    POSTs events as JSON (``{"events": [...]}``) to ``url``. Every worker
+    keeps its HTTP connection alive between batches.
+
+    :param str url: An ``http://`` or ``https://`` URL.
+    :param dict headers: Extra request headers.
+    :param number timeout: Socket timeout in seconds.
+    """
+    def __init__(self, url, headers=None, timeout=10, **kwargs):
+        super().__init__(**kwargs)
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('unsupported URL: %s' % url)
+        self.url = url
+        self.https = parts.scheme == 'https'
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.headers = dict(headers or {})
+        self.headers['Content-Type'] = 'application/json'
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            cls = (
+                http.client.HTTPSConnection if self.https
+                else http.client.HTTPConnection
+            )
+            conn = self.local.conn = cls(self.netloc, timeout=self.timeout)
+        return conn
+
+    def send_batch(self, events):
+        body = json.dumps({'events': [e.as_dict() for e in events]})
+        for attempt in (1, 2):
+            conn = self._connection()
+            response = None
+            try:
+                conn.request(
+                    'POST', self.path, body=body, headers=self.headers
+                )
+                response = conn.getresponse()
+                response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                self.local.conn = None
+                # a kept-alive connection closed by the server before it
+                # answered, we retry once on a new one; other errors (e.g.
+                # a read timeout) may come after the events were taken
+                reset = isinstance(e, (ConnectionResetError, BrokenPipeError))
+                if attempt == 2 or response is not None or not reset:
+                    raise
+                continue
+            if response.status >= 400:
+                raise http.client.HTTPException(
+                    '%s returned %s' % (self.url, response.status)
+                )
+            return
+
+
+class JSONLinesNotifier(Notifier):
+    """
+    Appends events to ``path``, one JSON object per line. Uses a single
+    worker thread.
+    """
+    def __init__(self, path, **kwargs):
+        kwargs['concurrency'] = 1
+        super().__init__(**kwargs)
+        self.path = path
+
+    def send_batch(self, events):
+        with open(self.path, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event.as_dict()) + '\n')
+
+
+class SyslogNotifier(Notifier):
+    """
+    Sends events to syslog as JSON messages. ``failure`` and ``timeout``
+    events are logged as errors, ``skipped`` and ``delayed`` ones as
+    warnings, the rest as info.
+
+    :param address: See `SysLogHandler
+      <https://docs.python.org/3/library/logging.handlers.html>`_.
+    :param int facility: See `SysLogHandler
+      <https://docs.python.org/3/library/logging.handlers.html>`_.
+    """
+    LEVELS = {
+        'failure': logging.ERROR, 'timeout': logging.ERROR,
+        'skipped': logging.WARNING, 'delayed': logging.WARNING,
+    }
+
+    def __init__(
+        self, address='/dev/log',
+        facility=logging.handlers.SysLogHandler.LOG_USER, **kwargs
+    ):
+        kwargs['concurrency'] = 1
+        super().__init__(**kwargs)
+        self.address = address
+        self.facility = facility
+        self.handler = None
+
+    def send_batch(self, events):
+        if self.handler is None:
+            self.handler = _SysLogHandler(
+                address=self.address, facility=self.facility
+            )
+            self.handler.setFormatter(
+                logging.Formatter('periodtask: %(message)s')
+            )
+        for event in events:
+            level = self.LEVELS.get(event.kind, logging.INFO)
+            record = logging.LogRecord(
+                'periodtask.notifiers', level, __file__, 0,
+                json.dumps(event.as_dict()), None, None
+            )
+            self.handler.emit(record)
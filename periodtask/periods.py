@@ -1,3 +1,4 @@
+import bisect
 import logging
 from datetime import datetime, timedelta
 
@@ -5,6 +6,7 @@ import pytz
 
 
 logger = logging.getLogger('periodtask.periods')
+ONE_DAY = timedelta(days=1)
 
 
 class BadCronFormat(Exception):
@@ -21,21 +23,56 @@ class Period:
         'L', 'LL', 'LLL', 'LLLL', 'LLLLL',
     )
     DELTA = timedelta(days=7)
+    DEFAULT_PARTS = ('0', '*/5', '*', '*', '*', '*', 'UTC')
+    __slots__ = (
+        'cron', 'seconds', 'minutes', 'hours', 'days', 'months', 'years',
+        'timezone', 'hour_values', 'minute_values', 'second_values',
+        'include_days', 'exclude_days',
+    )
+    # shared instances by normalized expression, see parse()
+    _interned = {}
+
+    @classmethod
+    def normalize(cls, cron):
+        """Return ``cron`` with single spaces and the defaults filled in."""
+        parts = cron.split()
+        if len(parts) > len(cls.DEFAULT_PARTS):
+            raise BadCronFormat('too many parts of format string')
+        return ' '.join(parts + list(cls.DEFAULT_PARTS[len(parts):]))
+
+    @classmethod
+    def parse(cls, cron, include_days=None, exclude_days=None):
+        """
+        Return a :py:class:`Period` of ``cron``. Periods do not change after
+        parsing, so the users of equivalent expressions (and the same
+        calendars) share one.
+        """
+        key = (cls.normalize(cron), include_days, exclude_days)
+        period = cls._interned.get(key)
+        if period is None:
+            period = cls._interned.setdefault(
+                key, cls(cron, include_days, exclude_days)
+            )
+        return period
 
-    def __init__(self, cron='0 */5 * * * * UTC'):
+    def __init__(
+        self, cron='0 */5 * * * * UTC', include_days=None, exclude_days=None
+    ):
+        self.cron = cron
+        # periodtask.calendars.Calendar instances filtering the days
+        self.include_days = include_days
+        self.exclude_days = exclude_days
         (
             self.seconds, self.minutes, self.hours, self.days,
             self.months, self.years, self.timezone
         ) = self._parse_cron(cron)
+        # the matching hours, minutes and seconds, for next_fire
+        self.hour_values = self._values(self.hours, 23)
+        self.minute_values = self._values(self.minutes, 59)
+        self.second_values = self._values(self.seconds, 59)
 
     def _parse_cron(self, cron):
-        parts = ['0', '*/5', '*', '*', '*', '*', 'UTC']
-        try:
-            for i, p in enumerate([p for p in cron.split()]):
-                parts[i] = p
-        except IndexError:
-            raise BadCronFormat('too many parts of format string') from None
-
+        parts = self.normalize(cron).split()
         seconds = self._parse_part(parts[0], 0, 60)
         minutes = self._parse_part(parts[1], 0, 59)
         hours = self._parse_part(parts[2], 0, 59)
@@ -56,7 +93,9 @@ class Period:
     def _parse_part(self, part, low, high, dom_allowed=False):
         part = part.strip()
         splitted = part.split(',')
-        return [self._parse_split(x, low, high, dom_allowed) for x in splitted]
+        return tuple(
+            self._parse_split(x, low, high, dom_allowed) for x in splitted
+        )
 
     def _parse_split(self, split, low, high, dom_allowed):
         try:
@@ -155,43 +194,47 @@ class Period:
                 return True
         return False
 
-    def _check(self, sec):
-        utc = datetime.utcfromtimestamp(sec).replace(tzinfo=pytz.utc)
-        dt = self.timezone.normalize(utc).astimezone(self.timezone)
-        isocalendar = dt.isocalendar()
+    def _values(self, part, high):
+        return tuple(v for v in range(high + 1) if self._check_part(part, v))
 
-        year = dt.year
-        weekday = isocalendar[2]
-        month = dt.month
-        day = dt.day
-        hour = dt.hour
-        minute = dt.minute
-        second = dt.second
+    def _localize(self, dt, hour, sec):
+        """
+        The start of ``hour`` on the day of ``dt`` (local time, ``sec``
+        converted), or the next hour after ``sec`` if it does not exist (DST
+        change).
+        """
+        naive = datetime(dt.year, dt.month, dt.day, hour)
+        try:
+            start = self.timezone.localize(naive, is_dst=None)
+        except pytz.AmbiguousTimeError:
+            # the first one
+            start = self.timezone.localize(naive, is_dst=True)
+        except pytz.NonExistentTimeError:
+            return sec + 3600 - dt.minute * 60 - dt.second
+        return max(int(start.timestamp()), sec + 1)
 
-        if not self._check_part(self.seconds, second):
-            return False
-        if not self._check_part(self.minutes, minute):
-            return False
-        if not self._check_part(self.hours, hour):
-            return False
-        if not self._check_part(self.months, month):
-            return False
-        if not self._check_part(self.years, year):
-            return False
+    def _next_value(self, values, actual):
+        """The first of the sorted ``values`` not lower than ``actual``."""
+        i = bisect.bisect_left(values, actual)
+        return values[i] if i < len(values) else None
+
+    def _local(self, sec):
+        utc = datetime.utcfromtimestamp(sec).replace(tzinfo=pytz.utc)
+        return self.timezone.normalize(utc).astimezone(self.timezone)
 
-        ok = False
+    def _check_day(self, dt):
+        day, month = dt.day, dt.month
+        weekday = dt.isoweekday()
         for lo, hi, step, dow in self.days:
             if not dow:
                 if day in range(lo, hi, step):
-                    ok = True
-                    break
+                    return True
             else:
                 if weekday not in range(lo, hi):
                     continue
                 if isinstance(step, int):
                     if weekday in range(lo, hi, step):
-                        ok = True
-                        break
+                        return True
                 else:
                     delta = self.DELTA
                     var_dt = dt
@@ -206,12 +249,113 @@ class Period:
                     if ok2:
                         var_dt += delta
                         if var_dt.month != month:
-                            ok = True
-                            break
-        if not ok:
+                            return True
+        return False
+
+    def _check_calendars(self, dt):
+        if self.include_days is not None and dt not in self.include_days:
+            return False
+        if self.exclude_days is not None and dt in self.exclude_days:
+            return False
+        return True
+
+    def _next_day(self, dt, sec, end):
+        """The start of the day after ``dt`` that may match."""
+        if self.include_days is None or dt in self.include_days:
+            return self._localize(dt + ONE_DAY, 0, sec)
+        # jump to the next included day
+        day = self.include_days.next_day(
+            dt + ONE_DAY, self._local(end).date()
+        )
+        if day is None:
+            return end + 1
+        naive = datetime(day.year, day.month, day.day)
+        for hour in range(3):
+            try:
+                start = self.timezone.localize(
+                    naive + timedelta(hours=hour), is_dst=None
+                )
+            except pytz.AmbiguousTimeError:
+                start = self.timezone.localize(
+                    naive + timedelta(hours=hour), is_dst=True
+                )
+            except pytz.NonExistentTimeError:
+                # midnight does not exist (DST change)
+                continue
+            return max(int(start.timestamp()), sec + 1)
+        return self._localize(dt + ONE_DAY, 0, sec)
+
+    def _check(self, sec):
+        dt = self._local(sec)
+        weekday = dt.isoweekday()
+
+        year = dt.year
+        month = dt.month
+        day = dt.day
+        hour = dt.hour
+        minute = dt.minute
+        second = dt.second
+
+        if not self._check_part(self.seconds, second):
+            return False
+        if not self._check_part(self.minutes, minute):
+            return False
+        if not self._check_part(self.hours, hour):
+            return False
+        if not self._check_part(self.months, month):
+            return False
+        if not self._check_part(self.years, year):
+            return False
+        if not self._check_day(dt):
+            return False
+        if not self._check_calendars(dt):
             return False
 
         return self.SEC_FMT.format(
                 year, month, day, hour, minute, second, self.timezone,
                 [x for x in self.DOW if self.DOW[x] == weekday][0]
             )
+
+    def next_fire(self, sec, horizon=366 * 86400):
+        """
+        Return the first second not before ``sec`` matching the expression,
+        or ``None`` if there is none in ``horizon`` seconds. Non-matching
+        days and hours are skipped as a whole (up to the next day of
+        ``include_days``), minutes and seconds are looked up without
+        converting each second to local time.
+        """
+        end = sec + horizon
+        while sec <= end:
+            dt = self._local(sec)
+            if not (
+                self._check_part(self.years, dt.year) and
+                self._check_part(self.months, dt.month) and
+                self._check_day(dt) and
+                self._check_calendars(dt)
+            ):
+                sec = self._next_day(dt, sec, end)
+            elif not self._check_part(self.hours, dt.hour):
+                hour = self._next_value(self.hour_values, dt.hour)
+                if hour is None:
+                    sec = self._localize(dt + ONE_DAY, 0, sec)
+                else:
+                    sec = self._localize(dt, hour, sec)
+            else:
+                minute = self._next_value(self.minute_values, dt.minute)
+                if minute == dt.minute:
+                    second = self._next_value(self.second_values, dt.second)
+                    if second is not None:
+                        sec += second - dt.second
+                        return sec if sec <= end else None
+                    minute = self._next_value(
+                        self.minute_values, dt.minute + 1
+                    )
+                if minute is None or not self.second_values:
+                    sec += 3600 - dt.minute * 60 - dt.second
+                else:
+                    # local time is continuous within an hour
+                    sec += (minute - dt.minute) * 60 + (
+                        self.second_values[0] - dt.second
+                    )
+                    return sec if sec <= end else None
+        return None
@@ -1,10 +1,19 @@
+import io
 import threading
-from subprocess import Popen, PIPE, TimeoutExpired
+from subprocess import Popen, PIPE
 import select
 import logging
+import time
+import os
+import signal
+
+from .stats import RunResult
 
 
 logger = logging.getLogger('periodtask.process_thread')
+(POPEN, POSIX_SPAWN) = ('popen', 'posix_spawn')
+# seconds to wait for the threads of killed processes after the deadline
+KILL_GRACE = 2
 
 
 def _parse(head_tail):
@@ -33,12 +42,81 @@ def parse_max_lines(max_lines):
     return oh, ot, om, eh, et, em
 
 
+def exit_code(status):
+    """Convert a wait status to a ``Popen.returncode``-like value."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class SpawnedProcess:
+    """
+    A process started with ``os.posix_spawnp`` in a new session, with the
+    ``Popen`` attributes :py:class:`ProcessThread` uses.
+    """
+    def __init__(self, command, env=None):
+        fds = []
+        try:
+            in_r, in_w = os.pipe()
+            fds += [in_r, in_w]
+            out_r, out_w = os.pipe()
+            fds += [out_r, out_w]
+            err_r, err_w = os.pipe()
+            fds += [err_r, err_w]
+            # the pipes are not inheritable, only the dup2()-ed copies are
+            # passed to the child
+            self.pid = os.posix_spawnp(
+                command[0], list(command),
+                os.environ if env is None else env,
+                file_actions=[
+                    (os.POSIX_SPAWN_DUP2, in_r, 0),
+                    (os.POSIX_SPAWN_DUP2, out_w, 1),
+                    (os.POSIX_SPAWN_DUP2, err_w, 2),
+                ],
+                setsid=True,
+            )
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+        for fd in (in_r, out_w, err_w):
+            os.close(fd)
+        self.args = command
+        self.returncode = None
+        self.stdin = io.TextIOWrapper(
+            io.open(in_w, 'wb'), line_buffering=True
+        )
+        self.stdout = io.TextIOWrapper(io.open(out_r, 'rb'))
+        self.stderr = io.TextIOWrapper(io.open(err_r, 'rb'))
+
+    def wait(self):
+        if self.returncode is None:
+            try:
+                _, status = os.waitpid(self.pid, 0)
+                self.returncode = exit_code(status)
+            except ChildProcessError:
+                # reaped elsewhere, Popen reports 0 as well
+                self.returncode = 0
+        return self.returncode
+
+
+def can_spawn(cwd):
+    """Whether a process with these options can be posix_spawn-ed."""
+    # there is no chdir file action in the os module
+    return hasattr(os, 'posix_spawnp') and cwd is None
+
+
 class ProcessThread(threading.Thread):
+    # how often to check whether the process exited while its output is
+    # still open
+    LEADER_POLL = 1
+
     def __init__(
         self, task_name, command, stop_signal, wait_timeout,
         formatted_sec, max_lines,
         stdout_logger, stdout_level, stderr_logger, stderr_level,
-        cwd
+        cwd, sec=None, limits=None, pipe_grace=5, env=None,
+        launcher=POPEN
     ):
         self.task_name = task_name
         self.command = command
@@ -51,6 +129,13 @@ class ProcessThread(threading.Thread):
         self.stderr_logger = stderr_logger
         self.stderr_level = stderr_level or logging.INFO
         self.cwd = cwd
+        self.env = env
+        self.launcher = launcher
+        self.sec = sec
+        self.limits = limits
+        self.limit_breach = None
+        self.pipe_grace = pipe_grace
+        self.cgroup = None
 
         self.stdout_head = []
         self.stdout_tail = []
@@ -58,7 +143,21 @@ class ProcessThread(threading.Thread):
         self.stderr_tail = []
 
         self.returncode = None
+        self.result = None
+        self.start_time = None
+        self.output_closed = None
+        # periodtask.tracing.RunTrace of the run, if traced
+        self.trace = None
+        # periodtask.dag.DagRun the run belongs to, if any
+        self.dag_run = None
+        # 1 for the first run, more for retries
+        self.attempt = 1
+        self.line_count = 0
+        self.char_count = 0
+        self.timed_out = False
+        self.deadline = None
         self.proc = None
+        self.started = threading.Event()
         self.lock = threading.Lock()
         super(ProcessThread, self).__init__()
 
@@ -101,63 +200,197 @@ class ProcessThread(threading.Thread):
         data = desc.readline()
         if not data:
             return False
+        self.store_line(data, head, tail, logger, level, h, t, m)
+        return True
+
+    def store_line(self, data, head, tail, logger, level, h, t, m):
+        """Log a line of output and keep it in the head or tail buffer."""
+        nchars = len(data)
         data = data.rstrip('\r\n')
         if logger:
             logger.log(level, data)
         with self.lock:
+            self.line_count += 1
+            self.char_count += nchars
             if tail:
                 tail.append(data)
                 if t is not None:
                     tail.pop(0)
-                return True
+                return
             head.append(data)
             if m is not None and len(head) > m:
                 if t != 0:
                     tail.extend(head[-t:])
                 del head[h:]
-        return True
 
     def run(self):
-        proc = self.proc = Popen(
-            self.command,
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
-            # encoding='utf-8',  # This only works on 3.6 and above
-            universal_newlines=True,
-            start_new_session=True,
-            bufsize=1,
-            cwd=self.cwd,
-        )
+        command, cgroup = self.command, None
+        if self.limits is not None:
+            try:
+                cgroup = self.limits.create_cgroup(self.task_name)
+            except OSError:
+                logger.exception('could not create cgroup')
+            command = self.limits.wrap(command, cgroup)
 
-        stdout_live, stderr_live = True, True
-        while stdout_live or stderr_live:
-            r, w, e = select.select([proc.stdout, proc.stderr], [], [])
-            if proc.stdout in r:
-                stdout_live = self.read_descriptor(
-                    proc.stdout,
-                    self.stdout_head, self.stdout_tail,
-                    self.stdout_logger, self.stdout_level,
-                    self.max_lines[0], self.max_lines[1], self.max_lines[2]
+        started = self.start_time = time.time()
+        try:
+            if self.launcher == POSIX_SPAWN and can_spawn(self.cwd):
+                proc = self.proc = SpawnedProcess(command, self.env)
+            else:
+                proc = self.proc = Popen(
+                    command,
+                    stdin=PIPE,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    # encoding='utf-8',  # This only works on 3.6 and above
+                    universal_newlines=True,
+                    start_new_session=True,
+                    bufsize=1,
+                    cwd=self.cwd,
+                    env=self.env,
                 )
-            if proc.stderr in r:
-                stderr_live = self.read_descriptor(
-                    proc.stderr,
-                    self.stderr_head, self.stderr_tail,
-                    self.stderr_logger, self.stderr_level,
-                    self.max_lines[3], self.max_lines[4], self.max_lines[5]
+        finally:
+            self.started.set()
+
+        self.cgroup = cgroup
+        live = {
+            proc.stdout: (
+                self.stdout_head, self.stdout_tail,
+                self.stdout_logger, self.stdout_level,
+                self.max_lines[0], self.max_lines[1], self.max_lines[2]
+            ),
+            proc.stderr: (
+                self.stderr_head, self.stderr_tail,
+                self.stderr_logger, self.stderr_level,
+                self.max_lines[3], self.max_lines[4], self.max_lines[5]
+            ),
+        }
+        reaped, next_poll, grace_until = None, 0, None
+        while live:
+            # Descendants may keep the pipes open after the leader exited.
+            # The leader is polled, and once it is gone the descendants get
+            # pipe_grace seconds to finish.
+            now = time.time()
+            if reaped is None and now >= next_poll:
+                reaped = self._try_reap()
+                next_poll = now + self.LEADER_POLL
+                if reaped is not None:
+                    grace_until = now + self.pipe_grace
+            if grace_until is not None and now >= grace_until:
+                logger.warning(
+                    'process of task %s exited, killing descendants still '
+                    'holding its output' % self.task_name
                 )
+                self._signal_group(signal.SIGKILL)
+                break
+            timeout = self.LEADER_POLL
+            if grace_until is not None:
+                timeout = grace_until - now
+            r, w, e = select.select(list(live), [], [], timeout)
+            for desc in r:
+                if not self.read_descriptor(desc, *live[desc]):
+                    del live[desc]
+        self.output_closed = time.time()
+        for desc in (proc.stdin, proc.stdout, proc.stderr):
+            desc.close()
 
-        proc.wait()
+        if reaped is None:
+            try:
+                reaped = os.wait4(proc.pid, 0)[1:] + (time.time(),)
+            except ChildProcessError:
+                proc.wait()
+                reaped = None, None, time.time()
+        status, rusage, finished = reaped
+        if status is not None:
+            # let Popen know that the child has been reaped
+            proc.returncode = exit_code(status)
+        self.result = RunResult(
+            proc.returncode, self.sec, started, finished, rusage
+        )
+        if self.limits is not None:
+            self.limit_breach = self.limits.breach(
+                proc.returncode, self.result, cgroup
+            )
+            if cgroup:
+                self.limits.kill_cgroup(cgroup)
+                self.limits.remove_cgroup(cgroup)
         self.returncode = proc.returncode
 
-    def stop(self):
-        logger.warning('sending %s to process' % self.stop_signal)
-        self.proc.send_signal(self.stop_signal)
+    def _try_reap(self):
+        try:
+            pid, status, rusage = os.wait4(self.proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            return None
+        if pid == 0:
+            return None
+        return status, rusage, time.time()
+
+    def _signal_group(self, sig):
+        # the process was started in a new session, so its pid is the
+        # process group id of its descendants as well
         try:
-            logger.warning('waiting for process to terminate...')
-            self.proc.wait(timeout=self.wait_timeout)
-        except TimeoutExpired:
-            logger.warning('killing the process...')
-            self.proc.kill()
-            self.proc.wait()
+            os.killpg(self.proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+        if self.cgroup:
+            self.limits.signal_cgroup(self.cgroup, sig)
+
+    def send_signal(self, sig):
+        self.started.wait()
+        # Popen.send_signal() would poll (and so reap) the child, but that
+        # is the job of run()
+        if self.proc is None or self.returncode is not None:
+            return
+        self._signal_group(sig)
+
+    def send_stop_signal(self):
+        logger.warning('sending %s to process group' % self.stop_signal)
+        self.send_signal(self.stop_signal)
+
+    def kill(self):
+        logger.warning('killing the process group...')
+        self.send_signal(signal.SIGKILL)
+
+    def stop(self):
+        self.send_stop_signal()
+        # The child is reaped by run(), so we wait for the thread, not for
+        # the process.
+        logger.warning('waiting for process to terminate...')
+        self.join(timeout=self.wait_timeout)
+        if self.is_alive():
+            self.kill()
+            self.join()
+
+
+def stop_threads(threads, deadline=None):
+    """
+    Stop the processes of ``threads`` in parallel.
+
+    The stop signal is sent to every process at once, then each is waited
+    for until its own ``wait_timeout`` or ``deadline`` (an absolute time),
+    whichever comes first. The remaining processes are killed together and
+    their threads are waited for at most ``KILL_GRACE`` seconds more.
+    """
+    signalled = time.time()
+    for thrd in threads:
+        thrd.send_stop_signal()
+    logger.warning('waiting for %s process(es) to terminate...' % len(threads))
+    for thrd in threads:
+        until = signalled + thrd.wait_timeout
+        if deadline is not None:
+            until = min(until, deadline)
+        thrd.join(timeout=max(0, until - time.time()))
+    alive = [thrd for thrd in threads if thrd.is_alive()]
+    for thrd in alive:
+        thrd.kill()
+    until = time.time() if deadline is None else max(deadline, time.time())
+    until += KILL_GRACE
+    for thrd in alive:
+        thrd.join(timeout=max(0, until - time.time()))
+    for thrd in alive:
+        if thrd.is_alive():
+            logger.error(
+                'process of task %s started for %s did not stop' % (
+                    thrd.task_name, thrd.formatted_sec
+                )
+            )
@@ -0,0 +1,267 @@
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+logger = logging.getLogger('periodtask.profiling')
+
+PHASES = ('timers', 'check_subprocesses', 'periods', 'start', 'mail')
+
+# used when phases are not timed
+NO_PHASE = contextlib.nullcontext()
+
+
+class _Phase:
+    __slots__ = ('timer', 'name')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.timer.exit()
+
+
+class PhaseTimer:
+    """
+    Measures the time spent in the phases of the scheduler. Phases nest
+    (e.g. ``mail`` inside ``check_subprocesses``), the time of an inner
+    phase is not counted in the outer one.
+    """
+    def __init__(self):
+        self.times = dict((p, 0.0) for p in PHASES)
+        self.stack = []
+
+    def reset(self):
+        self.times = dict((p, 0.0) for p in PHASES)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            outer = self.stack[-1]
+            self.times[outer[0]] += now - outer[1]
+        self.stack.append([name, now])
+
+    def exit(self):
+        now = time.perf_counter()
+        name, start = self.stack.pop()
+        self.times[name] = self.times.get(name, 0.0) + now - start
+        if self.stack:
+            self.stack[-1][1] = now
+
+    @property
+    def current(self):
+        return self.stack[-1][0] if self.stack else None
+
+
+class TickProfile:
+    """
+    What a tick of the scheduler did.
+
+    :ivar float started: The start of the tick (``time.time()``).
+    :ivar float duration: The duration of the tick in seconds.
+    :ivar dict phases: Seconds spent in each phase: ``timers``,
+      ``check_subprocesses``, ``periods`` (evaluating the cron expressions),
+      ``start`` (starting processes) and ``mail`` (notifications).
+    :ivar int seconds: The number of seconds evaluated (more than one if the
+      scheduler is catching up).
+    """
+    def __init__(self, started, duration, phases, seconds):
+        self.started = started
+        self.duration = duration
+        self.phases = phases
+        self.seconds = seconds
+
+    def __str__(self):
+        return '%.3fs for %s second(s) (%s)' % (
+            self.duration, self.seconds, ', '.join(
+                '%s: %.3fs' % (p, self.phases[p]) for p in PHASES
+                if self.phases.get(p)
+            )
+        )
+
+
+class TickHook:
+    """
+    Base class of the objects passed in the ``tick_hooks`` of
+    :py:class:`TaskList <periodtask.TaskList>`. The methods are called from
+    the scheduler thread and should return fast.
+    """
+    def tick_started(self, now):
+        pass
+
+    def tick_finished(self, profile):
+        """Called with the :py:class:`TickProfile` of the tick."""
+        pass
+
+    def close(self):
+        """Called when the scheduler stops."""
+        pass
+
+
+class SlowTickLogger(TickHook):
+    """Logs the phase timings of ticks longer than ``threshold`` seconds."""
+    def __init__(self, threshold=1.0):
+        self.threshold = threshold
+
+    def tick_finished(self, profile):
+        if profile.duration >= self.threshold:
+            logger.warning('slow tick: %s' % profile)
+
+
+class SlowTickWatchdog(TickHook):
+    """
+    Logs the stack of the scheduler thread when a tick runs longer than
+    ``threshold`` seconds, while it is still running. The stack is logged
+    once per slow tick.
+
+    :param number threshold: In seconds.
+    :param number interval: How often the watchdog thread checks, defaults
+      to a quarter of the threshold.
+    """
+    def __init__(self, threshold=5.0, interval=None):
+        self.threshold = threshold
+        self.interval = interval or max(0.05, threshold / 4)
+        self.lock = threading.Lock()
+        self.tick_start = None
+        self.ident = None
+        self.dumped = False
+        self.dumps = 0
+        self.closed = threading.Event()
+        self.thread = None
+
+    def tick_started(self, now):
+        with self.lock:
+            self.tick_start = time.time()
+            self.ident = threading.get_ident()
+            self.dumped = False
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._work, daemon=True, name='tick-watchdog'
+            )
+            self.thread.start()
+
+    def tick_finished(self, profile):
+        with self.lock:
+            self.tick_start = None
+
+    def close(self):
+        self.closed.set()
+
+    def _work(self):
+        while not self.closed.wait(self.interval):
+            with self.lock:
+                if (
+                    self.tick_start is None or self.dumped or
+                    time.time() - self.tick_start < self.threshold
+                ):
+                    continue
+                self.dumped = True
+                elapsed = time.time() - self.tick_start
+                ident = self.ident
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                continue
+            self.dumps += 1
+            logger.warning('tick running for %.1fs, stack:\n%s' % (
+                elapsed, ''.join(traceback.format_stack(frame))
+            ))
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%s)' % (
+            code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno
+        ))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(TickHook):
+    """
+    Samples the stack of the scheduler thread (or of every thread) every
+    ``interval`` seconds, starting with the first tick, and writes the
+    counts in collapsed-stack format (input of ``flamegraph.pl`` or
+    speedscope) to ``path`` after ``window`` seconds or when the scheduler
+    stops.
+
+    :param str path: The output file.
+    :param number window: The length of the sampling in seconds.
+    :param number interval: The sampling interval in seconds.
+    :param bool all_threads: Sample every thread, with the thread names as
+      root frames.
+    """
+    def __init__(self, path, window=60, interval=0.005, all_threads=False):
+        self.path = path
+        self.window = window
+        self.interval = interval
+        self.all_threads = all_threads
+        self.counts = {}
+        self.samples = 0
+        self.ident = None
+        self.thread = None
+        self.done = threading.Event()
+        self.written = False
+        self.lock = threading.Lock()
+
+    def tick_started(self, now):
+        if self.thread is None:
+            self.ident = threading.get_ident()
+            self.thread = threading.Thread(
+                target=self._work, daemon=True, name='sampling-profiler'
+            )
+            self.thread.start()
+
+    def close(self):
+        self.done.set()
+        self.write()
+
+    def _sample(self):
+        frames = sys._current_frames()
+        if self.all_threads:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            own = threading.get_ident()
+            stacks = [
+                '%s;%s' % (names.get(ident, ident), _collapse(frame))
+                for ident, frame in frames.items() if ident != own
+            ]
+        else:
+            frame = frames.get(self.ident)
+            stacks = [] if frame is None else [_collapse(frame)]
+        with self.lock:
+            self.samples += 1
+            for stack in stacks:
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def _work(self):
+        end = time.time() + self.window
+        while not self.done.wait(self.interval) and time.time() < end:
+            self._sample()
+        self.write()
+
+    def write(self):
+        """Write the collected samples, only once."""
+        with self.lock:
+            if self.written:
+                return
+            self.written = True
+            counts = sorted(self.counts.items())
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            for stack, count in counts:
+                f.write('%s %s\n' % (stack, count))
+        os.rename(tmp, self.path)
+        logger.info('%s samples written to %s' % (self.samples, self.path))
@@ -0,0 +1,705 @@
+"""
+Run the processes of tasks on worker agents, see the ``workers`` parameter
+of :py:class:`Task <periodtask.Task>`.
+
+A :py:class:`WorkerPool` listens on a TCP address or on a Unix socket, the
+agents connect to it and tell how many processes they run at once. Every
+run is sent to the least busy agent (the fewest runs relative to its
+capacity, then the most free capacity, then the lowest load average the
+agents report), the agent streams the output of the process back, then
+reports its return code and resource usage. Runs of an agent that
+disconnects are sent to another one.
+
+Messages are JSON objects, each preceded by its length in 4 bytes (big
+endian).
+
+Agent usage::
+
+    python -m periodtask.remote scheduler.example.com:7070 --capacity 4
+    python -m periodtask.remote /run/periodtask-workers.sock
+"""
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+import types
+
+from .process_thread import ProcessThread
+from .stats import RunResult
+
+
+logger = logging.getLogger('periodtask.remote')
+
+HEADER = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+RUSAGE_FIELDS = (
+    'utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw', 'nivcsw'
+)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(message):
+    """Return ``message`` as a frame."""
+    data = json.dumps(message).encode()
+    return HEADER.pack(len(data)) + data
+
+
+class FrameReader:
+    """Splits the received bytes into messages."""
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        """Add received data, return the complete messages."""
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            (size,) = HEADER.unpack_from(self.buffer)
+            if size > MAX_FRAME:
+                raise ProtocolError('frame too large: %s bytes' % size)
+            end = HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            messages.append(json.loads(self.buffer[HEADER.size:end].decode()))
+            self.buffer = self.buffer[end:]
+        return messages
+
+
+def parse_address(address):
+    """
+    Return the socket family and address of ``address``: a ``(host, port)``
+    tuple, a ``'host:port'`` string or the path of a Unix socket.
+    """
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    if os.sep not in address and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class RemoteRun(ProcessThread):
+    """
+    A run sent to a :py:class:`WorkerPool`, with the attributes and methods
+    of :py:class:`ProcessThread <periodtask.process_thread.ProcessThread>`
+    the scheduler uses. The output is kept in the head and tail buffers as
+    it arrives.
+
+    A run that could not be finished by any agent gets ``None`` as its
+    return code and the reason in ``limit_breach``.
+    """
+    ids = itertools.count(1)
+
+    def __init__(self, pool, task, formatted_sec, sec=None, trace=None):
+        super(RemoteRun, self).__init__(
+            task.name, task.command, task.stop_signal, task.wait_timeout,
+            formatted_sec, task.max_lines,
+            task.stdout_logger, task.stdout_level,
+            task.stderr_logger, task.stderr_level,
+            task.cwd, sec=sec, pipe_grace=task.pipe_grace
+        )
+        self.pool = pool
+        self.id = next(self.ids)
+        self.extra_env = {}
+        if trace is not None:
+            self.extra_env['TRACEPARENT'] = trace.traceparent
+        # the name of the agent running it
+        self.worker = None
+        self.requeued = 0
+        self.stop_requested = False
+        self.finished = threading.Event()
+
+    def message(self):
+        return {
+            'type': 'run',
+            'id': self.id,
+            'task': self.task_name,
+            'command': list(self.command),
+            'cwd': self.cwd,
+            'env': self.extra_env,
+            'scheduled': self.formatted_sec,
+            'stop_signal': int(self.stop_signal),
+            'pipe_grace': self.pipe_grace,
+        }
+
+    def reset(self):
+        """Forget the output of a run that is started again."""
+        with self.lock:
+            self.stdout_head, self.stdout_tail = [], []
+            self.stderr_head, self.stderr_tail = [], []
+            self.line_count = self.char_count = 0
+        self.worker = self.start_time = None
+
+    def output(self, stream, data):
+        if stream == 'stdout':
+            self.store_line(
+                data, self.stdout_head, self.stdout_tail,
+                self.stdout_logger, self.stdout_level, *self.max_lines[:3]
+            )
+        else:
+            self.store_line(
+                data, self.stderr_head, self.stderr_tail,
+                self.stderr_logger, self.stderr_level, *self.max_lines[3:]
+            )
+
+    def exited(self, returncode, duration=None, rusage=None, error=None):
+        finished = time.time()
+        if self.start_time is None:
+            self.start_time = finished
+        if duration is not None:
+            # the clocks of the agents may differ from ours
+            finished = self.start_time + duration
+            if rusage is not None:
+                rusage = types.SimpleNamespace(
+                    **dict(('ru_%s' % f, rusage[f]) for f in RUSAGE_FIELDS)
+                )
+            self.result = RunResult(
+                returncode, self.sec, self.start_time, finished, rusage
+            )
+        self.limit_breach = error
+        self.output_closed = finished
+        self.returncode = returncode
+        self.finished.set()
+
+    def start(self):
+        self.started.set()
+        self.pool.command('submit', self)
+
+    def run(self):
+        pass
+
+    def is_alive(self):
+        return not self.finished.is_set()
+
+    def join(self, timeout=None):
+        self.finished.wait(timeout)
+
+    def send_signal(self, sig):
+        if self.is_alive():
+            self.pool.command('signal', self, int(sig))
+
+
+class _Worker:
+    """The connection of an agent, used from the selector thread."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.outgoing = b''
+        self.name = None
+        self.capacity = 0
+        self.load = 0
+        self.runs = {}
+        self.last_seen = time.time()
+
+    def free(self):
+        return self.capacity - len(self.runs)
+
+
+class WorkerPool:
+    """
+    Sends the runs of tasks to worker agents (see
+    :py:class:`Agent`) connected to ``address`` (a ``(host, port)`` tuple,
+    a ``'host:port'`` string or the path of a Unix socket). The pools of
+    the tasks are started and closed by the
+    :py:class:`TaskList <periodtask.TaskList>`.
+
+    Runs wait in the pool while no agent has free capacity (use
+    ``max_runtime`` to give up on them). The runs of an agent that
+    disconnects, or is not heard from for ``heartbeat_timeout`` seconds,
+    are sent to another agent at most ``max_requeues`` times, then they
+    fail.
+
+    There is no authentication: listen on a Unix socket or on a trusted
+    network only.
+
+    :param address: Where to listen for the agents.
+    :param int max_requeues: How many times a run is sent again.
+    :param number heartbeat_timeout: Agents report their load every few
+      seconds, silent agents are dropped after this many seconds.
+    """
+    def __init__(self, address, max_requeues=3, heartbeat_timeout=30):
+        self.family, self.address = parse_address(address)
+        self.max_requeues = max_requeues
+        self.heartbeat_timeout = heartbeat_timeout
+        # (command, run, args) tuples for the selector thread
+        self.commands = collections.deque()
+        # runs waiting for an agent
+        self.pending = collections.deque()
+        self.workers = {}
+        self.selector = None
+        self.sock = None
+        self.thread = None
+        self.closing = False
+
+    def submit(self, task, formatted_sec, sec=None, trace=None):
+        """Return a :py:class:`RemoteRun` of ``task``, to be started."""
+        return RemoteRun(self, task, formatted_sec, sec, trace)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_UNIX:
+            self.sock.bind(self.address)
+            os.chmod(self.address, 0o600)
+        else:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(self.address)
+            # the port is chosen by the system if 0 was given
+            self.address = self.sock.getsockname()
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.thread = threading.Thread(
+            target=self._work, daemon=True, name='workerpool'
+        )
+        self.thread.start()
+        logger.info('worker pool listening on %s' % (self.address,))
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.closing = True
+        self._wakeup()
+        self.thread.join(timeout=5)
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+    def command(self, cmd, run, *args):
+        """Queue a command for the selector thread (any thread)."""
+        self.commands.append((cmd, run, args))
+        self._wakeup()
+
+    def capacity(self):
+        """The number of connected agents and their total capacity."""
+        workers = list(self.workers.values())
+        return len(workers), sum(w.capacity for w in workers)
+
+    def _wakeup(self):
+        try:
+            self.wakeup_w.send(b'x')
+        except (AttributeError, BlockingIOError, OSError):
+            pass
+
+    @staticmethod
+    def choose(workers):
+        """The agent to send the next run to, ``None`` if all are full."""
+        best, best_key = None, None
+        for worker in workers:
+            if worker.free() <= 0:
+                continue
+            key = (
+                len(worker.runs) / worker.capacity, -worker.free(),
+                worker.load
+            )
+            if best_key is None or key < best_key:
+                best, best_key = worker, key
+        return best
+
+    # selector thread
+
+    def _work(self):
+        while not self.closing:
+            for key, mask in self.selector.select(timeout=1):
+                sock = key.fileobj
+                if sock is self.sock:
+                    self._accept()
+                elif sock is self.wakeup_r:
+                    self._drain_wakeup()
+                else:
+                    worker = key.data
+                    if mask & selectors.EVENT_READ:
+                        self._read(worker)
+                    if mask & selectors.EVENT_WRITE and worker.sock:
+                        self._write(worker)
+            self._apply_commands()
+            self._check_heartbeats()
+            self._place()
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self._drop(key.data, requeue=False)
+        self.selector.close()
+        self.sock.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def _accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.selector.register(conn, selectors.EVENT_READ, _Worker(conn))
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read(self, worker):
+        try:
+            data = worker.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(worker)
+            return
+        worker.last_seen = time.time()
+        try:
+            for message in worker.reader.feed(data):
+                self._handle(worker, message)
+        except (ValueError, KeyError, TypeError, ProtocolError) as e:
+            logger.error('bad message from agent %s: %s' % (worker.name, e))
+            self._drop(worker)
+
+    def _write(self, worker):
+        try:
+            sent = worker.sock.send(worker.outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._drop(worker)
+            return
+        worker.outgoing = worker.outgoing[sent:]
+        if not worker.outgoing:
+            self.selector.modify(worker.sock, selectors.EVENT_READ, worker)
+
+    def _send(self, worker, message):
+        worker.outgoing += encode(message)
+        self.selector.modify(
+            worker.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, worker
+        )
+
+    def _handle(self, worker, message):
+        typ = message['type']
+        if typ == 'hello':
+            old = self.workers.get(message['name'])
+            if old is not None:
+                # reconnected before we noticed it was gone
+                self._drop(old)
+            worker.name = message['name']
+            worker.capacity = int(message['capacity'])
+            worker.load = message.get('load', 0)
+            self.workers[worker.name] = worker
+            logger.info('agent %s connected (capacity %s)' % (
+                worker.name, worker.capacity
+            ))
+        elif typ == 'status':
+            worker.load = message.get('load', 0)
+        elif typ == 'output':
+            run = worker.runs.get(message['id'])
+            if run is not None:
+                run.output(message['stream'], message['data'])
+        elif typ == 'exit':
+            run = worker.runs.pop(message['id'], None)
+            if run is not None:
+                run.exited(
+                    message['returncode'], message.get('duration'),
+                    message.get('rusage'), message.get('error')
+                )
+        else:
+            raise ProtocolError('unknown message type: %s' % typ)
+
+    def _drop(self, worker, requeue=True):
+        if worker.sock is None:
+            return
+        self.selector.unregister(worker.sock)
+        worker.sock.close()
+        worker.sock = None
+        if self.workers.get(worker.name) is worker:
+            del self.workers[worker.name]
+        if worker.name is not None:
+            logger.warning('agent %s disconnected' % worker.name)
+        for run in worker.runs.values():
+            if requeue and not run.stop_requested and (
+                run.requeued < self.max_requeues
+            ):
+                logger.warning(
+                    'task %s started for %s: agent %s lost, sending the run '
+                    'again' % (run.task_name, run.formatted_sec, worker.name)
+                )
+                run.requeued += 1
+                run.reset()
+                self.pending.appendleft(run)
+            else:
+                run.exited(None, error='agent %s lost' % worker.name)
+        worker.runs = {}
+
+    def _apply_commands(self):
+        while self.commands:
+            cmd, run, args = self.commands.popleft()
+            if cmd == 'submit':
+                self.pending.append(run)
+                continue
+            # signal
+            run.stop_requested = True
+            if run in self.pending:
+                self.pending.remove(run)
+                run.exited(-args[0])
+                continue
+            worker = self.workers.get(run.worker)
+            if worker is not None and run.id in worker.runs:
+                self._send(worker, {
+                    'type': 'signal', 'id': run.id, 'signal': args[0]
+                })
+
+    def _check_heartbeats(self):
+        limit = time.time() - self.heartbeat_timeout
+        for worker in list(self.workers.values()):
+            if worker.last_seen < limit:
+                logger.warning('agent %s is silent' % worker.name)
+                self._drop(worker)
+
+    def _place(self):
+        while self.pending:
+            worker = self.choose(self.workers.values())
+            if worker is None:
+                return
+            run = self.pending.popleft()
+            run.worker = worker.name
+            run.start_time = time.time()
+            worker.runs[run.id] = run
+            self._send(worker, run.message())
+
+
+class _AgentProcess(ProcessThread):
+    """A process of an agent, its output is sent to the pool."""
+    def __init__(self, agent, message):
+        env = None
+        if message.get('env'):
+            env = dict(os.environ, **message['env'])
+        super(_AgentProcess, self).__init__(
+            message['task'], message['command'], message['stop_signal'], 0,
+            message['scheduled'], None, None, None, None, None,
+            message.get('cwd'), pipe_grace=message.get('pipe_grace', 5),
+            env=env
+        )
+        self.agent = agent
+        self.run_id = message['id']
+        self.daemon = True
+
+    def store_line(self, data, head, tail, logger, level, h, t, m):
+        self.agent.send({
+            'type': 'output',
+            'id': self.run_id,
+            'stream': 'stdout' if head is self.stdout_head else 'stderr',
+            'data': data,
+        })
+
+    def run(self):
+        try:
+            super(_AgentProcess, self).run()
+        except Exception as e:
+            logger.exception('could not run %s' % (self.command,))
+            self.agent.finished(self, {
+                'type': 'exit', 'id': self.run_id, 'returncode': None,
+                'error': str(e),
+            })
+            return
+        result = self.result
+        rusage = None
+        if result.utime is not None:
+            rusage = dict((f, getattr(result, f)) for f in RUSAGE_FIELDS)
+        self.agent.finished(self, {
+            'type': 'exit',
+            'id': self.run_id,
+            'returncode': self.returncode,
+            'duration': result.duration,
+            'rusage': rusage,
+        })
+
+
+class Agent:
+    """
+    Runs the processes a :py:class:`WorkerPool` at ``address`` sends. The
+    connection is opened again after a failure, waiting ``reconnect``
+    seconds at first, twice as much after each failed attempt, but at most
+    ``max_reconnect`` seconds. The processes are killed when the connection
+    is lost, the pool sends them elsewhere.
+
+    :param address: The address of the pool, see :py:class:`WorkerPool`.
+    :param int capacity: The number of processes to run at once, the number
+      of CPUs by default.
+    :param str name: The name of the agent, the host name by default.
+    :param number heartbeat: Report the load average this often (seconds).
+    """
+    def __init__(
+        self, address, capacity=None, name=None, heartbeat=5,
+        reconnect=0.5, max_reconnect=30
+    ):
+        self.family, self.address = parse_address(address)
+        self.capacity = capacity or os.cpu_count() or 1
+        self.name = name or socket.gethostname()
+        self.heartbeat = heartbeat
+        self.reconnect = reconnect
+        self.max_reconnect = max_reconnect
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.processes = {}
+        self.stopped = False
+
+    def load(self):
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            return 0
+
+    def send(self, message):
+        """
+        Send ``message`` to the pool (any thread). A failed send closes the
+        connection, so the pool sends the runs elsewhere.
+        """
+        with self.send_lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall(encode(message))
+            except OSError as e:
+                logger.warning('cannot send to %s: %s' % (self.address, e))
+                try:
+                    # wakes up _serve, which connects again
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock = None
+
+    def finished(self, proc, message):
+        self.processes.pop(proc.run_id, None)
+        self.send(message)
+
+    def run(self):
+        """Serve the pool until :py:meth:`stop` is called."""
+        wait = self.reconnect
+        while not self.stopped:
+            try:
+                sock = socket.socket(self.family, socket.SOCK_STREAM)
+                sock.connect(self.address)
+            except OSError as e:
+                sock.close()
+                logger.warning('cannot connect to %s: %s' % (
+                    self.address, e
+                ))
+                time.sleep(wait)
+                wait = min(wait * 2, self.max_reconnect)
+                continue
+            wait = self.reconnect
+            logger.info('connected to %s' % (self.address,))
+            try:
+                self._serve(sock)
+            except (OSError, ValueError, KeyError, ProtocolError) as e:
+                logger.warning('connection lost: %s' % e)
+            finally:
+                with self.send_lock:
+                    self.sock = None
+                sock.close()
+                self._kill_all()
+
+    def stop(self):
+        self.stopped = True
+
+    def _serve(self, sock):
+        with self.send_lock:
+            self.sock = sock
+        self.send({
+            'type': 'hello', 'name': self.name, 'capacity': self.capacity,
+            'load': self.load(),
+        })
+        # the socket stays blocking (a send must not time out), the
+        # selector wakes up for the heartbeat
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        reader = FrameReader()
+        next_status = time.time() + self.heartbeat
+        try:
+            while not self.stopped:
+                if self.sock is not sock:
+                    raise OSError('send failed')
+                if selector.select(max(0, next_status - time.time())):
+                    data = sock.recv(65536)
+                    if data == b'':
+                        raise OSError('closed by the pool')
+                    for message in reader.feed(data):
+                        self._handle(message)
+                if time.time() >= next_status:
+                    self.send({'type': 'status', 'load': self.load()})
+                    next_status = time.time() + self.heartbeat
+        finally:
+            selector.close()
+
+    def _handle(self, message):
+        if message['type'] == 'run':
+            proc = _AgentProcess(self, message)
+            self.processes[proc.run_id] = proc
+            logger.info('task %s starts process for %s' % (
+                proc.task_name, proc.formatted_sec
+            ))
+            proc.start()
+        elif message['type'] == 'signal':
+            proc = self.processes.get(message['id'])
+            if proc is not None:
+                proc.send_signal(message['signal'])
+        else:
+            raise ProtocolError('unknown message type: %s' % message['type'])
+
+    def _kill_all(self):
+        procs = list(self.processes.values())
+        for proc in procs:
+            proc.send_signal(signal.SIGKILL)
+        for proc in procs:
+            proc.join()
+        self.processes = {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='periodtask worker agent')
+    parser.add_argument(
+        'address', help='host:port or the path of a Unix socket'
+    )
+    parser.add_argument('--capacity', type=int, help='processes at once')
+    parser.add_argument('--name', help='name of the agent')
+    parser.add_argument('--heartbeat', type=float, default=5)
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(name)s %(message)s'
+    )
+    agent = Agent(args.address, args.capacity, args.name, args.heartbeat)
+
+    def handler(num, frame):
+        agent.stop()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+    agent.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
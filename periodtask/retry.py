@@ -0,0 +1,47 @@
+import random
+
+
+class Retry:
+    """
+    Retry settings of a task. A failed run is started again after an
+    exponential backoff, the notifications are sent about the last attempt
+    only.
+
+    The n-th retry waits ``min(cap, base * factor ** (n - 1))`` seconds,
+    reduced by a random fraction of at most ``jitter`` (``1`` means "full
+    jitter"), so that tasks failing together do not retry together.
+
+    :param int max_attempts: The number of attempts of a run, including the
+      first one.
+    :param number base: The wait before the first retry in seconds.
+    :param number cap: The maximum wait in seconds.
+    :param number factor: The wait is multiplied by this after every retry.
+    :param number jitter: A fraction between ``0`` and ``1``.
+    :param list returncodes: Only these return codes are retried. ``None``
+      means any failure.
+    :param bool timeouts: Whether runs stopped because of ``max_runtime`` are
+      retried.
+    """
+    def __init__(
+        self, max_attempts=3, base=10, cap=600, factor=2, jitter=0.1,
+        returncodes=None, timeouts=False
+    ):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.jitter = jitter
+        self.returncodes = returncodes
+        self.timeouts = timeouts
+
+    def should_retry(self, attempt, outcome, returncode):
+        if attempt >= self.max_attempts:
+            return False
+        if outcome == 'timeout':
+            return self.timeouts
+        return self.returncodes is None or returncode in self.returncodes
+
+    def delay(self, attempt):
+        """The wait in seconds after the failure of ``attempt``."""
+        delay = min(self.cap, self.base * self.factor ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
@@ -0,0 +1,315 @@
+"""
+Fast-forward a :py:class:`TaskList <periodtask.TaskList>` over a time range
+on a virtual clock, to see how a set of schedules behaves (overlaps, skip
+and delay storms, e-mail thresholds) without waiting for it.
+
+Usage::
+
+    tasklist = TaskList(...)
+    simulation = Simulation(
+        tasklist, start, end,
+        profiles={'backup': Profile(duration=(600, 5400), failure_rate=0.05)}
+    )
+    for event in simulation.run():
+        print(event)
+"""
+import heapq
+import json
+import math
+import random
+import signal
+import time
+
+from .clock import VirtualClock
+from .stats import RunResult
+from .task import RUN, Task
+
+
+(START, NOTIFY) = ('start', 'notify')
+
+
+class Profile:
+    """
+    The declared behaviour of the simulated processes of a task.
+
+    :param duration: The duration of a run in seconds: a number, a
+      ``(low, high)`` tuple (uniform distribution) or a function taking a
+      ``random.Random`` instance.
+    :param float failure_rate: The probability of a run failing.
+    :param int returncode: The return code of the failing runs.
+    """
+    def __init__(self, duration=1, failure_rate=0, returncode=1):
+        self.duration = duration
+        self.failure_rate = failure_rate
+        self.returncode = returncode
+
+    def sample(self, rng):
+        """Return the duration and the return code of a run."""
+        duration = self.duration
+        if callable(duration):
+            duration = duration(rng)
+        elif isinstance(duration, tuple):
+            duration = rng.uniform(*duration)
+        returncode = 0
+        if self.failure_rate and rng.random() < self.failure_rate:
+            returncode = self.returncode
+        return max(0, duration), returncode
+
+
+class SimulatedProcess:
+    """
+    Stands for the :py:class:`ProcessThread` of a run in a
+    :py:class:`Simulation`: it "runs" until the virtual clock reaches its
+    end.
+    """
+    stdout_lines = stderr_lines = ''
+
+    def __init__(self, task, formatted_sec, sec, duration, returncode):
+        self.task_name = task.name
+        self.command = task.command
+        self.stop_signal = task.stop_signal
+        self.formatted_sec = formatted_sec
+        self.sec = sec
+        self.clock = task.clock
+        self.duration = duration
+        self.planned_returncode = returncode
+        self.returncode = None
+        self.result = None
+        self.limit_breach = None
+        self.timed_out = False
+        self.start_time = self.end = self.output_closed = None
+        self.deadline = self.trace = self.dag_run = self.proc = None
+        self.attempt = 1
+        self.line_count = self.char_count = 0
+
+    def start(self):
+        self.start_time = self.clock.time()
+        self.end = self.start_time + self.duration
+
+    def is_alive(self):
+        if self.returncode is not None:
+            return False
+        if self.clock.time() < self.end:
+            return True
+        self._exit(self.planned_returncode, self.end)
+        return False
+
+    def _exit(self, returncode, finished):
+        self.returncode = returncode
+        self.output_closed = finished
+        self.result = RunResult(
+            returncode, self.sec, self.start_time, finished, None
+        )
+
+    def send_stop_signal(self):
+        if self.is_alive():
+            self._exit(-int(self.stop_signal), self.clock.time())
+
+    def kill(self):
+        if self.is_alive():
+            self._exit(-signal.SIGKILL, self.clock.time())
+
+    def join(self, timeout=None):
+        pass
+
+
+class Event:
+    """
+    An entry of the timeline of a :py:class:`Simulation`. ``kind`` is
+    ``start``, an outcome (``success``, ``failure``, ``timeout``,
+    ``skipped``, ``delayed``) or ``notify`` (``detail`` is the type of the
+    notification, or its subject if rendered).
+    """
+    FIELDS = ('time', 'task', 'kind', 'scheduled', 'detail')
+
+    def __init__(self, time, task, kind, scheduled=None, detail=None):
+        self.time = time
+        self.task = task
+        self.kind = kind
+        self.scheduled = scheduled
+        self.detail = detail
+
+    def as_dict(self):
+        return dict((f, getattr(self, f)) for f in self.FIELDS)
+
+    def __str__(self):
+        text = '%s %s %s' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.time)),
+            self.task or '-', self.kind
+        )
+        if self.scheduled is not None:
+            text += ' for %s' % self.scheduled
+        if self.detail is not None:
+            text += ': %s' % self.detail
+        return text
+
+
+class _Recorder:
+    """The dispatcher and the notifier of the tasks in a simulation."""
+    def __init__(self, simulation, task_name):
+        self.simulation = simulation
+        self.task_name = task_name
+
+    def submit(self, template_lookup, send_func, typ, kwargs, on_done=None):
+        detail = typ
+        if self.simulation.render:
+            subject = template_lookup.get_template('%s_subject.txt' % typ)
+            detail = ''.join(subject.render(**kwargs).splitlines())
+        self.simulation.record(self.task_name, NOTIFY, None, detail)
+        if on_done is not None:
+            on_done(True)
+
+    def emit(self, event):
+        self.simulation.record(event.task, event.kind, event.scheduled)
+        return True
+
+    def flush(self, timeout=None):
+        return True
+
+
+class Simulation:
+    """
+    Runs ``tasklist`` from ``start`` to ``end`` on a
+    :py:class:`VirtualClock <periodtask.clock.VirtualClock>` as fast as
+    possible. No process is started: every run takes a duration and exits
+    with a return code drawn from the :py:class:`Profile` of its task. Only
+    the seconds something happens in are evaluated (a period of a task
+    matches, a process exits, a timer is due or a digest window ends), the
+    rest is skipped.
+
+    Notifications are not sent, they are recorded in the timeline together
+    with the starts, the outcomes, the skips and the delays. The notifiers
+    and the tracer of the tasks are replaced.
+
+    :param TaskList tasklist: The task list, not started.
+    :param int start: The start of the simulation (a UNIX timestamp).
+    :param int end: The end of the simulation (a UNIX timestamp).
+    :param dict profiles: :py:class:`Profile` instances by task name.
+    :param Profile default: The profile of the other tasks.
+    :param int seed: The seed of the random generator, simulations with the
+      same seed give the same timeline.
+    :param bool render: Render the subject of the notifications.
+    """
+    def __init__(
+        self, tasklist, start, end, profiles={}, default=None, seed=0,
+        render=False
+    ):
+        self.tasklist = tasklist
+        self.start = int(start)
+        self.end = int(end)
+        self.profiles = dict(profiles)
+        self.default = default or Profile()
+        self.random = random.Random(seed)
+        self.render = render
+        self.clock = VirtualClock(self.start)
+        self.timeline = []
+        self.index = {}
+        self.exits = []
+        tasklist.clock = self.clock
+        if tasklist.digest is not None:
+            tasklist.digest.clock = self.clock
+            tasklist.digest.dispatcher = _Recorder(self, None)
+        for task in tasklist.tasks:
+            recorder = _Recorder(self, task.name)
+            task.clock = self.clock
+            task.executor = self.execute
+            task.dispatcher = recorder
+            task.notifiers = [recorder]
+            task.tracer = None
+
+    def record(self, task_name, kind, scheduled=None, detail=None):
+        self.timeline.append(
+            Event(self.clock.now, task_name, kind, scheduled, detail)
+        )
+
+    def execute(self, task, formatted_sec, sec):
+        profile = self.profiles.get(task.name, self.default)
+        duration, returncode = profile.sample(self.random)
+        self.record(task.name, START, formatted_sec)
+        # the task is checked again when the process exits
+        end = math.ceil(self.clock.now + duration)
+        heapq.heappush(self.exits, (end, self.index[task]))
+        return SimulatedProcess(task, formatted_sec, sec, duration, returncode)
+
+    def run(self):
+        """Run the simulation, return the timeline (a list of events)."""
+        tl = self.tasklist
+        tasks = tl.by_priority
+        self.index = dict((t, i) for i, t in enumerate(tasks))
+        retrying = [i for i, t in enumerate(tasks) if t.retry is not None]
+        # (second, task index) heaps of the next fires and process exits
+        fires, self.exits = [], []
+        for i, task in enumerate(tasks):
+            self._push_fire(fires, i, self.start)
+        now = self.start
+        due = set(range(len(tasks)))  # run_on_start
+        while now < self.end:
+            self.clock.now = now
+            fired = []
+            while fires and fires[0][0] <= now:
+                fired.append(heapq.heappop(fires)[1])
+            due.update(fired)
+            while self.exits and self.exits[0][0] <= now:
+                due.add(heapq.heappop(self.exits)[1])
+            next_due = tl.timers.next_due
+            if next_due is not None and next_due <= now:
+                # retries are put into the deque of the task, the other
+                # timers (max_runtime, kill) are methods of their task
+                due.update(retrying)
+                for func in tl.timers.due(now):
+                    owner = getattr(func, '__self__', None)
+                    if isinstance(owner, Task) and owner in self.index:
+                        due.add(self.index[owner])
+            tl.last_checked = now - 1
+            tl._tick([tasks[i] for i in sorted(due)])
+            for i in fired:
+                self._push_fire(fires, i, now + 1)
+
+            # runs that can start in the next second (e.g. DAG runs)
+            ready = set()
+            for i in due:
+                task = tasks[i]
+                if self._ready(task):
+                    ready.add(i)
+                for down in task.downstream:
+                    if self._ready(down):
+                        ready.add(self.index[down])
+            due = ready
+            now = self._next_event(now, fires, bool(ready))
+        return self.timeline
+
+    def _ready(self, task):
+        if not task.waiting_runs() or not task.can_start():
+            return False
+        if task.upstream and task.periods:
+            # waits for its own period, it is among the fires
+            return False
+        return not task.process_threads or task.policy == RUN
+
+    def _push_fire(self, fires, i, sec):
+        fire = self.tasklist.by_priority[i].next_fire(sec)
+        if fire is not None and fire < self.end:
+            heapq.heappush(fires, (fire, i))
+
+    def _next_event(self, now, fires, ready):
+        if ready:
+            return now + 1
+        candidates = [self.end]
+        if fires:
+            candidates.append(fires[0][0])
+        if self.exits:
+            candidates.append(self.exits[0][0])
+        next_due = self.tasklist.timers.next_due
+        if next_due is not None:
+            candidates.append(math.ceil(next_due))
+        digest = self.tasklist.digest
+        if digest is not None:
+            for start, _ in list(digest.groups.values()):
+                candidates.append(math.ceil(start + digest.window))
+        return max(now + 1, min(candidates))
+
+    def write(self, path):
+        """Write the timeline to ``path`` as JSON lines."""
+        with open(path, 'w') as f:
+            for event in self.timeline:
+                f.write(json.dumps(event.as_dict()) + '\n')
@@ -0,0 +1,24 @@
+class Slots:
+    """
+    Counts the running processes of a
+    :py:class:`TaskList <periodtask.TaskList>` against ``limit`` (``None``
+    means no limit). Used from the scheduler thread only.
+
+    While ``held`` is set no slot is available: the scheduler collects the
+    due runs of a tick first, then admits them in priority order.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.held = False
+
+    def available(self):
+        if self.held:
+            return False
+        return self.limit is None or self.used < self.limit
+
+    def acquire(self):
+        self.used += 1
+
+    def release(self):
+        self.used -= 1
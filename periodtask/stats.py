@@ -0,0 +1,150 @@
+from collections import deque
+
+
+class RunResult:
+    """
+    Timing and resource usage of a single process run.
+
+    CPU times are in seconds, ``maxrss`` is in kilobytes (as reported by
+    ``getrusage(2)`` on Linux), block I/O is counted in operations.
+    """
+    FIELDS = (
+        'returncode', 'scheduled_sec', 'started', 'finished',
+        'utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw', 'nivcsw',
+    )
+
+    def __init__(self, returncode, scheduled_sec, started, finished, rusage):
+        self.returncode = returncode
+        self.scheduled_sec = scheduled_sec
+        self.started = started
+        self.finished = finished
+        if rusage is None:
+            self.utime = self.stime = None
+            self.maxrss = self.inblock = self.oublock = None
+            self.nvcsw = self.nivcsw = None
+        else:
+            self.utime = rusage.ru_utime
+            self.stime = rusage.ru_stime
+            self.maxrss = rusage.ru_maxrss
+            self.inblock = rusage.ru_inblock
+            self.oublock = rusage.ru_oublock
+            self.nvcsw = rusage.ru_nvcsw
+            self.nivcsw = rusage.ru_nivcsw
+
+    @property
+    def duration(self):
+        """Wall-clock duration of the run in seconds."""
+        return self.finished - self.started
+
+    @property
+    def start_delay(self):
+        """Seconds elapsed between the scheduled and the actual start."""
+        if self.scheduled_sec is None:
+            return None
+        return self.started - self.scheduled_sec
+
+    @property
+    def cpu_time(self):
+        if self.utime is None:
+            return None
+        return self.utime + self.stime
+
+    def as_dict(self):
+        d = dict((f, getattr(self, f)) for f in self.FIELDS)
+        d['duration'] = self.duration
+        d['start_delay'] = self.start_delay
+        return d
+
+    def __str__(self):
+        text = 'wall %.3fs' % self.duration
+        if self.start_delay is not None:
+            text += ', start delay %.3fs' % self.start_delay
+        if self.utime is not None:
+            text += (
+                ', user %.3fs, sys %.3fs, max rss %s kB, '
+                'block in/out %s/%s, ctx switches %s/%s' % (
+                    self.utime, self.stime, self.maxrss,
+                    self.inblock, self.oublock, self.nvcsw, self.nivcsw
+                )
+            )
+        return text
+
+
+class TaskStats:
+    """
+    Rolling aggregates of the :py:class:`RunResult` objects of a task.
+
+    Lifetime totals are kept for every run, averages and maximums are
+    computed over the last ``window`` runs.
+    """
+    __slots__ = (
+        'window', 'recent', 'runs', 'failures', 'timeouts',
+        'total_duration', 'total_cpu_time',
+    )
+
+    def __init__(self, window=100):
+        self.window = window
+        # the deque is created by the first run
+        self.recent = ()
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_duration = 0.0
+        self.total_cpu_time = 0.0
+
+    def add(self, result):
+        if not self.recent:
+            self.recent = deque(maxlen=self.window)
+        self.recent.append(result)
+        self.runs += 1
+        if result.returncode != 0:
+            self.failures += 1
+        self.total_duration += result.duration
+        if result.cpu_time is not None:
+            self.total_cpu_time += result.cpu_time
+
+    @property
+    def last(self):
+        return self.recent[-1] if self.recent else None
+
+    def _values(self, attr):
+        values = [getattr(r, attr) for r in self.recent]
+        return [v for v in values if v is not None]
+
+    def mean(self, attr):
+        values = self._values(attr)
+        return sum(values) / len(values) if values else None
+
+    def max(self, attr):
+        values = self._values(attr)
+        return max(values) if values else None
+
+    def summary(self):
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'total_duration': self.total_duration,
+            'total_cpu_time': self.total_cpu_time,
+            'mean_duration': self.mean('duration'),
+            'max_duration': self.max('duration'),
+            'mean_cpu_time': self.mean('cpu_time'),
+            'max_maxrss': self.max('maxrss'),
+            'mean_start_delay': self.mean('start_delay'),
+        }
+
+    def __str__(self):
+        text = '%s runs, %s failures, %s timeouts' % (
+            self.runs, self.failures, self.timeouts
+        )
+        if not self.recent:
+            return text
+        text += '; last %s runs: wall mean %.3fs, max %.3fs' % (
+            len(self.recent), self.mean('duration'), self.max('duration')
+        )
+        mean_cpu_time = self.mean('cpu_time')
+        if mean_cpu_time is not None:
+            text += ', cpu mean %.3fs, max %.3fs' % (
+                mean_cpu_time, self.max('cpu_time')
+            )
+        return text
@@ -1,19 +1,44 @@
+import collections
 import logging
 import signal
 import os
 
 from mako.lookup import TemplateLookup
 
-from .process_thread import ProcessThread
+from .process_thread import ProcessThread, stop_threads, POPEN
 from .periods import Period
+from .stats import TaskStats
+from .dispatcher import snapshot
+from .notifiers import OutcomeEvent
+from .profiling import NO_PHASE
+from .dag import DagRun
+from .clock import SYSTEM_CLOCK
 
 
 logger = logging.getLogger('periodtask.task')
 (SKIP, DELAY, RUN) = (0, 1, 2)
+(DROP_OLDEST, DROP_NEWEST, COALESCE) = (0, 1, 2)
+OUTCOMES = ('success', 'failure', 'timeout', 'skipped', 'delayed')
 
 
 base_dir = os.path.dirname(os.path.realpath(__file__))
 default_template_dir = os.path.join(base_dir, 'templates')
+# TemplateLookups by template directories, see shared_template_lookup()
+_template_lookups = {}
+
+
+def shared_template_lookup(directories):
+    """
+    Return a ``TemplateLookup`` of ``directories``. Tasks with the same
+    template directories share it (and its compiled templates).
+    """
+    key = tuple(directories)
+    lookup = _template_lookups.get(key)
+    if lookup is None:
+        lookup = _template_lookups.setdefault(key, TemplateLookup(
+            directories=list(directories), default_filters=['h']
+        ))
+    return lookup
 
 
 class Task:
@@ -43,6 +68,9 @@ class Task:
       skipped due to the defined **policy**.
     :param func/bool mail_deleyed: Controls emails sent when the task is
       delayed due to the defined **policy**.
+    :param func/bool mail_timeout: Controls emails sent when the task is
+      stopped because of **max_runtime**. If not set, **mail_failure** is
+      used (still with the TIMEOUT templates).
     :param func send_mail_func: If set, this must be a function. This function
       will be used to send emails, no matter what was set in **mail_...**
       params.
@@ -103,7 +131,103 @@ class Task:
     :param int/None failure_email_threshold: When a task fails more than
       this in a row no new FAILURE email will be sent. When the task runs
       successfully a RECOVER email will be sent. ``None`` means no threshold.
+    :param int stats_window: Resource usage of each run (CPU time, max RSS,
+      block I/O, context switches, wall-clock duration and start delay) is
+      collected in ``stats`` (a :py:class:`periodtask.stats.TaskStats`).
+      Averages and maximums are computed over this many recent runs.
+    :param periodtask.limits.Limits limits: Resource limits (rlimits, nice,
+      I/O priority, cgroup v2 placement) of the task process. A run that
+      ran into a limit is reported as a failure with the reason given.
+    :param number max_runtime: If a process runs longer than this many
+      seconds, it is stopped the same way as on shutdown: **stop_signal**
+      is sent, then it is killed after **wait_timeout**. The run is reported
+      as a TIMEOUT. ``None`` means no limit.
+    :param number pipe_grace: Signals are sent to the whole process group of
+      the task process. When the process exits but its descendants keep
+      its STDOUT or STDERR open, they are given this many seconds, then
+      they are killed and the run is considered finished.
+    :param bool urgent: When the task list collects notifications in a
+      :py:class:`periodtask.digest.Digest`, FAILURE and TIMEOUT
+      notifications of this task are sent immediately as well.
+    :param list notifiers: :py:class:`periodtask.notifiers.Notifier`
+      instances. Every outcome (``success``, ``failure``, ``timeout``,
+      ``skipped``, ``delayed``) is emitted to them as an
+      :py:class:`periodtask.notifiers.OutcomeEvent`, regardless of the
+      e-mail settings and thresholds.
+    :param str launcher: ``'popen'`` (the default) starts the process with
+      ``subprocess.Popen``, ``'posix_spawn'`` with ``os.posix_spawnp``,
+      which avoids copying the page tables of a large scheduler process
+      (glibc uses vfork semantics). Falls back to ``Popen`` when **cwd** is
+      set. Unlike ``Popen`` it does not close the inheritable file
+      descriptors of the scheduler in the child.
+    :param list upstream: Tasks (or task names) of the same
+      :py:class:`TaskList <periodtask.TaskList>` this task depends on. The
+      task runs when all of them succeeded in a DAG run (started by a task
+      without upstream tasks). If **periods** is given as well, the task
+      waits for its next matching second after that. When an upstream task
+      fails, this task is skipped in the DAG run. All the upstream tasks
+      must depend on the same root task.
+    :param func/bool mail_dag: Controls the email sent when a DAG run
+      started by this task (a task without upstream tasks) finished.
+      Otherwise it is the same as **mail_success**.
+    :param periodtask.retry.Retry retry: If given, failed runs are started
+      again after an exponential backoff. Retries follow the **policy**:
+      with ``SKIP`` a retry is dropped when a process of the task is
+      running, with ``DELAY`` it waits for it. Notifications (and
+      **failure_email_threshold**) concern the last attempt of a run only.
+    :param int max_delay_queue: The maximum number of runs waiting in the
+      delay queue (``DELAY`` policy, or waiting for a free process slot).
+      ``None`` means no limit.
+    :param int delay_overflow: What to do with a new run when the delay
+      queue is full. Available values are ``periodtask.DROP_OLDEST``,
+      ``periodtask.DROP_NEWEST`` and ``periodtask.COALESCE``.
+
+      **DROP_OLDEST**
+        The oldest waiting run is dropped (reported as skipped).
+
+      **DROP_NEWEST**
+        The new run is dropped (reported as skipped).
+
+      **COALESCE**
+        The last waiting run absorbs the new one: it will run for the
+        latest scheduled second, and the DELAYED and NO BLOCK emails tell
+        how many runs it absorbed (``coalesced``).
+    :param int priority: When the number of processes is limited
+      (``max_processes`` of :py:class:`TaskList <periodtask.TaskList>`),
+      waiting runs of tasks with higher priority start first.
+    :param periodtask.remote.WorkerPool workers: If given, the processes
+      run on the worker agents of this pool instead of the scheduler's
+      machine. **limits** and **launcher** apply to local processes only.
+      See :py:mod:`periodtask.remote`.
+    :param int max_starts_per_tick: With ``RUN`` policy every fire due in a
+      tick of the scheduler is started (with its own scheduled second), at
+      most this many of them. The rest waits in the delay queue for the
+      next ticks. ``None`` means no limit. Tasks with other policies start
+      at most one process in a tick.
+    :param periodtask.calendars.Calendar include_days: If given, the
+      **periods** match on the days of this calendar only (in the timezone
+      of the period).
+    :param periodtask.calendars.Calendar exclude_days: If given, the
+      **periods** do not match on the days of this calendar, e.g. on
+      holidays. See :py:mod:`periodtask.calendars`.
     """
+    __slots__ = (
+        'name', 'command', 'periods', 'run_on_start', 'mail_success',
+        'mail_failure', 'mail_skipped', 'mail_delayed', 'mail_timeout',
+        'mail_dag', 'wait_timeout', 'max_lines', 'stop_signal', 'policy',
+        'template_lookup', 'stdout_logger', 'stdout_level', 'stderr_logger',
+        'stderr_level', 'cwd', 'skip_delayed_email_threshold',
+        'failure_email_threshold', 'limits', 'max_runtime', 'pipe_grace',
+        'urgent', 'notifiers', 'launcher', 'retry', 'max_delay_queue',
+        'delay_overflow', 'priority', 'workers', 'max_starts_per_tick',
+        'retries', 'upstream', 'downstream', 'dag_queue', 'slots', 'digest',
+        'dispatcher', 'timers', 'clock', 'executor', 'metrics',
+        'phase_timer', 'history', 'paused', 'trigger_requested', 'tracer',
+        'current_trace', 'process_threads', 'first_check', 'delay_queue',
+        'failure_email_sent', 'skip_delayed_email_sent',
+        'stats',
+    )
+
     def __init__(
         self, name, command,
         periods='',
@@ -112,6 +236,7 @@ class Task:
         mail_failure=None,
         mail_skipped=None,
         mail_delayed=None,
+        mail_timeout=None,
         send_mail_func=None,
         wait_timeout=10,
         max_lines=50,
@@ -124,11 +249,33 @@ class Task:
         stderr_level=logging.INFO,
         cwd=None,
         skip_delayed_email_threshold=5,
-        failure_email_threshold=5
+        failure_email_threshold=5,
+        stats_window=100,
+        limits=None,
+        max_runtime=None,
+        pipe_grace=5,
+        urgent=False,
+        notifiers=[],
+        launcher=POPEN,
+        upstream=[],
+        mail_dag=None,
+        retry=None,
+        max_delay_queue=None,
+        delay_overflow=DROP_OLDEST,
+        priority=0,
+        workers=None,
+        max_starts_per_tick=None,
+        include_days=None,
+        exclude_days=None
     ):
+        if upstream and periods == '':
+            # only run when the upstream tasks succeeded
+            periods = []
         if not isinstance(periods, list) and not isinstance(periods, tuple):
             periods = [periods]
-        self.periods = [Period(x) for x in periods]
+        self.periods = [
+            Period.parse(x, include_days, exclude_days) for x in periods
+        ]
 
         self.name = name
         self.command = command
@@ -137,6 +284,8 @@ class Task:
         self.mail_failure = mail_failure
         self.mail_skipped = mail_skipped
         self.mail_delayed = mail_delayed
+        self.mail_timeout = mail_timeout
+        self.mail_dag = mail_dag
 
         if mail_success and send_mail_func:
             self.mail_success = send_mail_func
@@ -146,6 +295,10 @@ class Task:
             self.mail_skipped = send_mail_func
         if mail_delayed and send_mail_func:
             self.mail_delayed = send_mail_func
+        if mail_timeout and send_mail_func:
+            self.mail_timeout = send_mail_func
+        if mail_dag and send_mail_func:
+            self.mail_dag = send_mail_func
 
         self.wait_timeout = wait_timeout
         self.max_lines = max_lines
@@ -155,9 +308,7 @@ class Task:
             template_dir = template_dir + [default_template_dir]
         else:
             template_dir = [template_dir] + [default_template_dir]
-        self.template_lookup = TemplateLookup(
-            directories=template_dir, default_filters=['h']
-        )
+        self.template_lookup = shared_template_lookup(template_dir)
         self.stdout_logger = stdout_logger
         self.stdout_level = stdout_level
         self.stderr_logger = stderr_logger
@@ -165,43 +316,206 @@ class Task:
         self.cwd = cwd
         self.skip_delayed_email_threshold = skip_delayed_email_threshold
         self.failure_email_threshold = failure_email_threshold
+        self.limits = limits
+        self.max_runtime = max_runtime
+        self.pipe_grace = pipe_grace
+        self.urgent = urgent
+        self.notifiers = list(notifiers)
+        self.launcher = launcher
+        self.retry = retry
+        self.max_delay_queue = max_delay_queue
+        self.delay_overflow = delay_overflow
+        self.priority = priority
+        self.workers = workers
+        self.max_starts_per_tick = max_starts_per_tick
+        # (failed process thread, outcome) tuples of the due retries
+        self.retries = []
+        # resolved to tasks by TaskList
+        self.upstream = list(upstream)
+        self.downstream = []
+        # DAG runs waiting for this task
+        self.dag_queue = []
+        # the Slots of the TaskList, if any
+        self.slots = None
+        # the Digest and the Dispatcher of the TaskList, if any
+        self.digest = None
+        self.dispatcher = None
+        # the scheduler's TimerHeap and Clock, set by TaskList
+        self.timers = None
+        self.clock = SYSTEM_CLOCK
+        # if set, called instead of creating a ProcessThread (with the
+        # task, formatted_sec and sec), e.g. by a Simulation
+        self.executor = None
+        # periodtask.metrics.SchedulerMetrics of the TaskList, if any
+        self.metrics = None
+        # periodtask.profiling.PhaseTimer of the TaskList, if any
+        self.phase_timer = None
+        # recent runs of the TaskList (a deque), if any
+        self.history = None
+        self.paused = False
+        self.trigger_requested = False
+        # periodtask.tracing.Tracer of the TaskList, if any
+        self.tracer = None
+        # the RunTrace of the run being notified about
+        self.current_trace = None
 
         self.process_threads = []
         self.first_check = True
-        self.delay_queue = []
+        # (sec, formatted_sec, the number of runs absorbed by the entry)
+        self.delay_queue = collections.deque()
         # self.email_limitation_active = False
         self.failure_email_sent = 0
         self.skip_delayed_email_sent = 0
+        self.stats = TaskStats(stats_window)
 
     def check_second(self, sec):
+        if self.trigger_requested:
+            self.trigger_requested = False
+            return 'TRIGGERED'
         if self.first_check:
             self.first_check = False
             if self.run_on_start:
                 return 'START'
+        if self.paused:
+            return False
         for period in self.periods:
             chk = period._check(sec)
             if chk:
                 return chk
         return False
 
-    def start_process_thread(self, formatted_sec):
+    def next_fire(self, sec, horizon=366 * 86400):
+        """
+        Return the next second (not before ``sec``) the task is scheduled
+        for, ``None`` if there is none in ``horizon`` seconds or the task is
+        paused.
+        """
+        if self.paused:
+            return None
+        fires = [p.next_fire(sec, horizon) for p in self.periods]
+        fires = [f for f in fires if f is not None]
+        return min(fires) if fires else None
+
+    def pause(self):
+        """Do not schedule new runs until :py:meth:`resume` is called."""
+        self.paused = True
+        logger.info('task %s paused' % self.name)
+
+    def resume(self):
+        self.paused = False
+        logger.info('task %s resumed' % self.name)
+
+    def trigger(self):
+        """
+        Schedule a run for the next evaluated second, as if a period matched
+        it (the **policy** applies).
+        """
+        self.trigger_requested = True
+        logger.info('task %s triggered' % self.name)
+
+    def kill_processes(self):
+        """
+        Send **stop_signal** to the running processes and kill them after
+        **wait_timeout**. Does not wait.
+        """
+        threads = [t for t in self.process_threads if t.is_alive()]
+        for thrd in threads:
+            logger.warning('stopping process of task %s started for %s' % (
+                self.name, thrd.formatted_sec
+            ))
+            thrd.send_stop_signal()
+            if self.timers is not None:
+                self.timers.schedule(
+                    self.clock.time() + self.wait_timeout,
+                    self.kill_overrunning, thrd
+                )
+        return len(threads)
+
+    def phase(self, name):
+        if self.phase_timer is None:
+            return NO_PHASE
+        return self.phase_timer.phase(name)
+
+    def can_start(self):
+        return self.slots is None or self.slots.available()
+
+    def start_process_thread(
+        self, formatted_sec, sec=None, dag_run=None, attempt=1
+    ):
+        with self.phase('start'):
+            self._start_process_thread(formatted_sec, sec, dag_run, attempt)
+
+    def _start_process_thread(
+        self, formatted_sec, sec=None, dag_run=None, attempt=1
+    ):
         msg = 'task %s starts process for %s' % (self.name, formatted_sec)
+        if attempt > 1:
+            msg += ' (attempt %s)' % attempt
         logger.info(msg)
-        thrd = ProcessThread(
-            self.name,
-            self.command,
-            self.stop_signal,
-            self.wait_timeout,
-            formatted_sec,
-            self.max_lines,
-            self.stdout_logger,
-            self.stdout_level,
-            self.stderr_logger,
-            self.stderr_level,
-            self.cwd,
-        )
+        trace = env = None
+        if self.tracer is not None:
+            trace = self.tracer.start_run(self.name, sec, formatted_sec)
+            env = trace.env()
+        if self.executor is not None:
+            thrd = self.executor(self, formatted_sec, sec)
+        elif self.workers is not None:
+            thrd = self.workers.submit(self, formatted_sec, sec, trace)
+        else:
+            thrd = ProcessThread(
+                self.name,
+                self.command,
+                self.stop_signal,
+                self.wait_timeout,
+                formatted_sec,
+                self.max_lines,
+                self.stdout_logger,
+                self.stdout_level,
+                self.stderr_logger,
+                self.stderr_level,
+                self.cwd,
+                sec=sec,
+                limits=self.limits,
+                pipe_grace=self.pipe_grace,
+                env=env,
+                launcher=self.launcher,
+            )
+        thrd.trace = trace
+        thrd.attempt = attempt
+        if dag_run is None and self.downstream and not self.upstream:
+            dag_run = DagRun(self, formatted_sec)
+        elif dag_run is not None:
+            dag_run.task_started(self)
+        thrd.dag_run = dag_run
+        if self.slots is not None:
+            self.slots.acquire()
         self.process_threads.append(thrd)
         thrd.start()
+        if self.metrics is not None and sec is not None:
+            lag = max(0, self.clock.time() - sec)
+            self.metrics.scheduling_lag.labels(self.name).observe(lag)
+            self.metrics.queue_wait.labels(str(self.priority)).observe(lag)
+        if self.max_runtime is not None and self.timers is not None:
+            thrd.deadline = self.timers.schedule(
+                self.clock.time() + self.max_runtime,
+                self.enforce_max_runtime, thrd
+            )
+
+    def enforce_max_runtime(self, thrd):
+        if not thrd.is_alive():
+            return
+        logger.warning('task %s started for %s exceeded max_runtime (%ss)' % (
+            self.name, thrd.formatted_sec, self.max_runtime
+        ))
+        thrd.timed_out = True
+        thrd.send_stop_signal()
+        thrd.deadline = self.timers.schedule(
+            self.clock.time() + self.wait_timeout, self.kill_overrunning,
+            thrd
+        )
+
+    def kill_overrunning(self, thrd):
+        if thrd.is_alive():
+            thrd.kill()
 
     def send_mail_template(
         self, send_func,
@@ -217,6 +531,75 @@ class Task:
         html = html.render(**kwargs)
         send_func(subject, text, html_message=html)
 
+    def emit(self, kind, formatted_sec, subproc=None):
+        if self.metrics is not None:
+            self.metrics.outcomes.labels(self.name, kind).inc()
+        if self.digest is not None:
+            # every outcome is summarized, the thresholds only limit the
+            # immediate notifications
+            send_func = getattr(self, 'mail_%s' % kind)
+            if kind == 'timeout':
+                send_func = send_func or self.mail_failure
+            if not callable(send_func):
+                # not set, or True: the default function of the digest
+                send_func = self.digest.send_mail_func
+            if send_func:
+                self.digest.add(
+                    send_func, self, kind, subproc=subproc,
+                    current_sec=formatted_sec
+                )
+        if not self.notifiers:
+            return
+        event = OutcomeEvent(kind, self.name, formatted_sec, subproc)
+        for notifier in self.notifiers:
+            notifier.emit(event)
+
+    def notify(self, typ, send_func, **kwargs):
+        """
+        Send the ``typ`` notification (``success``, ``failure``, ``timeout``,
+        ``recover``, ``skipped``, ``delayed`` or ``noblock``) with
+        ``send_func``, or add it to the digest of the task list.
+        """
+        with self.phase('mail'):
+            trace = self.current_trace
+            if trace is None:
+                self._notify(typ, send_func, None, kwargs)
+                return
+            trace.notify_started()
+            handed_off = ok = False
+            try:
+                handed_off = self._notify(
+                    typ, send_func, trace.notify_done, kwargs
+                )
+                ok = True
+            finally:
+                if not handed_off:
+                    trace.notify_done(ok)
+
+    def _notify(self, typ, send_func, on_done, kwargs):
+        # returns True if on_done will be called by the dispatcher
+        if self.digest is not None:
+            if typ not in OUTCOMES:
+                # recover and noblock, outcomes are added by emit()
+                self.digest.add(send_func, self, typ, **kwargs)
+            if not (self.urgent and typ in ('failure', 'timeout')):
+                return False
+        if self.dispatcher is not None:
+            self.dispatcher.submit(
+                self.template_lookup, send_func, typ,
+                dict((k, snapshot(v)) for k, v in kwargs.items()),
+                on_done=on_done
+            )
+            return on_done is not None
+        self.send_mail_template(
+            send_func,
+            '%s_subject.txt' % typ,
+            '%s.txt' % typ,
+            '%s.html' % typ,
+            **kwargs
+        )
+        return False
+
     def check_subprocesses(self):
         if not self.process_threads:
             return
@@ -226,70 +609,275 @@ class Task:
             if subproc.is_alive():
                 new_process_threads.append(subproc)
                 continue
+            if subproc.deadline is not None:
+                self.timers.cancel(subproc.deadline)
+            if self.slots is not None:
+                self.slots.release()
             retcode = subproc.returncode
             msg = 'task %s started for %s terminated with code %s'
             msg = msg % (self.name, subproc.formatted_sec, retcode)
+            if subproc.result is not None:
+                self.stats.add(subproc.result)
+                msg += ' (%s)' % subproc.result
+            if self.metrics is not None:
+                self.metrics.run_finished(self.name, subproc)
             logger.info(msg)
-
-            if retcode == 0:
-                if self.mail_success:
-                    self.send_mail_template(
-                        self.mail_success,
-                        'success_subject.txt',
-                        'success.txt',
-                        'success.html',
-                        subproc=subproc
-                    )
-                if (
-                    self.mail_failure and
-                    self.failure_email_threshold is not None and
-                    self.failure_email_sent >= self.failure_email_threshold
-                ):
-                    self.send_mail_template(
-                        self.mail_failure,
-                        'recover_subject.txt',
-                        'recover.txt',
-                        'recover.html',
-                        task=self,
-                        subproc=subproc
-                    )
-                self.failure_email_sent = 0
+            if subproc.limit_breach:
+                logger.warning('task %s started for %s: %s' % (
+                    self.name, subproc.formatted_sec, subproc.limit_breach
+                ))
+            if subproc.timed_out:
+                self.stats.timeouts += 1
+                outcome = 'timeout'
+            elif retcode == 0 and not subproc.limit_breach:
+                outcome = 'success'
             else:
-                if (
-                    self.mail_failure and (
-                        self.failure_email_threshold is None or
-                        self.failure_email_sent <
-                        self.failure_email_threshold
-                    )
-                ):
-                    self.failure_email_sent += 1
-                    self.send_mail_template(
-                        self.mail_failure,
-                        'failure_subject.txt',
-                        'failure.txt',
-                        'failure.html',
-                        subproc=subproc
-                    )
+                outcome = 'failure'
+            self.emit(outcome, subproc.formatted_sec, subproc)
+            if self.history is not None:
+                self.history.append({
+                    'task': self.name,
+                    'scheduled': subproc.formatted_sec,
+                    'outcome': outcome,
+                    'returncode': retcode,
+                    'started': subproc.start_time,
+                    'duration':
+                        subproc.result.duration if subproc.result else None,
+                    'limit_breach': subproc.limit_breach,
+                    'attempt': subproc.attempt,
+                })
+
+            trace = subproc.trace
+            if trace is not None:
+                trace.run_finished(subproc, outcome)
+            if outcome != 'success' and self.schedule_retry(subproc, outcome):
+                if trace is not None:
+                    trace.close()
+                continue
+            self.current_trace = trace
+            self.finish_run(subproc, outcome)
+            self.current_trace = None
+            if trace is not None:
+                trace.close()
 
         self.process_threads = new_process_threads
 
+    def finish_run(self, subproc, outcome):
+        """Send the notifications about the last attempt of a run."""
+        if outcome == 'success':
+            if self.mail_success:
+                self.notify(
+                    'success', self.mail_success,
+                    subproc=subproc,
+                    stats=self.stats
+                )
+            if (
+                self.mail_failure and
+                self.failure_email_threshold is not None and
+                self.failure_email_sent >= self.failure_email_threshold
+            ):
+                self.notify(
+                    'recover', self.mail_failure,
+                    task=self,
+                    subproc=subproc
+                )
+            self.failure_email_sent = 0
+        else:
+            send_func = self.mail_failure
+            if outcome == 'timeout':
+                send_func = self.mail_timeout or self.mail_failure
+            if (
+                send_func and (
+                    self.failure_email_threshold is None or
+                    self.failure_email_sent <
+                    self.failure_email_threshold
+                )
+            ):
+                self.failure_email_sent += 1
+                self.notify(
+                    outcome, send_func,
+                    subproc=subproc,
+                    stats=self.stats
+                )
+        if subproc.dag_run is not None:
+            subproc.dag_run.task_finished(self, outcome, subproc)
+
+    def schedule_retry(self, subproc, outcome):
+        """
+        Schedule the next attempt of a failed run if **retry** allows it,
+        return whether it did.
+        """
+        if (
+            self.retry is None or self.timers is None or
+            not self.retry.should_retry(
+                subproc.attempt, outcome, subproc.returncode
+            )
+        ):
+            return False
+        delay = self.retry.delay(subproc.attempt)
+        logger.warning(
+            'task %s started for %s: attempt %s of %s failed, retrying in '
+            '%.1fs' % (
+                self.name, subproc.formatted_sec, subproc.attempt,
+                self.retry.max_attempts, delay
+            )
+        )
+        self.timers.schedule(
+            self.clock.time() + delay, self.retries.append, (subproc, outcome)
+        )
+        return True
+
+    def check_retries(self):
+        """
+        Start a due retry if the **policy** and the free slots allow it,
+        return whether a process was started.
+        """
+        if not self.retries or self.paused:
+            return False
+        if self.process_threads and self.policy != RUN:
+            if self.policy == DELAY:
+                return False
+            # SKIP: the runs are over
+            for subproc, outcome in self.retries:
+                logger.warning('retry of task %s for %s skipped' % (
+                    self.name, subproc.formatted_sec
+                ))
+                self.emit('skipped', subproc.formatted_sec)
+                self.finish_run(subproc, outcome)
+            self.retries = []
+            return False
+        if not self.can_start():
+            return False
+        subproc, _ = self.retries.pop(0)
+        self.start_process_thread(
+            subproc.formatted_sec, subproc.sec, subproc.dag_run,
+            subproc.attempt + 1
+        )
+        return True
+
     def skipped_or_delayed(self, formatted_sec, typ='skipped'):
         if getattr(self, 'mail_%s' % typ):
-            self.send_mail_template(
-                getattr(self, 'mail_%s' % typ),
-                '%s_subject.txt' % typ,
-                '%s.txt' % typ,
-                '%s.html' % typ,
+            self.notify(
+                typ, getattr(self, 'mail_%s' % typ),
                 running=self.process_threads,
                 current_sec=formatted_sec,
                 task_name=self.name,
-                delay_queue=self.delay_queue
+                delay_queue=[f for _, f, _ in self.delay_queue],
+                coalesced=self.delay_queue[-1][2] if self.delay_queue else 0
             )
 
+    def queue_run(self, sec, formatted_sec):
+        """
+        Put a scheduled run into the delay queue, respecting
+        **max_delay_queue**. Return ``formatted_sec``, or ``None`` if the
+        run was dropped.
+        """
+        if (
+            self.max_delay_queue is None or self.policy == SKIP or
+            len(self.delay_queue) < self.max_delay_queue
+        ):
+            self.delay_queue.append((sec, formatted_sec, 0))
+            return formatted_sec
+        if self.delay_overflow == COALESCE:
+            absorbed = self.delay_queue[-1][2]
+            self.delay_queue[-1] = (sec, formatted_sec, absorbed + 1)
+            return formatted_sec
+        if self.delay_overflow == DROP_NEWEST:
+            dropped = formatted_sec
+            formatted_sec = None
+        else:
+            _, dropped, _ = self.delay_queue.popleft()
+            self.delay_queue.append((sec, formatted_sec, 0))
+        logger.warning('task %s skipped for %s (delay queue is full)' % (
+            self.name, dropped
+        ))
+        self.emit('skipped', dropped)
+        return formatted_sec
+
+    def waiting_runs(self):
+        """The number of runs waiting to start."""
+        return len(self.delay_queue) + len(self.dag_queue) + len(self.retries)
+
+    def waiting_since(self, now):
+        """
+        The scheduled second of the oldest run waiting to start, ``None`` if
+        there is none.
+        """
+        secs = []
+        if self.delay_queue:
+            secs.append(self.delay_queue[0][0])
+        if self.dag_queue:
+            secs.append(self.dag_queue[0].started)
+        if self.retries:
+            secs.append(self.retries[0][0].sec or now)
+        if self.trigger_requested and self.upstream:
+            secs.append(now)
+        return min(secs) if secs else None
+
+    def admit(self, now):
+        """Start waiting runs if possible, return whether it did."""
+        if self.retries and self.check_retries():
+            return True
+        if self.upstream:
+            return self.check_dag_second(now)
+        if self.policy == RUN:
+            return self.start_batch() > 0
+        return self.start_queued()
+
+    def check_dag_second(self, sec):
+        if self.process_threads or not self.can_start():
+            return
+        if self.trigger_requested:
+            self.trigger_requested = False
+            self.start_process_thread('TRIGGERED', sec)
+            return True
+        if not self.dag_queue or self.paused:
+            return
+        if self.periods and not any(p._check(sec) for p in self.periods):
+            return
+        dag_run = self.dag_queue.pop(0)
+        self.start_process_thread(dag_run.formatted_sec, sec, dag_run)
+        return True
+
+    def check_for_seconds(self, seconds):
+        """
+        Evaluate the ``seconds`` of a tick, return the number of processes
+        started.
+        """
+        if self.policy != RUN or self.upstream:
+            for sec in seconds:
+                # only one process of a task can be started in one tick
+                if self.check_for_second(sec):
+                    return 1
+            return 0
+        # queue every due fire, then start them together
+        for sec in seconds:
+            formatted_sec = self.check_second(sec)
+            if formatted_sec:
+                self.queue_run(sec, formatted_sec)
+        return self.start_batch()
+
+    def start_batch(self):
+        """
+        Start waiting runs (``RUN`` policy) up to **max_starts_per_tick**,
+        return the number of processes started.
+        """
+        started = 0
+        while (
+            self.max_starts_per_tick is None or
+            started < self.max_starts_per_tick
+        ):
+            if not self.start_queued():
+                break
+            started += 1
+        return started
+
     def check_for_second(self, sec):
+        if self.upstream:
+            return self.check_dag_second(sec)
         formatted_sec = self.check_second(sec)
         if formatted_sec:
-            self.delay_queue.append(formatted_sec)
+            formatted_sec = self.queue_run(sec, formatted_sec)
 
         if self.process_threads:
             if self.policy == SKIP:
@@ -300,6 +888,7 @@ class Task:
                     self.name, 'skipped', formatted_sec
                 )
                 logger.warning(msg)
+                self.emit('skipped', formatted_sec)
 
                 # do we need to send a skip e-mail?
                 if (
@@ -318,6 +907,7 @@ class Task:
                     self.name, 'delayed', formatted_sec
                 )
                 logger.warning(msg)
+                self.emit('delayed', formatted_sec)
 
                 # do we need to send a delayed e-mail?
                 if (
@@ -329,35 +919,57 @@ class Task:
                     self.skip_delayed_email_sent += 1
                 return
 
-        if self.delay_queue:
-            self.start_process_thread(self.delay_queue.pop(0))
-            if (
-                not self.delay_queue and
-                self.skip_delayed_email_threshold is not None and
-                self.skip_delayed_email_sent >=
-                self.skip_delayed_email_threshold
+        if self.delay_queue and not self.can_start():
+            # waiting for a free slot, but with SKIP only one run may wait
+            if self.policy == SKIP and formatted_sec and (
+                len(self.delay_queue) > 1
             ):
-                func = None
-                if self.policy == SKIP:
-                    func = self.mail_skipped
-                elif self.policy == DELAY:
-                    func = self.mail_delayed
-                if func:
-                    self.send_mail_template(
-                        func,
-                        'noblock_subject.txt',
-                        'noblock.txt',
-                        'noblock.html',
-                        task=self
-                    )
-            self.skip_delayed_email_sent = 0
-            return True
+                self.delay_queue.pop()
+                logger.warning('task %s skipped for %s (no free slot)' % (
+                    self.name, formatted_sec
+                ))
+                self.emit('skipped', formatted_sec)
+            return
+
+        return self.start_queued()
+
+    def start_queued(self):
+        """Start the oldest run of the delay queue if possible."""
+        if not self.delay_queue or not self.can_start():
+            return
+        if self.process_threads and self.policy != RUN:
+            return
+        queued_sec, queued_formatted_sec, coalesced = (
+            self.delay_queue.popleft()
+        )
+        if coalesced:
+            logger.info('task %s run for %s absorbed %s run(s)' % (
+                self.name, queued_formatted_sec, coalesced
+            ))
+        self.start_process_thread(queued_formatted_sec, queued_sec)
+        if (
+            not self.delay_queue and
+            self.skip_delayed_email_threshold is not None and
+            self.skip_delayed_email_sent >=
+            self.skip_delayed_email_threshold
+        ):
+            func = None
+            if self.policy == SKIP:
+                func = self.mail_skipped
+            elif self.policy == DELAY:
+                func = self.mail_delayed
+            if func:
+                self.notify(
+                    'noblock', func,
+                    task=self,
+                    coalesced=coalesced
+                )
+        self.skip_delayed_email_sent = 0
+        return True
 
-    def stop(self, check_subprocesses=True):
+    def stop(self, check_subprocesses=True, deadline=None):
         if self.process_threads:
-            for proc in self.process_threads:
-                proc.stop()
-                proc.join()
+            stop_threads(self.process_threads, deadline)
             if check_subprocesses:
                 self.check_subprocesses()
         logger.info('task stopped: %s' % self.name)
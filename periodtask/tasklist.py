@@ -1,8 +1,18 @@
+import collections
 import logging
 import time
 import threading
 import signal
 
+from .timers import TimerHeap
+from .process_thread import stop_threads
+from .metrics import SchedulerMetrics
+from .profiling import PhaseTimer, TickProfile, NO_PHASE
+from .slots import Slots
+from .clock import SYSTEM_CLOCK
+from . import dag
+from . import mailsender
+
 
 logger = logging.getLogger('periodtask.tasklist')
 
@@ -12,23 +22,186 @@ class TaskList:
     Defines the tasks to run and starts the sceduler.
     Pass in :py:class:`Task <periodtask.Task>` instances
     to schedule.
+
+    :param number stop_timeout: The time budget of shutdown in seconds. The
+      stop signal is sent to all running processes at once, each process is
+      waited for at most its ``wait_timeout`` (but not after the budget is
+      spent), then the remaining ones are killed and waited for at most
+      ``KILL_GRACE`` seconds more (see
+      :py:func:`stop_threads <periodtask.process_thread.stop_threads>`).
+      E-mails still being sent are waited for until the budget is spent.
+      Defaults to the longest ``wait_timeout`` plus 5 seconds.
+    :param periodtask.digest.Digest digest: If given, notifications of the
+      tasks are collected and sent as periodic summaries.
+    :param periodtask.dispatcher.Dispatcher dispatcher: If given,
+      notifications are rendered and sent from its worker thread, the
+      scheduler only queues them.
+    :param list notifiers: :py:class:`periodtask.notifiers.Notifier`
+      instances added to the ``notifiers`` of every task.
+    :param periodtask.metrics.Registry metrics: If given, scheduler health
+      metrics (tick duration, scheduling lag, run durations, outcomes,
+      running processes, queue depths) are registered in it. Expose them
+      with :py:class:`periodtask.metrics.MetricsServer` or
+      :py:class:`periodtask.metrics.TextfileWriter`.
+    :param list tick_hooks: :py:class:`periodtask.profiling.TickHook`
+      instances, notified at the start and at the end of every tick with
+      the time spent in each phase of the tick.
+    :param str control_socket: If given, a control API is served on this
+      Unix socket while the scheduler runs: task list with next fire times,
+      running processes, delay queues, recent runs, and triggering,
+      pausing, resuming or stopping tasks. See
+      :py:mod:`periodtask.control`.
+    :param int history_size: The number of recent runs kept in memory (in
+      ``history``).
+    :param periodtask.tracing.Tracer tracer: If given, a trace is recorded
+      for every run (queueing, process, output drain and notification
+      spans), and the processes get its ID in ``TRACEPARENT``.
+    :param int max_processes: If given, at most this many processes of the
+      tasks run at the same time. Runs not started for lack of a free slot
+      wait in the delay queue of their task (with ``SKIP`` policy at most
+      one), independent branches of DAG runs share the slots. The due runs
+      of a tick are collected first, then the waiting runs are started in
+      the order of the ``priority`` of their tasks.
+    :param number aging: If given, the priority of a waiting run grows by
+      one every ``aging`` seconds it waits, so that runs of low priority
+      tasks start eventually.
+    :param periodtask.clock.Clock clock: The clock of the scheduler, the
+      system clock by default. See
+      :py:class:`periodtask.simulation.Simulation`.
     """
-    def __init__(self, *args):
+    def __init__(
+        self, *args, stop_timeout=None, digest=None, dispatcher=None,
+        notifiers=[], metrics=None, tick_hooks=[], control_socket=None,
+        history_size=100, tracer=None, max_processes=None, aging=None,
+        clock=None
+    ):
         self.tasks = args
+        dag.resolve(self.tasks)
+        if stop_timeout is None:
+            stop_timeout = max(
+                [task.wait_timeout for task in args] + [0]
+            ) + 5
+        self.stop_timeout = stop_timeout
         self.last_checked = None
         self.stopped = False
         self.orig_sigint_handler = None
         self.orig_sigterm_handler = None
-
-    def _tick(self):
-        now = int(time.time())
+        self.timers = TimerHeap()
+        self.clock = clock or SYSTEM_CLOCK
+        self.digest = digest
+        self.dispatcher = dispatcher
+        if digest is not None:
+            digest.dispatcher = dispatcher
+            digest.clock = self.clock
+        for task in self.tasks:
+            task.timers = self.timers
+            task.clock = self.clock
+            task.digest = digest
+            task.dispatcher = dispatcher
+            task.notifiers.extend(notifiers)
+        self.notifiers = list(notifiers)
+        self.stop_request = None
+        self.metrics = None
+        if metrics is not None:
+            self.metrics = SchedulerMetrics(metrics, self)
+            for task in self.tasks:
+                task.metrics = self.metrics
+        self.history = collections.deque(maxlen=history_size)
+        self.tracer = tracer
         for task in self.tasks:
-            task.check_subprocesses()
-            for sec in range(self.last_checked + 1, now + 1):
-                # Only one process of a task can be started in one tick
-                if task.check_for_second(sec):
-                    break
+            task.history = self.history
+            task.tracer = tracer
+        # higher priority first, keeping the order of tasks otherwise
+        self.by_priority = sorted(self.tasks, key=lambda t: -t.priority)
+        self.aging = aging
+        self.slots = None
+        if max_processes is not None:
+            self.slots = Slots(max_processes)
+            for task in self.tasks:
+                task.slots = self.slots
+        # the WorkerPools of the tasks, started with the scheduler
+        self.worker_pools = []
+        for task in self.tasks:
+            if task.workers is not None and (
+                task.workers not in self.worker_pools
+            ):
+                self.worker_pools.append(task.workers)
+        self.control_socket = control_socket
+        self.control = None
+        self.tick_hooks = list(tick_hooks)
+        self.phase_timer = None
+        if self.tick_hooks:
+            self.phase_timer = PhaseTimer()
+            for task in self.tasks:
+                task.phase_timer = self.phase_timer
+
+    def phase(self, name):
+        if self.phase_timer is None:
+            return NO_PHASE
+        return self.phase_timer.phase(name)
+
+    def _tick(self, tasks=None):
+        # ``tasks``: evaluate only these (a Simulation knows which are due)
+        if tasks is None:
+            tasks = self.by_priority
+        now = self.clock.time()
+        started = time.time()
+        if self.phase_timer is not None:
+            self.phase_timer.reset()
+            for hook in self.tick_hooks:
+                hook.tick_started(now)
+        if self.control is not None:
+            self.control.apply_pending()
+        with self.phase('timers'):
+            self.timers.run_due(now)
+        now = int(now)
+        with self.phase('check_subprocesses'):
+            for task in tasks:
+                task.check_subprocesses()
+        seconds = range(self.last_checked + 1, now + 1)
+        with self.phase('periods'):
+            if self.slots is not None:
+                # collect the due runs, then admit them by priority
+                self.slots.held = True
+            for task in tasks:
+                if task.retries:
+                    task.check_retries()
+                task.check_for_seconds(seconds)
+            if self.slots is not None:
+                self.slots.held = False
+                self.admit(now)
         self.last_checked = now
+        if self.digest is not None:
+            with self.phase('mail'):
+                self.digest.tick(now)
+        duration = time.time() - started
+        if self.metrics is not None:
+            self.metrics.tick_duration.observe(duration)
+        if self.phase_timer is not None:
+            profile = TickProfile(
+                started, duration, self.phase_timer.times, len(seconds)
+            )
+            for hook in self.tick_hooks:
+                hook.tick_finished(profile)
+
+    def priority(self, task, since, now):
+        """The priority of a run of ``task`` waiting since ``since``."""
+        if not self.aging:
+            return task.priority
+        return task.priority + max(0, now - since) / self.aging
+
+    def admit(self, now):
+        """Start waiting runs in priority order while there are free slots."""
+        waiting = []
+        for i, task in enumerate(self.tasks):
+            since = task.waiting_since(now)
+            if since is not None:
+                waiting.append((-self.priority(task, since, now), since, i))
+        waiting.sort()
+        for _, _, i in waiting:
+            if not self.slots.available():
+                break
+            self.tasks[i].admit(now)
 
     def start(self):
         """
@@ -44,17 +217,68 @@ class TaskList:
         signal.signal(signal.SIGINT, handler)
         signal.signal(signal.SIGTERM, handler)
 
-        self.last_checked = int(time.time()) - 1
+        if self.control_socket is not None:
+            # imported here, so that the client can run as
+            # ``python -m periodtask.control``
+            from .control import ControlServer
+            self.control = ControlServer(self, self.control_socket)
+            self.control.start()
+
+        for pool in self.worker_pools:
+            pool.start()
+
+        self.last_checked = int(self.clock.time()) - 1
         while not self.stopped:
             self._tick()
-            time.sleep(0.5)
+            if self.stop_request is not None:
+                self._stop(*self.stop_request)
+                break
+            self.clock.sleep(0.5)
 
     def _stop(self, check_subprocesses=True):
-        signal.signal(signal.SIGINT, self.orig_sigint_handler)
-        signal.signal(signal.SIGTERM, self.orig_sigterm_handler)
+        if threading.current_thread() is not threading.main_thread():
+            # e.g. from a notification sent by the Dispatcher, the main
+            # thread will stop after its current tick
+            self.stop_request = (check_subprocesses,)
+            return
+        if self.orig_sigint_handler is not None:
+            signal.signal(signal.SIGINT, self.orig_sigint_handler)
+            signal.signal(signal.SIGTERM, self.orig_sigterm_handler)
         self.stopped = True
+        deadline = time.time() + self.stop_timeout
+
+        threads = [t for task in self.tasks for t in task.process_threads]
+        if threads:
+            stop_threads(threads, deadline)
         for task in self.tasks:
-            task.stop(check_subprocesses)
+            if check_subprocesses:
+                task.check_subprocesses()
+            logger.info('task stopped: %s' % task.name)
+        for pool in self.worker_pools:
+            pool.close()
+
+        # e-mails may still be on their way
+        if self.digest is not None:
+            self.digest.flush()
+        if self.dispatcher is not None:
+            self.dispatcher.flush(timeout=max(0, deadline - time.time()))
+        notifiers = set(n for task in self.tasks for n in task.notifiers)
+        for notifier in notifiers:
+            notifier.flush(timeout=max(0, deadline - time.time()))
+        if self.tracer is not None:
+            self.tracer.flush(timeout=max(0, deadline - time.time()))
+        mailsender.flush_all(deadline)
+        for hook in self.tick_hooks:
+            hook.close()
+        if self.control is not None:
+            self.control.close()
         for thread in threading.enumerate():
-            if thread != threading.main_thread():
-                thread.join()
+            if (
+                thread is threading.main_thread() or
+                thread is threading.current_thread() or
+                thread.daemon
+            ):
+                continue
+            thread.join(timeout=max(0, deadline - time.time()))
+            if thread.is_alive():
+                logger.warning('thread %s still running' % thread.name)
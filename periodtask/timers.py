@@ -0,0 +1,45 @@
+import heapq
+import itertools
+
+
+class TimerHeap:
+    """
+    Deadlines of the scheduler, kept in a single heap.
+
+    The heap is not thread safe, it is meant to be used from the scheduler
+    thread only: callbacks are scheduled from the tick and run by
+    :py:meth:`run_due` in a later tick.
+    """
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, due, func, *args):
+        """Call ``func(*args)`` in the first tick at or after ``due``."""
+        entry = [due, next(self._counter), func, args]
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        # removing from the middle of a heap is expensive, the entry is
+        # dropped when it reaches the top
+        entry[2] = None
+
+    @property
+    def next_due(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now):
+        """The callbacks due at ``now``, without running them."""
+        return [e[2] for e in self._heap if e[0] <= now and e[2] is not None]
+
+    def run_due(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            _, _, func, args = heapq.heappop(self._heap)
+            if func is not None:
+                func(*args)
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+
+from .notifiers import Notifier
+
+
+logger = logging.getLogger('periodtask.tracing')
+
+# OTLP span status codes
+(STATUS_OK, STATUS_ERROR) = (1, 2)
+# OTLP span kind: internal
+KIND_INTERNAL = 1
+
+
+def _nano(ts):
+    return str(int(ts * 1e9))
+
+
+def _attributes(attrs):
+    result = []
+    for key, value in attrs.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = {'boolValue': value}
+        elif isinstance(value, int):
+            value = {'intValue': str(value)}
+        elif isinstance(value, float):
+            value = {'doubleValue': value}
+        else:
+            value = {'stringValue': str(value)}
+        result.append({'key': key, 'value': value})
+    return result
+
+
+def trace_id(task_name, sec, formatted_sec):
+    """
+    The trace ID of a run: derived from the task name and the scheduled
+    second, so it can be computed from the logs as well.
+    """
+    key = '%s\0%s\0%s' % (task_name, sec, formatted_sec)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+class RunTrace:
+    """
+    The spans of one run of a task. The root span (``run``) lasts from the
+    scheduled second until the notifications are sent, its children are
+    ``queue`` (waiting for the start, e.g. in the delay queue),
+    ``process`` (until the process exited), ``drain`` (until its output was
+    closed) and ``notify``.
+    """
+    def __init__(self, tracer, task_name, sec, formatted_sec):
+        self.tracer = tracer
+        self.task_name = task_name
+        self.sec = sec
+        self.formatted_sec = formatted_sec
+        self.trace_id = trace_id(task_name, sec, formatted_sec)
+        self.span_id = new_span_id()
+        self.process_span_id = new_span_id()
+        self.attributes = {}
+        self.status = STATUS_OK
+        self.checked = None
+        self.notify_start = self.notify_end = None
+        self.notify_failed = False
+        self.pending = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    @property
+    def traceparent(self):
+        """W3C ``traceparent`` of the process span."""
+        return '00-%s-%s-01' % (self.trace_id, self.process_span_id)
+
+    def env(self, base=None):
+        """The environment of the process, with ``TRACEPARENT`` set."""
+        env = dict(os.environ if base is None else base)
+        env['TRACEPARENT'] = self.traceparent
+        return env
+
+    def span(self, name, start, end, span_id=None, **attrs):
+        self.tracer.export({
+            'traceId': self.trace_id,
+            'spanId': span_id or new_span_id(),
+            'parentSpanId': self.span_id,
+            'name': name,
+            'kind': KIND_INTERNAL,
+            'startTimeUnixNano': _nano(start),
+            'endTimeUnixNano': _nano(max(start, end)),
+            'attributes': _attributes(attrs),
+        })
+
+    def run_finished(self, thrd, outcome):
+        """Export the spans of the process, called when it is noticed."""
+        self.checked = time.time()
+        result = thrd.result
+        started = thrd.start_time or self.checked
+        exited = result.finished if result is not None else self.checked
+        closed = thrd.output_closed or exited
+        self.attributes = {
+            'periodtask.task': self.task_name,
+            'periodtask.scheduled': self.formatted_sec,
+            'periodtask.outcome': outcome,
+            'process.exit_code': thrd.returncode,
+            'process.pid': thrd.proc.pid if thrd.proc is not None else None,
+            'periodtask.limit_breach': thrd.limit_breach,
+        }
+        if outcome != 'success':
+            self.status = STATUS_ERROR
+        start = self.sec if self.sec is not None else started
+        self.span('queue', start, started)
+        self.span(
+            'process', started, exited, span_id=self.process_span_id,
+            **{
+                'process.command': ' '.join(thrd.command),
+                'process.exit_code': thrd.returncode,
+            }
+        )
+        self.span(
+            'drain', min(exited, closed), max(exited, closed),
+            **{'periodtask.output_lines': thrd.line_count}
+        )
+
+    def notify_started(self):
+        with self.lock:
+            self.pending += 1
+            if self.notify_start is None:
+                self.notify_start = time.time()
+
+    def notify_done(self, ok=True):
+        """Called when a notification was sent (maybe from another thread)."""
+        with self.lock:
+            self.pending -= 1
+            self.notify_end = time.time()
+            if not ok:
+                self.notify_failed = True
+            finish = self.closed and self.pending == 0
+        if finish:
+            self._finish()
+
+    def close(self):
+        """No more notifications will be started."""
+        with self.lock:
+            self.closed = True
+            finish = self.pending == 0
+        if finish:
+            self._finish()
+
+    def _finish(self):
+        end = self.checked or time.time()
+        if self.notify_start is not None:
+            self.span(
+                'notify', self.notify_start, self.notify_end,
+                **{'periodtask.notify_failed': self.notify_failed}
+            )
+            end = max(end, self.notify_end)
+        start = self.sec if self.sec is not None else end
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': '',
+            'name': 'run %s' % self.task_name,
+            'kind': KIND_INTERNAL,
+            'startTimeUnixNano': _nano(start),
+            'endTimeUnixNano': _nano(max(start, end)),
+            'attributes': _attributes(self.attributes),
+            'status': {'code': self.status},
+        }
+        self.tracer.export(span)
+
+
+class _RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def handleError(self, record):
+        # raised to the worker, which counts the spans as failed
+        raise
+
+
+class SpanExporter(Notifier):
+    """
+    Writes spans as OTLP JSON (one ``ExportTraceServiceRequest`` per line)
+    to ``path``, rotating it at ``max_bytes`` and keeping ``backup_count``
+    old files. Spans are batched and written from a worker thread.
+    """
+    def __init__(
+        self, path, max_bytes=10 * 1024 * 1024, backup_count=5,
+        service_name='periodtask', batch_size=512, batch_interval=1.0,
+        **kwargs
+    ):
+        kwargs['concurrency'] = 1
+        super().__init__(
+            batch_size=batch_size, batch_interval=batch_interval, **kwargs
+        )
+        self.path = path
+        self.handler = _RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, delay=True
+        )
+        self.resource = {
+            'attributes': _attributes({'service.name': service_name}),
+        }
+
+    def send_batch(self, spans):
+        line = json.dumps({
+            'resourceSpans': [{
+                'resource': self.resource,
+                'scopeSpans': [{
+                    'scope': {'name': 'periodtask'},
+                    'spans': spans,
+                }],
+            }],
+        })
+        record = logging.LogRecord(
+            'periodtask.tracing', logging.INFO, __file__, 0, line, None, None
+        )
+        self.handler.emit(record)
+
+
+class Tracer:
+    """
+    Records a trace per run of the tasks of a
+    :py:class:`TaskList <periodtask.TaskList>`. The processes get the
+    ``TRACEPARENT`` environment variable (`W3C Trace Context
+    <https://www.w3.org/TR/trace-context/>`_), so they can attach their own
+    spans to the trace.
+
+    :param str path: The OTLP JSON lines file, see :py:class:`SpanExporter`
+      for the other parameters.
+    """
+    def __init__(self, path, **kwargs):
+        self.exporter = SpanExporter(path, **kwargs)
+
+    def start_run(self, task_name, sec, formatted_sec):
+        return RunTrace(self, task_name, sec, formatted_sec)
+
+    def export(self, span):
+        self.exporter.emit(span)
+
+    def flush(self, timeout=None):
+        return self.exporter.flush(timeout)
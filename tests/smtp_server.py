@@ -0,0 +1,65 @@
+import socketserver
+import threading
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept messages from smtplib."""
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost stub')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.wfile.write(b'250-localhost\r\n')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command == 'AUTH':
+                self.reply('235 ok')
+            elif command == 'DATA':
+                if server.fail_next:
+                    server.fail_next -= 1
+                    self.reply('451 try again later')
+                    continue
+                self.reply('354 go ahead')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append(b''.join(data))
+                self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+        self.fail_next = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from . import ts
+from periodtask import Task
+from periodtask.periods import Period
+from periodtask.calendars import (
+    Calendar, weekends, annual, nth_weekday, easter
+)
+
+
+ICS = '''BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+SUMMARY:Closed
+DTSTART;VALUE=DATE:20240325
+DTEND;VALUE=DATE:20240327
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Founders
+ Day
+DTSTART;VALUE=DATE:20220610
+RRULE:FREQ=YEARLY;COUNT=3
+END:VEVENT
+END:VCALENDAR
+'''
+
+
+class CalendarTest(unittest.TestCase):
+    def test_rules(self):
+        calendar = Calendar(
+            dates=['2024-07-05'],
+            rules=[
+                easter(-2), nth_weekday(11, 'THU', 4),
+                nth_weekday(5, 'MON', -1), annual(1, 1, observed=True),
+            ]
+        )
+        for day in (
+            date(2024, 7, 5), date(2024, 3, 29), date(2025, 4, 18),
+            date(2024, 11, 28), date(2024, 5, 27),
+            # January 1, 2022 is a Saturday
+            date(2021, 12, 31),
+        ):
+            self.assertIn(day, calendar)
+        for day in (date(2024, 7, 4), date(2024, 3, 31), date(2022, 1, 1)):
+            self.assertNotIn(day, calendar)
+        self.assertEqual(
+            calendar.next_day(date(2024, 7, 6), date(2024, 12, 31)),
+            date(2024, 11, 28)
+        )
+        self.assertIsNone(
+            calendar.next_day(date(2024, 7, 6), date(2024, 11, 27))
+        )
+        # January 1, 2023 is a Sunday
+        self.assertEqual(len(list(weekends(2023))), 105)
+
+    def test_ics(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'holidays.ics')
+            with open(path, 'w') as f:
+                f.write(ICS)
+            calendar = Calendar.from_ics(path)
+        self.assertEqual(
+            [
+                d for d in (
+                    date(2024, 3, 25), date(2024, 3, 26), date(2024, 3, 27),
+                    date(2022, 6, 10), date(2024, 6, 10), date(2025, 6, 10),
+                ) if d in calendar
+            ],
+            [
+                date(2024, 3, 25), date(2024, 3, 26), date(2022, 6, 10),
+                date(2024, 6, 10),
+            ]
+        )
+
+    def test_periods(self):
+        holidays = Calendar(dates=['2018-07-11'], rules=[weekends])
+        p = Period.parse('0 0 18 * * * UTC', exclude_days=holidays)
+        self.assertIsNot(p, Period.parse('0 0 18 * * * UTC'))
+        self.assertFalse(p._check(ts('2018-07-11 18:00:00')))
+        self.assertTrue(p._check(ts('2018-07-12 18:00:00')))
+        # Wednesday is a holiday, then Saturday and Sunday
+        self.assertEqual(
+            p.next_fire(ts('2018-07-10 19:00:00')), ts('2018-07-12 18:00:00')
+        )
+        self.assertEqual(
+            p.next_fire(ts('2018-07-13 19:00:00')), ts('2018-07-16 18:00:00')
+        )
+
+        month_ends = Calendar(dates=['2018-07-31', '2018-08-31'])
+        task = Task(
+            'test_calendar', ('true',), '0 0 18 * * * Europe/Budapest',
+            include_days=month_ends
+        )
+        self.assertEqual(
+            task.next_fire(ts('2018-07-10 00:00:00')),
+            ts('2018-07-31 16:00:00')
+        )
+        self.assertEqual(
+            task.next_fire(ts('2018-07-31 17:00:00')),
+            ts('2018-08-31 16:00:00')
+        )
+        self.assertIsNone(task.next_fire(ts('2018-08-31 17:00:00')))
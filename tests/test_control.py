@@ -0,0 +1,105 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from . import ts
+from periodtask import Task, TaskList
+from periodtask.clock import VirtualClock
+from periodtask.control import request, ControlError, ControlServer
+
+
+def wait_for(func, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = func()
+        if result:
+            return result
+        time.sleep(0.1)
+    raise AssertionError('timeout')
+
+
+class ControlTest(unittest.TestCase):
+    def test_control(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'control.sock')
+        tl = TaskList(
+            Task(
+                'test_control_long', ('sleep', '30'), '0 0 0 1 1 * UTC',
+                run_on_start=True, wait_timeout=2
+            ),
+            Task('test_control_short', ('ls',), '0 0 0 1 1 * UTC'),
+            control_socket=path,
+        )
+        results = {}
+
+        def client():
+            try:
+                wait_for(lambda: os.path.exists(path))
+                results['running'] = wait_for(
+                    lambda: request(path, 'running')
+                )
+                results['tasks'] = request(path, 'tasks')
+                request(path, 'trigger', task='test_control_short')
+                results['history'] = wait_for(lambda: request(
+                    path, 'history', task='test_control_short'
+                ))
+                request(path, 'pause', task='test_control_short')
+                results['paused'] = request(path, 'tasks')[1]
+                results['kill'] = request(
+                    path, 'kill', task='test_control_long'
+                )
+                results['killed'] = wait_for(lambda: request(
+                    path, 'history', task='test_control_long', limit=1
+                ))
+                try:
+                    request(path, 'trigger', task='nonexistent')
+                except ControlError as e:
+                    results['error'] = str(e)
+                try:
+                    request(path, 'history', limit={'runs': 1})
+                except ControlError as e:
+                    results['bad_limit'] = str(e)
+                # the server still answers
+                results['after_error'] = request(path, 'tasks')
+            finally:
+                tl._stop()
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        tl.start()
+        thread.join()
+
+        self.assertFalse(os.path.exists(path))
+        running = results['running']
+        self.assertEqual(running[0]['task'], 'test_control_long')
+        self.assertTrue(running[0]['pid'] > 0)
+        tasks = results['tasks']
+        self.assertEqual(tasks[0]['running'], 1)
+        self.assertEqual(
+            tasks[1]['next_fire_formatted'][4:], '-01-01 00:00:00 UTC'
+        )
+        self.assertEqual(results['history'][0]['outcome'], 'success')
+        self.assertEqual(results['history'][0]['scheduled'], 'TRIGGERED')
+        self.assertTrue(results['paused']['paused'])
+        self.assertIsNone(results['paused']['next_fire'])
+        self.assertEqual(results['kill'], {'stopped': 1})
+        self.assertEqual(results['killed'][0]['outcome'], 'failure')
+        self.assertEqual(results['killed'][0]['returncode'], -15)
+        self.assertEqual(results['error'], 'unknown task: nonexistent')
+        self.assertIn('int()', results['bad_limit'])
+        self.assertEqual(len(results['after_error']), 2)
+
+    def test_virtual_clock(self):
+        start = ts('2018-07-10 10:15:30')
+        tl = TaskList(
+            Task('test_control_clock', ('true',), '0 * * * * * UTC'),
+            clock=VirtualClock(start),
+        )
+        server = ControlServer(tl, None)
+        task = server.cmd_tasks({})[0]
+        self.assertEqual(task['next_fire'], start + 30)
+        self.assertEqual(
+            task['next_fire_formatted'], '2018-07-10 10:16:00 UTC'
+        )
@@ -174,7 +174,7 @@ class CronTest(unittest.TestCase):
     def test_missing_lower_bound(self):
         p = Period('* * * * * -2000,2010-')
         self.assertEqual(
-            p.years, [(0, 2001, 1, False), (2010, None, 1, False)]
+            p.years, ((0, 2001, 1, False), (2010, None, 1, False))
         )
 
     def test_every_six_minutes(self):
@@ -183,3 +183,27 @@ class CronTest(unittest.TestCase):
             p._check(ts('2018-08-30 13:06:00')),
             '2018-08-30 13:06:00 UTC, THU'
         )
+
+    def test_next_fire(self):
+        p = Period('0 0 21 sun/L')
+        self.assertEqual(
+            p.next_fire(ts('2018-07-10 10:15:00')), ts('2018-07-29 21:00:00')
+        )
+        self.assertEqual(
+            p.next_fire(ts('2018-07-29 21:00:00')), ts('2018-07-29 21:00:00')
+        )
+        self.assertIsNone(
+            p.next_fire(ts('2018-07-10 10:15:00'), horizon=86400)
+        )
+        p = Period('0 30 2 * * * Europe/Budapest')
+        # 02:30 does not exist on the day of the DST change
+        self.assertEqual(
+            p.next_fire(ts('2018-03-24 02:00:00')), ts('2018-03-26 00:30:00')
+        )
+
+    def test_interned(self):
+        p = Period.parse('0 */5')
+        self.assertIs(p, Period.parse(' 0  */5 * * * * UTC'))
+        self.assertIsNot(p, Period.parse('0 */10'))
+        with self.assertRaises(BadCronFormat):
+            Period.parse('0 0 0 * * * UTC x')
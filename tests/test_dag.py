@@ -0,0 +1,91 @@
+import unittest
+
+from periodtask import Task, TaskList, DependencyError
+
+
+class DagTest(unittest.TestCase):
+    def test_resolve(self):
+        a = Task('a', ('true',), upstream=['c'])
+        b = Task('b', ('true',), upstream=[a])
+        c = Task('c', ('true',), upstream=['b'])
+        with self.assertRaisesRegex(DependencyError, 'a -> b -> c -> a'):
+            TaskList(a, b, c)
+
+        with self.assertRaisesRegex(DependencyError, 'unknown'):
+            TaskList(Task('d', ('true',), upstream=['x']))
+
+        # a join of two roots would not wait for the other root
+        with self.assertRaisesRegex(
+            DependencyError, 'join depends on several root tasks: a, b'
+        ):
+            TaskList(
+                Task('a', ('true',)), Task('b', ('true',)),
+                Task('join', ('true',), upstream=['a', 'b']),
+            )
+
+        root = Task('root', ('true',), '* * * * * -1526')
+        down = Task('down', ('true',), upstream=['root'])
+        TaskList(root, down)
+        self.assertEqual(down.upstream, [root])
+        self.assertEqual(root.downstream, [down])
+        self.assertEqual(down.periods, [])
+
+    def test_diamond(self):
+        tasklist = []
+        mails = []
+
+        def send(subject, text, html_message):
+            mails.append((subject, text))
+            tasklist[0]._stop(check_subprocesses=False)
+
+        tl = TaskList(
+            Task(
+                'root', ('true',), '* * * * * -1526', run_on_start=True,
+                mail_dag=send
+            ),
+            Task('left', ('false',), upstream=['root']),
+            Task('right', ('true',), upstream=['root']),
+            Task('join', ('true',), upstream=['left', 'right']),
+            Task('after', ('true',), upstream=['join']),
+        )
+        tasklist.append(tl)
+        tl.start()
+
+        self.assertEqual(
+            sorted((r['task'], r['outcome']) for r in tl.history),
+            [('left', 'failure'), ('right', 'success'), ('root', 'success')]
+        )
+        subject, text = mails[0]
+        self.assertEqual(
+            subject, '!!! root DAG FAILURE - started for: START'
+        )
+        self.assertIn('left: FAILURE (code 1)', text)
+        self.assertIn('join: SKIPPED', text)
+        self.assertIn('after: SKIPPED', text)
+
+    def test_max_processes(self):
+        tasklist = []
+
+        def send(subject, text, html_message):
+            tasklist[0]._stop(check_subprocesses=False)
+
+        tl = TaskList(
+            Task(
+                'root', ('true',), '* * * * * -1526', run_on_start=True,
+                mail_dag=send
+            ),
+            Task('b1', ('sleep', '0.3'), upstream=['root']),
+            Task('b2', ('sleep', '0.3'), upstream=['root']),
+            Task('b3', ('sleep', '0.3'), upstream=['root']),
+            max_processes=2
+        )
+        tasklist.append(tl)
+        tl.start()
+
+        runs = [r for r in tl.history if r['task'] != 'root']
+        self.assertEqual(len(runs), 3)
+        # the third branch waited for a free slot
+        starts = sorted(r['started'] for r in runs)
+        self.assertLess(starts[1] - starts[0], 0.3)
+        self.assertGreaterEqual(starts[2] - starts[0], 0.3)
+        self.assertEqual(tl.slots.used, 0)
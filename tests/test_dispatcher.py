@@ -0,0 +1,88 @@
+import threading
+import time
+import unittest
+
+from periodtask import Task, TaskList
+from periodtask.dag import DagRun
+from periodtask.dispatcher import (
+    Dispatcher, RunSnapshot, DROP_OLD, snapshot
+)
+
+
+class DispatcherTest(unittest.TestCase):
+    def test_notifications_off_scheduler_thread(self):
+        tasklist = []
+        sent = []
+
+        def send(subject, text, html_message):
+            sent.append((threading.current_thread().name, subject))
+            tasklist[0]._stop(check_subprocesses=False)
+
+        dispatcher = Dispatcher()
+        tl = TaskList(
+            Task(
+                'test_dispatcher',
+                ('tests/task_script.py',), '* * * * * -1526',
+                run_on_start=True,
+                mail_success=send,
+            ),
+            dispatcher=dispatcher
+        )
+        tasklist.append(tl)
+        tl.start()
+
+        self.assertEqual(sent[0][0], 'dispatcher')
+        self.assertIn('COMPLETED', sent[0][1])
+        self.assertEqual(dispatcher.stats()['sent'], 1)
+
+    def test_snapshot(self):
+        task = Task(
+            'test_snapshot', ('tests/task_script.py',), '* * * * * -1526'
+        )
+        task.start_process_thread('now')
+        thrd = task.process_threads[0]
+        thrd.join()
+        snap = RunSnapshot(thrd)
+        thrd.stdout_head.append('changed later')
+        self.assertEqual(snap.returncode, 0)
+        self.assertNotIn('changed later', snap.stdout_lines)
+
+        root = Task('test_snapshot_root', ('true',))
+        down = Task('test_snapshot_down', ('true',), upstream=[root])
+        TaskList(root, down)
+        dag = DagRun(root, 'now')
+        snap = snapshot(dag)
+        dag.nodes[down].state = 'failure'
+        dag.outcome = 'failure'
+        self.assertEqual(
+            [n.state for n in snap.node_list], ['running', 'pending']
+        )
+        self.assertIsNone(snap.outcome)
+        self.assertEqual(snap.root.name, 'test_snapshot_root')
+
+    def test_overflow(self):
+        release = threading.Event()
+        sent = []
+
+        def send(subject, text, html_message):
+            release.wait()
+            sent.append(subject)
+
+        task = Task(
+            'test_overflow', ('true',), '* * * * * -1526',
+        )
+        dispatcher = Dispatcher(queue_size=1, overflow=DROP_OLD)
+        task.dispatcher = dispatcher
+        for sec in ('1', '2', '3'):
+            task.notify(
+                'skipped', send,
+                running=[], current_sec=sec, task_name=task.name,
+                delay_queue=[]
+            )
+            time.sleep(0.1)
+        release.set()
+        self.assertTrue(dispatcher.flush(timeout=5))
+        # the first one was being sent, the second one was dropped
+        self.assertEqual(len(sent), 2)
+        self.assertIn('3', sent[1])
+        self.assertEqual(dispatcher.stats()['dropped'], 1)
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from email.message import EmailMessage
+
+from periodtask.mailsender import MailSender, Spool
+from .smtp_server import SMTPServer
+
+
+class MailSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.spool_dir)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def spooled(self, sub):
+        return os.listdir(os.path.join(self.spool_dir, sub))
+
+    def sender(self, **kwargs):
+        return MailSender(
+            '127.0.0.1', self.server.port, 'from@example.com',
+            'to@example.com', username='user', password='secret', **kwargs
+        )
+
+    def test_thread_per_message(self):
+        sender = self.sender()
+        for i in range(3):
+            sender.send_mail('subject %s' % i, 'text')
+        for i in range(50):
+            if sender.stats()['sent'] == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_pool_reuses_connection(self):
+        sender = self.sender(pool_size=1)
+        for i in range(5):
+            sender.send_mail('subject %s' % i, 'text', '<p>html</p>')
+        self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(sender.stats()['sent'], 5)
+        self.assertEqual(sender.queue_depth, 0)
+
+    def test_idle_connection_closed(self):
+        sender = self.sender(pool_size=1, idle_timeout=0.2)
+        sender.send_mail('first', 'text')
+        self.assertTrue(sender.flush(timeout=5))
+        time.sleep(0.5)
+        sender.send_mail('second', 'text')
+        self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_queue_full(self):
+        self.server.shutdown()  # nobody accepts, the worker blocks
+        sender = self.sender(pool_size=1, queue_size=1, timeout=1)
+        for i in range(5):
+            sender.send_mail('subject %s' % i, 'text')
+        self.assertGreaterEqual(sender.stats()['dropped'], 3)
+
+    def test_spool_retry(self):
+        self.server.fail_next = 2
+        sender = self.sender(spool_dir=self.spool_dir, retry_base=0.05)
+        sender.send_mail('subject', 'text')
+        self.assertTrue(self.wait_for(lambda: self.server.messages))
+        self.assertTrue(self.wait_for(lambda: not self.spooled('new')))
+        self.assertEqual(sender.stats()['failed'], 2)
+        self.assertEqual(self.spooled('dead'), [])
+
+    def test_spool_dead_letter(self):
+        self.server.fail_next = 100
+        sender = self.sender(
+            spool_dir=self.spool_dir, retry_base=0.05, max_attempts=2
+        )
+        sender.send_mail('subject', 'text')
+        self.assertTrue(self.wait_for(lambda: self.spooled('dead')))
+        self.assertEqual(self.spooled('new'), [])
+        self.assertEqual(self.server.messages, [])
+
+    def test_spool_replay(self):
+        msg = EmailMessage()
+        msg['Subject'] = 'left over'
+        msg['To'] = 'to@example.com'
+        msg.set_content('text')
+        Spool(self.spool_dir, 8).put(msg)
+
+        self.sender(spool_dir=self.spool_dir)
+        self.assertTrue(self.wait_for(lambda: self.server.messages))
+        self.assertIn(b'left over', self.server.messages[0])
+        self.assertTrue(self.wait_for(lambda: not self.spooled('new')))
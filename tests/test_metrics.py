@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from periodtask import Task, TaskList
+from periodtask.metrics import Registry, MetricsServer
+
+
+class MetricsTest(unittest.TestCase):
+    def test_exposition(self):
+        registry = Registry()
+        counter = registry.counter('c_total', 'A counter', ('task',))
+        counter.labels('a "b"').inc()
+        counter.labels('a "b"').inc(2)
+        registry.gauge('g', 'A gauge').set(1.5)
+        registry.callback_gauge(
+            'cb', 'Callback', lambda: [(('x',), 7)], ('k',)
+        )
+        registry.callback_counter('cbc_total', 'Callback counter', lambda: 4)
+        hist = registry.histogram('h_seconds', 'Hist', buckets=(1, 2))
+        hist.observe(0.5)
+        hist.observe(1.5)
+        hist.observe(10)
+
+        text = registry.expose()
+        self.assertIn('# TYPE c_total counter', text)
+        self.assertIn('c_total{task="a \\"b\\""} 3', text)
+        self.assertIn('g 1.5', text)
+        self.assertIn('cb{k="x"} 7', text)
+        self.assertIn('# TYPE cbc_total counter', text)
+        self.assertIn('cbc_total 4', text)
+        self.assertIn('h_seconds_bucket{le="1"} 1', text)
+        self.assertIn('h_seconds_bucket{le="2"} 2', text)
+        self.assertIn('h_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('h_seconds_sum 12.0', text)
+        self.assertIn('h_seconds_count 3', text)
+
+    def test_server_and_textfile(self):
+        registry = Registry()
+        registry.counter('served_total', 'Served').inc()
+        server = MetricsServer(registry, 0)
+        try:
+            url = 'http://127.0.0.1:%s/metrics' % server.port
+            with urllib.request.urlopen(url, timeout=5) as response:
+                body = response.read().decode()
+        finally:
+            server.close()
+        self.assertIn('served_total 1', body)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'periodtask.prom')
+            registry.write_textfile(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), registry.expose())
+            self.assertEqual(os.listdir(tmp), ['periodtask.prom'])
+
+    def test_scheduler_metrics(self):
+        tasklist = []
+
+        def send(subject, text, html_message):
+            tasklist[0]._stop(check_subprocesses=False)
+
+        registry = Registry()
+        tl = TaskList(
+            Task(
+                'test_scheduler_metrics',
+                ('seq', '1', '10'), '* * * * * -1526', run_on_start=True,
+                mail_success=send
+            ),
+            metrics=registry,
+        )
+        tasklist.append(tl)
+        tl.start()
+
+        text = registry.expose()
+        self.assertIn(
+            'periodtask_outcomes_total{task="test_scheduler_metrics",'
+            'outcome="success"} 1', text
+        )
+        self.assertIn(
+            'periodtask_output_lines_total{task="test_scheduler_metrics"} 10',
+            text
+        )
+        self.assertIn(
+            'periodtask_run_duration_seconds_count'
+            '{task="test_scheduler_metrics"} 1', text
+        )
+        self.assertIn('periodtask_running_processes 0', text)
+        self.assertIn('# TYPE periodtask_mail_sent_total counter', text)
+        self.assertIn('# TYPE periodtask_mail_failed_total counter', text)
+        self.assertIn('periodtask_tick_duration_seconds_count', text)
@@ -0,0 +1,193 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from periodtask import Task, TaskList
+from periodtask.notifiers import (
+    OutcomeEvent, WebhookNotifier, JSONLinesNotifier, SyslogNotifier
+)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(json.loads(body))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ClosingHandler(WebhookHandler):
+    def do_POST(self):
+        # closes the kept-alive connection without telling the client
+        super().do_POST()
+        self.close_connection = True
+
+
+class SlowHandler(WebhookHandler):
+    def do_POST(self):
+        self.server.requests.append(None)
+        time.sleep(1)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler=WebhookHandler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.connections = 0
+        self.requests = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/hook' % self.server_address[1]
+
+
+def event(kind='success'):
+    return OutcomeEvent(kind, 'task', '2018-07-09 18:05:00 UTC, MON')
+
+
+class NotifierTest(unittest.TestCase):
+    def test_webhook_keep_alive(self):
+        server = WebhookServer()
+        try:
+            notifier = WebhookNotifier(server.url)
+            for i in range(3):
+                notifier.emit(event())
+            self.assertTrue(notifier.flush(timeout=5))
+            self.assertEqual(len(server.requests), 3)
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(notifier.stats()['sent'], 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_webhook_retry(self):
+        server = WebhookServer(ClosingHandler)
+        try:
+            notifier = WebhookNotifier(server.url)
+            for i in range(2):
+                notifier.emit(event())
+                self.assertTrue(notifier.flush(timeout=5))
+            # the second request is sent again on a new connection
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(server.connections, 2)
+            self.assertEqual(notifier.stats()['sent'], 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        server = WebhookServer(SlowHandler)
+        try:
+            notifier = WebhookNotifier(server.url, timeout=0.2)
+            notifier.emit(event())
+            self.assertTrue(notifier.flush(timeout=5))
+            # the server may have taken the events, they are not sent again
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(notifier.stats()['failed'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_webhook_batch(self):
+        server = WebhookServer()
+        try:
+            notifier = WebhookNotifier(
+                server.url, batch_size=10, batch_interval=0.2
+            )
+            for i in range(4):
+                notifier.emit(event())
+            self.assertTrue(notifier.flush(timeout=5))
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(len(server.requests[0]['events']), 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_backpressure(self):
+        release = threading.Event()
+
+        class Slow(JSONLinesNotifier):
+            def send_batch(self, events):
+                release.wait()
+
+        notifier = Slow(os.devnull, queue_size=1)
+        results = [notifier.emit(event()) for i in range(4)]
+        release.set()
+        self.assertFalse(all(results))
+        self.assertGreater(notifier.stats()['dropped'], 0)
+
+    def test_jsonlines_from_task(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            tasklist = []
+            notifier = JSONLinesNotifier(path)
+
+            def send(subject, text, html_message):
+                tasklist[0]._stop(check_subprocesses=False)
+
+            tl = TaskList(
+                Task(
+                    'test_jsonlines',
+                    ('tests/task_script.py', 'x'), '* * * * * -1526',
+                    run_on_start=True, mail_failure=send,
+                ),
+                notifiers=[notifier]
+            )
+            tasklist.append(tl)
+            tl.start()
+            with open(path) as f:
+                events = [json.loads(line) for line in f]
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0]['kind'], 'failure')
+            self.assertEqual(events[0]['task'], 'test_jsonlines')
+            self.assertEqual(events[0]['returncode'], 1)
+            self.assertIn('19', events[0]['stdout'])
+            self.assertGreater(events[0]['duration'], 0)
+        finally:
+            os.remove(path)
+
+    def test_syslog(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        try:
+            notifier = SyslogNotifier(address=sock.getsockname())
+            notifier.emit(event('failure'))
+            data = sock.recv(65536).decode()
+            # facility user (1) * 8 + error (3)
+            self.assertTrue(data.startswith('<11>periodtask: {'))
+            self.assertIn('"kind": "failure"', data)
+        finally:
+            sock.close()
+
+    def test_syslog_failure(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'log')
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            notifier = SyslogNotifier(address=path)
+            notifier.emit(event())
+            self.assertTrue(notifier.flush(timeout=5))
+            sock.close()
+            os.remove(path)
+            notifier.emit(event())
+            self.assertTrue(notifier.flush(timeout=5))
+        self.assertEqual(notifier.stats()['sent'], 1)
+        self.assertEqual(notifier.stats()['failed'], 1)
@@ -0,0 +1,46 @@
+import time
+import unittest
+
+from periodtask import Task, TaskList
+from periodtask.metrics import Registry
+from periodtask.process_thread import stop_threads
+
+
+class PriorityTest(unittest.TestCase):
+    def test_admission(self):
+        tasks = [
+            Task(
+                name, ('sleep', '5'), '* * * * * -1526', run_on_start=True,
+                priority=priority
+            )
+            for name, priority in (('low', 0), ('high', 10), ('mid', 5))
+        ]
+        registry = Registry()
+        tl = TaskList(*tasks, max_processes=2, metrics=registry)
+        tl.last_checked = int(time.time()) - 1
+        try:
+            tl._tick()
+            low, high, mid = tasks
+            self.assertEqual(len(high.process_threads), 1)
+            self.assertEqual(len(mid.process_threads), 1)
+            self.assertEqual(len(low.process_threads), 0)
+            self.assertEqual(len(low.delay_queue), 1)
+            text = registry.expose()
+            self.assertIn(
+                'periodtask_queue_wait_seconds_count{priority="10"} 1', text
+            )
+            self.assertIn('periodtask_waiting_runs{priority="0"} 1', text)
+        finally:
+            threads = [t for task in tasks for t in task.process_threads]
+            stop_threads(threads, time.time() + 5)
+
+    def test_aging(self):
+        low = Task('low', ('true',), priority=0)
+        high = Task('high', ('true',), priority=3)
+        tl = TaskList(low, high, max_processes=1, aging=60)
+        now = 1000000
+        self.assertEqual(tl.priority(high, now, now), 3)
+        # waiting for four minutes overtakes a fresh run of priority 3
+        self.assertGreater(
+            tl.priority(low, now - 240, now), tl.priority(high, now, now)
+        )
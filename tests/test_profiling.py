@@ -0,0 +1,68 @@
+import os
+import tempfile
+import time
+import unittest
+
+from periodtask import Task, TaskList
+from periodtask.profiling import (
+    PhaseTimer, TickHook, SlowTickWatchdog, SamplingProfiler
+)
+
+
+class RecordingHook(TickHook):
+    def __init__(self):
+        self.profiles = []
+        self.closed = False
+
+    def tick_finished(self, profile):
+        self.profiles.append(profile)
+
+    def close(self):
+        self.closed = True
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_nested_phases(self):
+        timer = PhaseTimer()
+        with timer.phase('check_subprocesses'):
+            time.sleep(0.05)
+            with timer.phase('mail'):
+                time.sleep(0.1)
+        self.assertGreaterEqual(timer.times['mail'], 0.1)
+        self.assertGreaterEqual(timer.times['check_subprocesses'], 0.05)
+        self.assertLess(timer.times['check_subprocesses'], 0.1)
+
+    def test_tick_hooks(self):
+        tasklist = []
+
+        def send(subject, text, html_message):
+            time.sleep(0.6)
+            tasklist[0]._stop(check_subprocesses=False)
+
+        hook = RecordingHook()
+        watchdog = SlowTickWatchdog(threshold=0.2, interval=0.05)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ticks.folded')
+            tl = TaskList(
+                Task(
+                    'test_tick_hooks',
+                    ('ls',), '* * * * * -1526', run_on_start=True,
+                    mail_success=send
+                ),
+                tick_hooks=[
+                    hook, watchdog, SamplingProfiler(path, interval=0.01)
+                ],
+            )
+            tasklist.append(tl)
+            with self.assertLogs('periodtask.profiling', 'WARNING') as cm:
+                tl.start()
+            with open(path) as f:
+                folded = f.read()
+
+        self.assertTrue(hook.closed)
+        self.assertTrue(hook.profiles[0].phases['start'] > 0)
+        self.assertTrue(hook.profiles[-1].phases['mail'] >= 0.6)
+        self.assertEqual(watchdog.dumps, 1)
+        self.assertIn('in send', cm.output[0])
+        self.assertIn('_tick (tasklist.py:', folded)
+        self.assertIn('send (test_profiling.py:', folded)
@@ -0,0 +1,147 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from periodtask import Task, TaskList
+from periodtask.remote import (
+    Agent, WorkerPool, FrameReader, encode, _Worker
+)
+
+
+def wait_for(func, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = func()
+        if result:
+            return result
+        time.sleep(0.1)
+    raise AssertionError('timeout')
+
+
+def start_agent(path, name, capacity):
+    return subprocess.Popen(
+        [
+            sys.executable, '-m', 'periodtask.remote', path,
+            '--name', name, '--capacity', str(capacity), '--heartbeat', '1'
+        ],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+class FrameTest(unittest.TestCase):
+    def test_frames(self):
+        data = encode({'type': 'status', 'load': 1}) + encode({'a': 'é'})
+        reader = FrameReader()
+        self.assertEqual(reader.feed(data[:3]), [])
+        self.assertEqual(reader.feed(data[3:10]), [])
+        self.assertEqual(
+            reader.feed(data[10:]), [{'type': 'status', 'load': 1}, {'a': 'é'}]
+        )
+
+    def test_choose(self):
+        small, big = _Worker(None), _Worker(None)
+        small.capacity, big.capacity = 1, 4
+        self.assertIs(WorkerPool.choose([small, big]), big)
+        big.runs = {1: None, 2: None}
+        big.load = 0.1
+        # 1/2 busy, small is empty but more loaded
+        small.load = 0.9
+        self.assertIs(WorkerPool.choose([small, big]), small)
+        small.runs = {3: None}
+        big.runs = {1: None, 2: None, 4: None, 5: None}
+        self.assertIsNone(WorkerPool.choose([small, big]))
+
+    def test_send_failure(self):
+        agent = Agent('/nonexistent.sock')
+        sock, pool_end = socket.socketpair()
+        agent.sock = sock
+        pool_end.close()
+        agent.send({'type': 'status', 'load': 0})
+        # the connection is given up, the agent connects again
+        self.assertIsNone(agent.sock)
+        agent.send({'type': 'status', 'load': 0})
+        sock.close()
+
+
+class RemoteTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'workers.sock')
+        self.agents = []
+
+    def tearDown(self):
+        for agent in self.agents:
+            agent.kill()
+            agent.wait()
+        self.tmp.cleanup()
+
+    def tick_until(self, tl, func):
+        tl.last_checked = int(time.time()) - 1
+        deadline = time.time() + 20
+        while not func():
+            if time.time() > deadline:
+                raise AssertionError('timeout')
+            tl._tick()
+            time.sleep(0.1)
+
+    def test_remote_run(self):
+        mails = []
+
+        def send(subject, text, html_message):
+            mails.append(text)
+
+        # the agents connect again when the pool is not there yet
+        self.agents.append(start_agent(self.path, 'a', 2))
+        pool = WorkerPool(self.path)
+        task = Task(
+            'test_remote', ('sh', '-c', 'echo out; echo err >&2; exit 3'),
+            '0 0 0 1 1 * UTC', run_on_start=True, mail_failure=send,
+            workers=pool
+        )
+        tl = TaskList(task)
+        time.sleep(1)
+        pool.start()
+        try:
+            wait_for(lambda: pool.capacity() == (1, 2))
+            self.tick_until(tl, lambda: tl.history)
+        finally:
+            pool.close()
+
+        run = tl.history[0]
+        self.assertEqual(run['outcome'], 'failure')
+        self.assertEqual(run['returncode'], 3)
+        self.assertEqual(len(mails), 1)
+        self.assertIn('out', mails[0])
+        self.assertIn('err', mails[0])
+        self.assertIsNotNone(task.stats.last.utime)
+
+    def test_requeue(self):
+        pool = WorkerPool(self.path)
+        pool.start()
+        task = Task(
+            'test_requeue', ('sh', '-c', 'sleep 1; echo done'),
+            '0 0 0 1 1 * UTC', run_on_start=True, workers=pool
+        )
+        tl = TaskList(task)
+        try:
+            self.agents.append(start_agent(self.path, 'a', 1))
+            self.agents.append(start_agent(self.path, 'b', 1))
+            wait_for(lambda: pool.capacity() == (2, 2))
+            self.tick_until(tl, lambda: task.process_threads)
+            run = task.process_threads[0]
+            worker = wait_for(lambda: run.worker)
+            # the agent running it dies
+            agent = self.agents[0 if worker == 'a' else 1]
+            agent.kill()
+            wait_for(lambda: run.requeued)
+            self.tick_until(tl, lambda: tl.history)
+        finally:
+            pool.close()
+
+        self.assertEqual(tl.history[0]['outcome'], 'success')
+        self.assertNotEqual(run.worker, worker)
+        self.assertEqual(run.stdout_lines, 'done')
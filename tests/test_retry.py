@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from periodtask import Task, TaskList
+from periodtask.retry import Retry
+
+
+class RetryTest(unittest.TestCase):
+    def test_delay(self):
+        retry = Retry(base=10, cap=25, jitter=0)
+        self.assertEqual([retry.delay(n) for n in (1, 2, 3)], [10, 20, 25])
+        retry = Retry(base=10, cap=25, jitter=1)
+        for _ in range(100):
+            self.assertTrue(0 <= retry.delay(3) <= 25)
+        retry = Retry(max_attempts=3, returncodes=[75])
+        self.assertTrue(retry.should_retry(1, 'failure', 75))
+        self.assertFalse(retry.should_retry(1, 'failure', 1))
+        self.assertFalse(retry.should_retry(3, 'failure', 75))
+        self.assertFalse(retry.should_retry(1, 'timeout', None))
+
+    def test_retry_success(self):
+        tasklist = []
+        mails = []
+
+        def send(subject, text, html_message):
+            mails.append(subject)
+            tasklist[0]._stop(check_subprocesses=False)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            counter = os.path.join(tmp, 'counter')
+            # fails twice, then succeeds
+            script = 'echo x >> %s; test $(wc -l < %s) -ge 3' % (
+                counter, counter
+            )
+            tl = TaskList(
+                Task(
+                    'test_retry_success', ('sh', '-c', script),
+                    '* * * * * -1526', run_on_start=True,
+                    mail_success=send, mail_failure=send,
+                    retry=Retry(max_attempts=3, base=0.1, jitter=0)
+                )
+            )
+            tasklist.append(tl)
+            tl.start()
+
+        self.assertEqual(len(mails), 1)
+        self.assertIn('COMPLETED', mails[0])
+        self.assertEqual(
+            [(r['attempt'], r['outcome']) for r in tl.history],
+            [(1, 'failure'), (2, 'failure'), (3, 'success')]
+        )
+
+    def test_retry_exhausted(self):
+        tasklist = []
+        mails = []
+
+        def send(subject, text, html_message):
+            mails.append(subject)
+            tasklist[0]._stop(check_subprocesses=False)
+
+        task = Task(
+            'test_retry_exhausted', ('sh', '-c', 'exit 75'),
+            '* * * * * -1526', run_on_start=True, mail_failure=send,
+            retry=Retry(max_attempts=2, base=0.1, returncodes=[75])
+        )
+        tl = TaskList(task)
+        tasklist.append(tl)
+        tl.start()
+
+        self.assertEqual(len(mails), 1)
+        self.assertIn('FAIL', mails[0])
+        self.assertEqual(len(tl.history), 2)
+        # one logical run counts against failure_email_threshold
+        self.assertEqual(task.failure_email_sent, 1)
@@ -0,0 +1,72 @@
+import unittest
+
+from . import ts
+from periodtask import Task, TaskList
+from periodtask.retry import Retry
+from periodtask.simulation import Simulation, Profile
+
+
+class SimulationTest(unittest.TestCase):
+    def test_overlap(self):
+        start = ts('2018-07-10 10:00:00')
+        tl = TaskList(Task(
+            'overlap', ('true',), '0 */5 * * * * UTC',
+            mail_skipped=True
+        ))
+        simulation = Simulation(
+            tl, start, start + 3600, default=Profile(duration=400)
+        )
+        timeline = simulation.run()
+
+        kinds = [e.kind for e in timeline]
+        self.assertEqual(kinds.count('start'), 6)
+        self.assertEqual(kinds.count('success'), 6)
+        self.assertEqual(kinds.count('skipped'), 6)
+        self.assertEqual(
+            [e.detail for e in timeline if e.kind == 'notify'],
+            ['skipped'] * 6
+        )
+        self.assertEqual(timeline[0].time, start)
+        self.assertEqual(timeline[1].kind, 'skipped')
+        self.assertEqual(timeline[1].time, start + 300)
+        successes = [e for e in timeline if e.kind == 'success']
+        self.assertEqual(successes[0].time, start + 400)
+
+    def test_max_runtime(self):
+        start = ts('2018-07-10 10:00:00')
+        tl = TaskList(Task(
+            'max_runtime', ('true',), '0 0 * * * * UTC', mail_timeout=True,
+            max_runtime=30
+        ))
+        simulation = Simulation(
+            tl, start, start + 1800, default=Profile(duration=100)
+        )
+        timeline = simulation.run()
+
+        # the outcome is recorded when the timer stops the process
+        self.assertEqual(
+            [(e.time - start, e.kind) for e in timeline],
+            [(0, 'start'), (30, 'timeout'), (30, 'notify')]
+        )
+        self.assertEqual(tl.history[0]['outcome'], 'timeout')
+
+    def test_retry(self):
+        start = ts('2018-07-10 10:00:00')
+        tl = TaskList(Task(
+            'retry', ('false',), '0 0 * * * * UTC', mail_failure=True,
+            retry=Retry(max_attempts=3, base=60, jitter=0)
+        ))
+        simulation = Simulation(
+            tl, start, start + 1800,
+            profiles={'retry': Profile(duration=1, failure_rate=1)},
+            render=True
+        )
+        timeline = simulation.run()
+
+        self.assertEqual(
+            [e.time - start for e in timeline if e.kind == 'start'],
+            [0, 61, 182]
+        )
+        notifications = [e for e in timeline if e.kind == 'notify']
+        self.assertEqual(len(notifications), 1)
+        self.assertTrue(notifications[0].detail.startswith('!!! retry FAIL'))
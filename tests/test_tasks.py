@@ -1,7 +1,32 @@
+import os
+import threading
+import time
+import types
 import unittest
 
 from . import ts
-from periodtask import Task, TaskList
+from periodtask import (
+    Task, TaskList, DELAY, RUN, DROP_OLDEST, DROP_NEWEST, COALESCE
+)
+from periodtask.limits import Limits
+from periodtask.digest import Digest
+from periodtask.simulation import Simulation, Profile
+from periodtask import process_thread
+from periodtask.process_thread import SpawnedProcess, stop_threads
+
+
+def running_in_group(pgid):
+    running = []
+    for pid in os.listdir('/proc'):
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                stat = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # zombies are not reaped by every init
+        if int(stat[2]) == pgid and stat[0] != 'Z':
+            running.append(pid)
+    return running
 
 
 class TaskTest(unittest.TestCase):
@@ -18,7 +43,7 @@ class TaskTest(unittest.TestCase):
 
         def send(subject, text, html_message):
             tasklist[0]._stop(check_subprocesses=False)
-            self.assertEqual(len(text.splitlines()), 105)
+            self.assertEqual(len(text.splitlines()), 113)
 
         tl = TaskList(
             Task(
@@ -36,7 +61,7 @@ class TaskTest(unittest.TestCase):
 
         def send(subject, text, html_message):
             tasklist[0]._stop(check_subprocesses=False)
-            self.assertEqual(len(text.splitlines()), 9)
+            self.assertEqual(len(text.splitlines()), 17)
 
         tl = TaskList(
             Task(
@@ -108,7 +133,7 @@ class TaskTest(unittest.TestCase):
 
         def send(subject, text, html_message):
             tasklist[0]._stop(check_subprocesses=False)
-            self.assertEqual(len(text.splitlines()), 16)
+            self.assertEqual(len(text.splitlines()), 24)
 
         tl = TaskList(
             Task(
@@ -127,7 +152,7 @@ class TaskTest(unittest.TestCase):
 
         def send(subject, text, html_message):
             tasklist[0]._stop(check_subprocesses=False)
-            self.assertEqual(len(text.splitlines()), 24)
+            self.assertEqual(len(text.splitlines()), 32)
 
         tl = TaskList(
             Task(
@@ -146,7 +171,7 @@ class TaskTest(unittest.TestCase):
 
         def send(subject, text, html_message):
             tasklist[0]._stop(check_subprocesses=False)
-            self.assertEqual(len(text.splitlines()), 24)
+            self.assertEqual(len(text.splitlines()), 32)
 
         tl = TaskList(
             Task(
@@ -165,7 +190,7 @@ class TaskTest(unittest.TestCase):
 
         def send(subject, text, html_message):
             tasklist[0]._stop(check_subprocesses=False)
-            self.assertEqual(len(text.splitlines()), 15)
+            self.assertEqual(len(text.splitlines()), 23)
 
         tl = TaskList(
             Task(
@@ -179,6 +204,228 @@ class TaskTest(unittest.TestCase):
         tasklist.append(tl)
         tl.start()
 
+    def test_resource_accounting(self):
+        tasklist = []
+
+        mails = []
+
+        def send(subject, text, html_message):
+            tasklist[0]._stop(check_subprocesses=False)
+            mails.append((text, html_message))
+
+        task = Task(
+            'test_resource_accounting',
+            ('tests/task_script.py',), '*', run_on_start=True,
+            mail_success=send,
+        )
+        tl = TaskList(task)
+        tasklist.append(tl)
+        tl.start()
+
+        result = task.stats.last
+        self.assertEqual(task.stats.runs, 1)
+        self.assertEqual(result.returncode, 0)
+        self.assertGreater(result.duration, 0)
+        self.assertGreater(result.maxrss, 0)
+        self.assertIsNotNone(result.start_delay)
+        text, html_message = mails[0]
+        self.assertIn('RESOURCES', text)
+        # the statistics of the task are rendered
+        self.assertIn('TASK STATISTICS', text)
+        self.assertIn('1 runs, 0 failures, 0 timeouts; last 1 runs', text)
+        self.assertIn('TASK STATISTICS', html_message)
+
+    def test_cpu_limit(self):
+        tasklist = []
+        subjects = []
+
+        def send(subject, text, html_message):
+            tasklist[0]._stop(check_subprocesses=False)
+            subjects.append(subject)
+            self.assertIn('RLIMIT_CPU', text)
+
+        tl = TaskList(
+            Task(
+                'test_cpu_limit',
+                ('python3', '-c', 'while True: pass'), '*',
+                run_on_start=True,
+                mail_failure=send,
+                limits=Limits(cpu_time=1, nice=5),
+            )
+        )
+        tasklist.append(tl)
+        tl.start()
+        self.assertIn('FAILURE (LIMIT)', subjects[0])
+
+    def test_max_runtime(self):
+        tasklist = []
+        subjects = []
+
+        def send(subject, text, html_message):
+            tasklist[0]._stop(check_subprocesses=False)
+            subjects.append(subject)
+
+        task = Task(
+            'test_max_runtime',
+            ('tests/longtask.py',), '*',
+            run_on_start=True,
+            mail_failure=send,
+            max_runtime=1,
+        )
+        tl = TaskList(task)
+        tasklist.append(tl)
+        tl.start()
+        self.assertIn('TIMEOUT', subjects[0])
+        self.assertEqual(task.stats.timeouts, 1)
+
+    def test_parallel_stop(self):
+        script = (
+            'import signal, time\n'
+            'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+            'print("started", flush=True)\n'
+            'time.sleep(30)\n'
+        )
+        tasks = [
+            Task(
+                'test_parallel_stop_%s' % i,
+                ('python3', '-c', script), '* * * * * -1526',
+                wait_timeout=2
+            ) for i in range(3)
+        ]
+        tl = TaskList(*tasks)
+        for task in tasks:
+            task.start_process_thread('now')
+        time.sleep(1)
+
+        start = time.time()
+        tl._stop()
+        self.assertLess(time.time() - start, 4)
+        for task in tasks:
+            self.assertEqual(task.process_threads, [])
+
+    def test_orphaned_descendants(self):
+        task = Task(
+            'test_orphaned_descendants',
+            ('sh', '-c', 'sleep 30 & echo started'), '* * * * * -1526',
+            pipe_grace=1
+        )
+        task.start_process_thread('now')
+        thrd = task.process_threads[0]
+        thrd.join(timeout=5)
+        self.assertFalse(thrd.is_alive())
+        self.assertEqual(thrd.returncode, 0)
+        self.assertEqual(thrd.stdout_lines, 'started')
+        self.assertEqual(running_in_group(thrd.proc.pid), [])
+
+    def test_stop_process_group(self):
+        task = Task(
+            'test_stop_process_group',
+            ('sh', '-c', 'sleep 30; echo done'), '* * * * * -1526',
+            wait_timeout=2
+        )
+        task.start_process_thread('now')
+        time.sleep(0.5)
+        start = time.time()
+        task.stop()
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(task.process_threads, [])
+
+    def test_posix_spawn(self):
+        task = Task(
+            'test_posix_spawn',
+            ('sh', '-c', 'echo out; echo err >&2; sleep 30'),
+            '* * * * * -1526', launcher='posix_spawn', wait_timeout=2
+        )
+        task.start_process_thread('now')
+        thrd = task.process_threads[0]
+        thrd.started.wait()
+        self.assertIsInstance(thrd.proc, SpawnedProcess)
+        # a new session, like with Popen
+        self.assertEqual(os.getpgid(thrd.proc.pid), thrd.proc.pid)
+        time.sleep(0.5)
+        task.stop()
+        self.assertEqual(thrd.returncode, -15)
+        self.assertEqual(thrd.stdout_lines, 'out')
+        self.assertEqual(thrd.stderr_lines, 'err')
+
+        # there is no chdir file action
+        task = Task(
+            'test_posix_spawn_cwd', ('pwd',), '* * * * * -1526',
+            launcher='posix_spawn', cwd='/'
+        )
+        task.start_process_thread('now')
+        thrd = task.process_threads[0]
+        thrd.join()
+        self.assertNotIsInstance(thrd.proc, SpawnedProcess)
+        self.assertEqual(thrd.stdout_lines, '/')
+
+    def test_digest(self):
+        tasklist = []
+        mails = []
+
+        def send(subject, text, html_message):
+            mails.append((subject, text))
+            if len(mails) == 2:
+                tasklist[0]._stop(check_subprocesses=False)
+
+        tl = TaskList(
+            Task(
+                'test_digest_ok',
+                ('tests/task_script.py',), '* * * * * -1526',
+                run_on_start=True,
+                mail_success=send,
+            ),
+            Task(
+                'test_digest_fail',
+                ('tests/task_script.py', 'x'), '* * * * * -1526',
+                run_on_start=True,
+                mail_failure=send,
+                urgent=True,
+            ),
+            digest=Digest(window=2),
+        )
+        tasklist.append(tl)
+        tl.start()
+
+        # the urgent failure comes first, then a single summary
+        self.assertIn('FAILURE', mails[0][0])
+        self.assertIn('summary of 2 task(s)', mails[1][0])
+        self.assertIn('test_digest_ok', mails[1][1])
+        self.assertIn('SUCCESS: 1', mails[1][1])
+        self.assertIn('FAILURE: 1', mails[1][1])
+
+    def test_digest_counts_every_outcome(self):
+        start = ts('2018-07-10 10:00:00')
+
+        mails = []
+
+        def send(subject, text, html_message):
+            mails.append(text)
+
+        digest = Digest(window=86400, send_mail_func=send)
+        tl = TaskList(
+            Task(
+                'test_digest_count', ('false',), '0 * * * * * UTC',
+                mail_failure=True, urgent=True
+            ),
+            Task('test_digest_nomail', ('false',), '0 * * * * * UTC'),
+            digest=digest,
+        )
+        timeline = Simulation(
+            tl, start, start + 7 * 60 - 1,
+            default=Profile(duration=1, failure_rate=1)
+        ).run()
+
+        # the threshold only limits the immediate notifications
+        notifications = [e for e in timeline if e.kind == 'notify']
+        self.assertEqual(len(notifications), 5)
+        # mail_failure=True and no mail function: the default one is used
+        digest.dispatcher = None
+        digest.flush()
+        self.assertEqual(len(mails), 1)
+        for name in ('test_digest_count', 'test_digest_nomail'):
+            self.assertRegex(mails[0], '%s\n=+\nFAILURE: 7\n' % name)
+
     def test_multi_fail(self):
         tasklist = []
         messages = {'COMPLETED': 0, 'FAILURE': 0, 'RECOVERED': 0}
@@ -210,3 +457,112 @@ class TaskTest(unittest.TestCase):
         )
         tasklist.append(tl)
         tl.start()
+
+    def test_delay_queue_overflow(self):
+        mails = []
+
+        def send(subject, text, html_message):
+            mails.append(text)
+
+        running = types.SimpleNamespace(
+            formatted_sec='running', stdout_lines='', stderr_lines=''
+        )
+        start = ts('2018-07-10 10:15:00')
+        queues = {}
+        for overflow in (DROP_OLDEST, DROP_NEWEST, COALESCE):
+            task = Task(
+                'test_delay_queue_overflow', ('true',), '* * * * * * UTC',
+                policy=DELAY, max_delay_queue=2, delay_overflow=overflow,
+                mail_delayed=send, skip_delayed_email_threshold=None
+            )
+            task.process_threads = [running]
+            for sec in range(start, start + 5):
+                task.check_for_second(sec)
+            queues[overflow] = [s - start for s, _, _ in task.delay_queue]
+
+        self.assertEqual(queues[DROP_OLDEST], [3, 4])
+        self.assertEqual(queues[DROP_NEWEST], [0, 1])
+        self.assertEqual(queues[COALESCE], [0, 4])
+        self.assertEqual([n for _, _, n in task.delay_queue], [0, 3])
+        self.assertIn('absorbed 3 more run(s)', mails[-1])
+
+        # the oldest run starts, the absorbing one keeps its count
+        task.process_threads = []
+        task.paused = True
+        task.check_for_second(start + 5)
+        task.paused = False
+        task.check_for_second(start + 6)
+        self.assertEqual(
+            [(s - start, n) for s, _, n in task.delay_queue], [(4, 3), (6, 0)]
+        )
+        self.assertNotIn('absorbed', mails[-1])
+
+        task.paused = True
+        for absorbed in ('absorbed 3 run(s)', None):
+            task.process_threads[0].join()
+            task.check_subprocesses()
+            with self.assertLogs('periodtask.task', 'INFO') as logs:
+                task.check_for_second(start + 7)
+            started = [m for m in logs.output if 'absorbed' in m]
+            if absorbed:
+                self.assertIn(absorbed, started[0])
+            else:
+                self.assertEqual(started, [])
+        self.assertEqual(len(task.delay_queue), 0)
+        task.process_threads[0].join()
+
+    def test_stop_threads_deadline(self):
+        release = threading.Event()
+        stuck = threading.Thread(target=release.wait)
+        # a thread that does not end when its process is killed
+        stuck.task_name, stuck.formatted_sec = 'test_stuck', 'now'
+        stuck.wait_timeout = 0.1
+        stuck.send_stop_signal = stuck.kill = lambda: None
+        stuck.start()
+        grace = process_thread.KILL_GRACE
+        process_thread.KILL_GRACE = 0.1
+        try:
+            started = time.time()
+            with self.assertLogs('periodtask.process_thread', 'ERROR') as logs:
+                stop_threads([stuck], started + 0.2)
+            self.assertLess(time.time() - started, 2)
+            self.assertIn('test_stuck started for now', logs.output[0])
+        finally:
+            process_thread.KILL_GRACE = grace
+            release.set()
+            stuck.join()
+
+    def test_run_policy_starts_every_fire(self):
+        start = ts('2018-07-10 10:15:00')
+        task = Task(
+            'test_run_policy_starts_every_fire', ('true',),
+            '* * * * * * UTC', policy=RUN, max_starts_per_tick=3
+        )
+        self.assertEqual(task.check_for_seconds(range(start, start + 5)), 3)
+        self.assertEqual(
+            [t.sec - start for t in task.process_threads], [0, 1, 2]
+        )
+        self.assertEqual(
+            [t.formatted_sec[:19] for t in task.process_threads],
+            ['2018-07-10 10:15:0%s' % i for i in range(3)]
+        )
+        # the rest starts in the next tick
+        self.assertEqual(
+            [s - start for s, _, _ in task.delay_queue], [3, 4]
+        )
+        self.assertEqual(task.check_for_seconds([start + 5]), 3)
+        self.assertEqual(len(task.delay_queue), 0)
+        self.assertEqual(
+            [t.sec - start for t in task.process_threads], [0, 1, 2, 3, 4, 5]
+        )
+        for thrd in task.process_threads:
+            thrd.join()
+
+    def test_shared_state(self):
+        first = Task('test_shared_state_1', ('true',), '0 0 * * * * UTC')
+        second = Task('test_shared_state_2', ('true',), '0 0 * * * * UTC')
+        self.assertIs(first.periods[0], second.periods[0])
+        self.assertIs(first.template_lookup, second.template_lookup)
+        other = Task('test_shared_state_3', ('true',), template_dir='/tmp')
+        self.assertIsNot(first.template_lookup, other.template_lookup)
+        self.assertFalse(hasattr(first, '__dict__'))
@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+import unittest
+
+from periodtask import Task, TaskList
+from periodtask.dispatcher import Dispatcher
+from periodtask.tracing import Tracer, trace_id
+
+
+def read_spans(path):
+    spans = []
+    with open(path) as f:
+        for line in f:
+            for resource in json.loads(line)['resourceSpans']:
+                for scope in resource['scopeSpans']:
+                    spans.extend(scope['spans'])
+    return spans
+
+
+class TracingTest(unittest.TestCase):
+    def test_run_trace(self):
+        tasklist = []
+        texts = []
+
+        def send(subject, text, html_message):
+            texts.append(text)
+            tasklist[0]._stop(check_subprocesses=False)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'spans.jsonl')
+            tl = TaskList(
+                Task(
+                    'test_run_trace',
+                    ('sh', '-c', 'echo $TRACEPARENT'), '* * * * * -1526',
+                    run_on_start=True, mail_success=send
+                ),
+                dispatcher=Dispatcher(),
+                tracer=Tracer(path, batch_interval=0.1),
+            )
+            tasklist.append(tl)
+            tl.start()
+            spans = read_spans(path)
+
+        names = sorted(s['name'] for s in spans)
+        self.assertEqual(
+            names,
+            ['drain', 'notify', 'process', 'queue', 'run test_run_trace']
+        )
+        root = [s for s in spans if s['name'].startswith('run')][0]
+        process = [s for s in spans if s['name'] == 'process'][0]
+        self.assertEqual(set(s['traceId'] for s in spans), {root['traceId']})
+        for span in spans:
+            if span is not root:
+                self.assertEqual(span['parentSpanId'], root['spanId'])
+        self.assertEqual(root['status'], {'code': 1})
+        self.assertIn(
+            '00-%s-%s-01' % (root['traceId'], process['spanId']), texts[0]
+        )
+        self.assertLessEqual(
+            int(root['startTimeUnixNano']), int(process['startTimeUnixNano'])
+        )
+
+    def test_rotation(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'spans.jsonl')
+            tracer = Tracer(
+                path, max_bytes=2000, backup_count=2, batch_interval=0.01
+            )
+            for i in range(50):
+                trace = tracer.start_run('task', i, 'sec')
+                trace.close()
+                tracer.flush()
+            self.assertEqual(
+                sorted(os.listdir(tmp)),
+                ['spans.jsonl', 'spans.jsonl.1', 'spans.jsonl.2']
+            )
+            self.assertEqual(
+                read_spans(path)[-1]['traceId'], trace_id('task', 49, 'sec')
+            )
+
+    def test_export_failure(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tracer = Tracer(
+                os.path.join(tmp, 'missing', 'spans.jsonl'),
+                batch_interval=0.01
+            )
+            tracer.start_run('task', 0, 'sec').close()
+            tracer.flush()
+        stats = tracer.exporter.stats()
+        self.assertEqual(stats['sent'], 0)
+        self.assertGreater(stats['failed'], 0)